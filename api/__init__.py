@@ -1 +1,2 @@
+from .compression import CompressionMiddleware
 from .endpoints import add_api_routes
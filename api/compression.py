@@ -0,0 +1,94 @@
+import gzip
+import io
+import os
+import zlib
+
+import falcon
+
+from log import LogManager
+
+logger = LogManager(__name__)
+
+
+class CompressionMiddleware(object):
+    """ The CompressionMiddleware lets clients send gzip compressed bodies,
+    such as large task results, and gzips the responses that are large enough
+    to be worth it for clients that accept it. Streamed responses, like task
+    output, are passed through unchanged.
+    """
+
+    def __init__(self, threshold=1024, max_body_size=64 * 1024 * 1024, level=6):
+        self._threshold = threshold
+        self._max_body_size = max_body_size
+        self._level = level
+
+    @classmethod
+    def from_environ(cls):
+        """ Create a new CompressionMiddleware configured by the optional
+        environment variables SWARMER_COMPRESS_THRESHOLD, in bytes where 0
+        turns off compressing responses, and SWARMER_MAX_BODY_SIZE, the largest
+        size in bytes a compressed request body may expand to
+        """
+        return cls(threshold=int(os.environ.get('SWARMER_COMPRESS_THRESHOLD', '1024')),
+                   max_body_size=int(os.environ.get('SWARMER_MAX_BODY_SIZE', str(64 * 1024 * 1024))))
+
+    def process_request(self, req: falcon.Request, _: falcon.Response):
+        encoding = (req.get_header('Content-Encoding') or 'identity').strip().lower()
+        if encoding == 'identity':
+            return
+        if encoding not in ['gzip', 'x-gzip']:
+            raise falcon.HTTPUnsupportedMediaType(description='Unsupported Content-Encoding {e}'.format(e=encoding))
+
+        body = self._decompress(req.bounded_stream.read())
+        logger.debug('Decompressed a request body to {n} bytes'.format(n=len(body)))
+        req.env['CONTENT_LENGTH'] = str(len(body))
+        req.env.pop('HTTP_CONTENT_ENCODING', None)
+        req.env['wsgi.input'] = io.BytesIO(body)
+        req.stream = req.env['wsgi.input']
+        # Falcon caches the bounded stream, it has to be rebuilt around the new body
+        req._bounded_stream = None
+
+    def process_response(self, req: falcon.Request, resp: falcon.Response, *_):
+        if not self._threshold or resp.body is not None or resp.stream is not None:
+            return
+        if resp.get_header('Content-Encoding') or not _accepts_gzip(req.get_header('Accept-Encoding')):
+            return
+
+        resp.append_header('Vary', 'Accept-Encoding')
+        data = resp.data
+        if data is None or len(data) < self._threshold:
+            return
+        resp.data = gzip.compress(data, compresslevel=self._level)
+        resp.set_header('Content-Encoding', 'gzip')
+
+    def _decompress(self, compressed):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(compressed, self._max_body_size)
+            if decompressor.unconsumed_tail:
+                raise falcon.HTTPPayloadTooLarge(
+                    description='The request body expands to more than {n} bytes'.format(n=self._max_body_size))
+            body += decompressor.flush()
+        except zlib.error as ex:
+            raise falcon.HTTPBadRequest(description='Unable to decompress the request body: {e}'.format(e=ex))
+        if not decompressor.eof:
+            raise falcon.HTTPBadRequest(description='The compressed request body is incomplete')
+        return body
+
+
+def _accepts_gzip(header):
+    """ Check whether an Accept-Encoding header allows gzip, encodings given
+    a quality of 0 are refused
+    """
+    for entry in (header or '').split(','):
+        coding, _, params = entry.strip().partition(';')
+        if coding.strip().lower() not in ['gzip', 'x-gzip', '*']:
+            continue
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
@@ -1,8 +1,13 @@
+import json
 import logging
+import os
+from threading import BoundedSemaphore
 
 import falcon
 from falcon.media.validators import jsonschema
+from redis import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 
+from db import JobDb
 from jobs import JobRunner
 from log import LogManager
 from .schema import get_schema_for
@@ -21,24 +26,138 @@ class SubmitJobResource(object):
         image_name = req.media.get('image_name')
         callback = req.media.get('callback_url')
         tasks = req.media.get('tasks')
-        # tasks = req.media.get('tasks')
-        identifier = self._runner.create_new_job(image_name, callback, tasks)
+        identifier = self._runner.create_new_job(image_name, callback, tasks, priority=req.media.get('priority'),
+                                                 tenant=req.media.get('tenant'),
+                                                 batch_size=req.media.get('batch_size'))
         logger.info('Job created with identifier {i}'.format(i=identifier))
         resp.status = falcon.HTTP_201
         resp.media = {'id': identifier}
         resp.location = '/status/{i}'.format(i=identifier)
 
 
+class SubmitJobBatchResource(object):
+    def __init__(self, runner: JobRunner):
+        logger.info('Spinning up the SubmitJobBatchResource')
+        self._runner = runner
+
+    @jsonschema.validate(get_schema_for('job_batch_submit'))
+    def on_post(self, req: falcon.Request, resp: falcon.Response):
+        jobs = req.media.get('jobs')
+        logger.info('Received request to create {n} new jobs'.format(n=len(jobs)))
+        identifiers = self._runner.create_new_jobs(
+            [(j.get('image_name'), j.get('callback_url'), j.get('tasks'), j.get('priority'), j.get('tenant'),
+              j.get('batch_size')) for j in jobs])
+        logger.info('Jobs created with identifiers {i}'.format(i=', '.join(identifiers)))
+        resp.status = falcon.HTTP_201
+        resp.media = {'ids': identifiers}
+
+
 class JobStatusResource(object):
     def __init__(self, runner: JobRunner):
         logger.info('Spinning up the JobStatusResource')
         self._runner = runner
 
-    def on_get(self, _: falcon.Request, resp: falcon.Response, job_id: str):
+    def on_get(self, req: falcon.Request, resp: falcon.Response, job_id: str):
         logger.info('Received request for status of job {i}'.format(i=job_id))
-        job = self._runner.get_job(job_id)
+        if req.get_param('view') == 'summary':
+            resp.media = self._runner.get_job_summary(job_id)
+            return
+
+        fields = req.get_param_as_list('fields')
+        if fields is not None:
+            fields = ['name'] + [f for f in fields if f != 'name']
+            unknown = set(fields) - set(JobDb.TASK_FIELDS.values()) - {'name'}
+            if unknown:
+                raise falcon.HTTPBadRequest(description='Unknown task fields: {f}'.format(f=', '.join(sorted(unknown))))
+        resp.media = self._runner.get_job(job_id, fields=fields)
+
+
+class JobWatchResource(object):
+    # Seconds a long poll waits for the job to change, unless the client asks for less
+    MAX_TIMEOUT = 30
+
+    # Seconds between keep alive comments on an event stream
+    KEEPALIVE_INTERVAL = 15
+
+    # Seconds an event stream is kept open before the client has to reconnect, which
+    # hands its request thread to the next watcher in line
+    STREAM_DURATION = 300
+
+    # Every watcher holds a request thread, only this many may watch at once so the
+    # rest of the threads stay free for callbacks and submissions
+    MAX_WATCHERS = 8
+
+    # Seconds a turned away watcher is asked to wait before trying again
+    RETRY_AFTER = 5
+
+    def __init__(self, runner: JobRunner, max_watchers=None):
+        logger.info('Spinning up the JobWatchResource')
+        self._runner = runner
+        self._slots = BoundedSemaphore(self.MAX_WATCHERS if max_watchers is None else max_watchers)
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response, job_id: str):
+        if not self._slots.acquire(blocking=False):
+            logger.info('Turning away a watcher of job {i}, too many jobs are being watched'.format(i=job_id))
+            raise falcon.HTTPServiceUnavailable(description='Too many jobs are being watched, poll /status instead',
+                                                retry_after=self.RETRY_AFTER)
+        # A stream hands its slot on to the generator, which releases it once the stream ends
+        release = True
+        try:
+            since = req.get_param_as_int('since')
+            if 'text/event-stream' in (req.accept or ''):
+                last_event = req.get_header('Last-Event-ID')
+                if last_event is not None and last_event.isdigit():
+                    since = int(last_event)
+                self._stream(resp, job_id, since, req.get_param_as_bool('full') or False)
+                release = False
+                return
+
+            self._poll(req, resp, job_id, since)
+        finally:
+            if release:
+                self._slots.release()
+
+    def _poll(self, req, resp, job_id, since):
+        timeout = req.get_param_as_int('timeout')
+        timeout = self.MAX_TIMEOUT if timeout is None else max(0, min(timeout, self.MAX_TIMEOUT))
+        try:
+            job = self._runner.watch_job(job_id, since=since, timeout=timeout,
+                                         full=req.get_param_as_bool('full') or False)
+        except ValueError as ex:
+            raise falcon.HTTPNotFound(description=str(ex))
+        if job is None:
+            resp.status = falcon.HTTP_NO_CONTENT
+            return
         resp.media = job
 
+    def _stream(self, resp, job_id, since, full):
+        logger.info('Streaming the status of job {i}'.format(i=job_id))
+        try:
+            changes = self._runner.follow_job(job_id, since=since, keepalive=self.KEEPALIVE_INTERVAL,
+                                              duration=self.STREAM_DURATION, full=full)
+        except ValueError as ex:
+            raise falcon.HTTPNotFound(description=str(ex))
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.stream = _format_events(changes, self._slots)
+
+
+def _format_events(changes, slots):
+    """ Format each change to a job as a server sent event, with a keep alive
+    comment whenever nothing changed
+    """
+    try:
+        for job in changes:
+            if job is None:
+                yield b': keepalive\n\n'
+                continue
+            yield 'id: {v}\nevent: status\ndata: {d}\n\n'.format(v=job.get(JobDb.VERSION_FIELD, 0),
+                                                                  d=json.dumps(job)).encode('utf-8')
+    finally:
+        # Stops following the job and frees the watcher slot when the client goes away
+        changes.close()
+        slots.release()
+
 
 class ClientCallbackResource(object):
     def __init__(self, runner: JobRunner):
@@ -55,6 +174,91 @@ class ClientCallbackResource(object):
         resp.status = falcon.HTTP_NO_CONTENT
 
 
+class ClientBatchCallbackResource(object):
+    def __init__(self, runner: JobRunner):
+        logger.info('Spinning up the ClientBatchCallbackResource')
+        self._runner = runner
+
+    @jsonschema.validate(get_schema_for('batch_result_submit'))
+    def on_post(self, req: falcon.Request, resp: falcon.Response, job_id):
+        results = req.media.get('results')
+        logger.info('Received results for {n} tasks in job {i}'.format(n=len(results), i=job_id))
+        self._runner.complete_tasks(job_id, [(r.get('task_name'), r.get('task_status'), r.get('task_result'))
+                                             for r in results])
+        resp.status = falcon.HTTP_NO_CONTENT
+
+
+class PoolTaskResource(object):
+    # Seconds a worker should wait before asking again when there is no task
+    RETRY_AFTER = 1
+
+    def __init__(self, runner: JobRunner):
+        logger.info('Spinning up the PoolTaskResource')
+        self._runner = runner
+
+    def on_get(self, _: falcon.Request, resp: falcon.Response, pool_id: str):
+        task = self._runner.next_pool_task(pool_id)
+        if task is None:
+            resp.status = falcon.HTTP_NO_CONTENT
+            resp.set_header('Retry-After', str(self.RETRY_AFTER))
+            return
+
+        logger.info('Handing task {tn} of job {i} to pool {p}'.format(tn=task['task_name'], i=task['job_id'],
+                                                                    p=pool_id))
+        resp.media = task
+
+
+class TaskOutputResource(object):
+    # Bytes of the request body read and stored at a time
+    CHUNK_SIZE = 65536
+
+    def __init__(self, runner: JobRunner):
+        logger.info('Spinning up the TaskOutputResource')
+        self._runner = runner
+
+    def on_post(self, req: falcon.Request, resp: falcon.Response, job_id: str, task_name: str, stream: str):
+        logger.info('Receiving {s} output of task {tn} in job {i}'.format(s=stream, tn=task_name, i=job_id))
+        try:
+            while True:
+                chunk = req.bounded_stream.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._runner.append_task_output(job_id, task_name, stream, chunk)
+        except ValueError as ex:
+            raise falcon.HTTPNotFound(description=str(ex))
+        resp.status = falcon.HTTP_NO_CONTENT
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response, job_id: str, task_name: str, stream: str):
+        if not self._runner.can_read_output(req.path, req.get_param('expires'), req.get_param('signature')):
+            raise falcon.HTTPForbidden(description='The output link is invalid or has expired')
+        try:
+            resp.stream = self._runner.read_task_output(job_id, task_name, stream)
+        except ValueError as ex:
+            raise falcon.HTTPNotFound(description=str(ex))
+        resp.content_type = 'text/plain; charset=utf-8'
+
+
+class HealthResource(object):
+    def __init__(self, runner: JobRunner):
+        logger.info('Spinning up the HealthResource')
+        self._runner = runner
+
+    def on_get(self, _: falcon.Request, resp: falcon.Response):
+        healthy = self._runner.is_healthy()
+        resp.status = falcon.HTTP_OK if healthy else falcon.HTTP_SERVICE_UNAVAILABLE
+        resp.media = {'redis': 'ok' if healthy else 'unavailable'}
+
+
+def handle_store_unavailable(ex, _: falcon.Request, resp: falcon.Response, __):
+    """ Answer requests that could not reach redis in time with a 503, so
+    clients back off and retry instead of seeing a server error
+    """
+    logger.error('Unable to reach redis: {e}'.format(e=ex))
+    resp.status = falcon.HTTP_SERVICE_UNAVAILABLE
+    resp.set_header('Retry-After', str(PoolTaskResource.RETRY_AFTER))
+    resp.media = {'title': 'The job store is unavailable'}
+
+
 class TestingEndpoint(object):
     def __init__(self):
         self._logger = logging.getLogger('gunicorn.error')
@@ -70,7 +274,16 @@ def add_api_routes(app: falcon.API, runner: JobRunner):
     logger.info('Adding routes to api')
 
     app.add_route('/submit', SubmitJobResource(runner))
+    app.add_route('/submit/batch', SubmitJobBatchResource(runner))
     app.add_route('/status/{job_id}', JobStatusResource(runner))
+    app.add_route('/status/{job_id}/watch',
+                  JobWatchResource(runner, max_watchers=int(os.environ.get('SWARMER_MAX_WATCHERS', '8'))))
     app.add_route('/result/{job_id}', ClientCallbackResource(runner))
+    app.add_route('/result/{job_id}/batch', ClientBatchCallbackResource(runner))
+    app.add_route('/pool/{pool_id}/task', PoolTaskResource(runner))
+    app.add_route('/output/{job_id}/{task_name}/{stream}', TaskOutputResource(runner))
+    app.add_route('/health', HealthResource(runner))
     app.add_route('/test', TestingEndpoint())
+    app.add_error_handler(RedisConnectionError, handle_store_unavailable)
+    app.add_error_handler(RedisTimeoutError, handle_store_unavailable)
     logger.info('All routes added')
@@ -1,3 +1,55 @@
+task_resources_schema = {
+    'type': 'object',
+    'properties': {
+        'cpu_reservation': {
+            'type': 'number',
+            'minimum': 0
+        },
+        'cpu_limit': {
+            'type': 'number',
+            'minimum': 0
+        },
+        'mem_reservation': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'mem_limit': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'generic_resources': {
+            'type': 'object',
+            'additionalProperties': {
+                'type': 'integer'
+            }
+        }
+    }
+}
+
+task_schema = {
+    'type': 'object',
+    'required': ['task_name', 'task_args'],
+    'properties': {
+        'task_name': {
+            'type': 'string'
+        },
+        'task_args': {
+            'type': 'array',
+            'items': {
+                'type': 'string'
+            },
+            'minItems': 0
+        },
+        'resources': task_resources_schema,
+        'constraints': {
+            'type': 'array',
+            'items': {
+                'type': 'string'
+            }
+        }
+    }
+}
+
 job_submit_schema = {
     'type': 'object',
     'required': ['image_name', 'callback_url', 'tasks'],
@@ -8,24 +60,32 @@ job_submit_schema = {
         'callback_url': {
             'type': 'string'
         },
+        'priority': {
+            'type': 'integer',
+            'minimum': 1
+        },
+        'tenant': {
+            'type': 'string'
+        },
+        'batch_size': {
+            'type': 'integer',
+            'minimum': 1
+        },
         'tasks': {
             'type': 'array',
-            'items': {
-                'type': 'object',
-                'required': ['task_name', 'task_args'],
-                'properties': {
-                    'task_name': {
-                        'type': 'string'
-                    },
-                    'task_args': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'string'
-                        },
-                        'minItems': 0
-                    }
-                }
-            },
+            'items': task_schema,
+            'minItems': 1
+        }
+    }
+}
+
+job_batch_submit_schema = {
+    'type': 'object',
+    'required': ['jobs'],
+    'properties': {
+        'jobs': {
+            'type': 'array',
+            'items': job_submit_schema,
             'minItems': 1
         }
     }
@@ -37,22 +97,7 @@ task_submit_schema = {
     'properties': {
         'tasks': {
             'type': 'array',
-            'items': {
-                'type': 'object',
-                'required': ['task_name', 'task_args'],
-                'properties': {
-                    'task_name': {
-                        'type': 'string'
-                    },
-                    'task_args': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'string'
-                        },
-                        'minItems': 0
-                    }
-                }
-            },
+            'items': task_schema,
             'minItems': 1
         }
     }
@@ -73,20 +118,34 @@ callback_result_schema = {
             'required': ['stdout', 'stderr'],
             'properties': {
                 'stdout': {
-                    'type': 'string'
+                    'type': ['string', 'null']
                 },
                 'stderr': {
-                    'type': 'string'
+                    'type': ['string', 'null']
                 }
             }
         }
     }
 }
 
+batch_result_schema = {
+    'type': 'object',
+    'required': ['results'],
+    'properties': {
+        'results': {
+            'type': 'array',
+            'items': callback_result_schema,
+            'minItems': 1
+        }
+    }
+}
+
 schema_dict = {
     'job_submit': job_submit_schema,
+    'job_batch_submit': job_batch_submit_schema,
     'task_submit': task_submit_schema,
-    'result_submit': callback_result_schema
+    'result_submit': callback_result_schema,
+    'batch_result_submit': batch_result_schema
 }
 
 
@@ -22,6 +22,11 @@ class Authenticator(metaclass=ABCMeta):
     obtain_auth()
         Calls the relevant libraries to get a user, password, and registry
         combination suitable for passing to the login() method of the DockerClient
+
+    expires_at(last_auth)
+        Returns when the credentials obtained at last_auth stop working, so they
+        can be renewed ahead of time. Returns None for credentials that do not
+        expire, which is the default.
     """
 
     @abstractmethod
@@ -42,3 +47,13 @@ class Authenticator(metaclass=ABCMeta):
         and registry details to login to the registry
         """
         raise NotImplementedError
+
+    def expires_at(self, last_auth: datetime) -> datetime:
+        """ Ask when the credentials obtained at last_auth expire
+
+        Parameters
+        ----------
+        last_auth : datetime
+            The last time this authenticator was used to login to a registry
+        """
+        return None
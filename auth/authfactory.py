@@ -1,4 +1,6 @@
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from threading import Lock, Thread
 
 from docker import DockerClient
 from pkg_resources import iter_entry_points, DistributionNotFound
@@ -11,10 +13,24 @@ class AuthenticationFactory:
     PROVIDER_KEY = 'provider'
     LAST_LOGIN_KEY = 'last_login'
 
-    def __init__(self):
+    # Seconds between asking the providers whether they need to login again
+    LOGIN_CHECK_INTERVAL = 60
+
+    # The background refresher renews credentials this long before they expire
+    REFRESH_MARGIN = timedelta(minutes=15)
+
+    # The longest the background refresher sleeps, and how long it waits after a failed login
+    REFRESH_INTERVAL = 300
+    RETRY_DELAY = 30
+
+    def __init__(self, check_interval=None):
         self._providers = dict()
         self._logger = LogManager(__name__)
-        self._setup_providers()        
+        self._check_interval = self.LOGIN_CHECK_INTERVAL if check_interval is None else check_interval
+        self._next_check = None
+        self._login_lock = Lock()
+        self._refreshing = False
+        self._setup_providers()
 
     @property
     def has_providers(self) -> bool:
@@ -25,6 +41,63 @@ class AuthenticationFactory:
         return False if not self.has_providers else any(
             [p for p in self._providers.values() if p[self.PROVIDER_KEY].should_authenticate(p[self.LAST_LOGIN_KEY])])
 
+    def ensure_logins(self, client: DockerClient):
+        """ Login to the registries that need it, the providers are only asked
+        once every check interval no matter how often this is called
+        """
+        if self._refreshing:
+            return
+
+        with self._login_lock:
+            now = time.monotonic()
+            if self._next_check is not None and now < self._next_check:
+                return
+
+            if self.any_require_login:
+                self.perform_logins(client)
+            # Only set once the logins went through, so a failed login is retried right away
+            self._next_check = now + self._check_interval
+
+    def start_refresher(self, client: DockerClient, thread_builder=Thread):
+        """ Login right away and then keep renewing the logins of the client on
+        a background thread, ahead of their expiry. Once started, creating
+        services never waits on a registry login.
+        """
+        if not self.has_providers:
+            return
+
+        try:
+            delay = self.refresh_logins(client)
+        except Exception as ex:
+            self._logger.error('Unable to login to the registries: {e}'.format(e=ex))
+            delay = self.RETRY_DELAY
+
+        self._refreshing = True
+        refresher = thread_builder(target=self._refresh_forever, args=(client, delay))
+        refresher.daemon = True
+        refresher.start()
+
+    def refresh_logins(self, client: DockerClient) -> float:
+        """ Login with every provider whose credentials are missing or about to
+        expire
+
+        :returns: The seconds until the next credentials need renewing
+        """
+        with self._login_lock:
+            next_refresh = datetime.now() + timedelta(seconds=self.REFRESH_INTERVAL)
+            for entry in self._providers.values():
+                provider = entry[self.PROVIDER_KEY]
+                expiry = self._expiry(entry)
+                if provider.should_authenticate(entry[self.LAST_LOGIN_KEY]) or (
+                        expiry is not None and expiry - self.REFRESH_MARGIN <= datetime.now()):
+                    self._login(client, entry)
+                    expiry = self._expiry(entry)
+                if expiry is not None:
+                    next_refresh = min(next_refresh, expiry - self.REFRESH_MARGIN)
+
+        # Credentials that live shorter than the margin are renewed every retry delay, not continuously
+        return max((next_refresh - datetime.now()).total_seconds(), self.RETRY_DELAY)
+
     def perform_logins(self, client: DockerClient):
         self._logger.info('Running logins for docker client')
 
@@ -35,9 +108,27 @@ class AuthenticationFactory:
         for entry in self._providers.values():
             provider = entry[self.PROVIDER_KEY]
             if provider.should_authenticate(entry[self.LAST_LOGIN_KEY]):
-                (user, password, registry) = provider.obtain_auth()
-                client.login(username=user, password=password, registry=registry)
-                entry['last_login'] = datetime.now()
+                self._login(client, entry)
+
+    def _login(self, client, entry):
+        (user, password, registry) = entry[self.PROVIDER_KEY].obtain_auth()
+        # The docker client keeps the first auth config it gets for a user unless told to replace it,
+        # which would leave it sending an expired token for registries that rotate passwords
+        client.login(username=user, password=password, registry=registry, reauth=True)
+        entry[self.LAST_LOGIN_KEY] = datetime.now()
+
+    def _expiry(self, entry):
+        last_login = entry[self.LAST_LOGIN_KEY]
+        return None if last_login is None else entry[self.PROVIDER_KEY].expires_at(last_login)
+
+    def _refresh_forever(self, client, delay):
+        while True:
+            time.sleep(delay)
+            try:
+                delay = self.refresh_logins(client)
+            except Exception as ex:
+                self._logger.error('Unable to renew the registry logins: {e}'.format(e=ex))
+                delay = self.RETRY_DELAY
 
     def _setup_providers(self):
         for entry_point in iter_entry_points(self.EXTRAS_KEY):
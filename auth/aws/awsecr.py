@@ -34,11 +34,20 @@ class AwsAuthenticator(Authenticator):
         delta = current - last_auth
         return delta > self.AUTH_EXPIRY_DELTA
 
+    def expires_at(self, last_auth: datetime) -> datetime:
+        if self.LAST_TOKEN_EXPIRY is not None:
+            return self.LAST_TOKEN_EXPIRY
+        return last_auth + self.AUTH_EXPIRY_DELTA
+
     def obtain_auth(self) -> (str, str, str):
         response = self.client.get_authorization_token()
         auth_data = response[self.AUTH_RESPONSE_DATA_KEY][0]
         token_raw = auth_data[self.AUTH_DATA_TOKEN_KEY]
-        self.LAST_TOKEN_EXPIRY = auth_data[self.AUTH_DATA_EXPIRES_KEY]
+        expiry = auth_data[self.AUTH_DATA_EXPIRES_KEY]
+        # boto3 hands back an aware datetime, everything else here uses naive local time
+        if expiry.tzinfo is not None:
+            expiry = expiry.astimezone().replace(tzinfo=None)
+        self.LAST_TOKEN_EXPIRY = expiry
         proxy_endpiont = auth_data[self.AUTH_DATA_PROXY_KEY]
         token_clear = b64decode(token_raw).decode()
         credentials = token_clear.split(':')
@@ -35,6 +35,11 @@ class BasicAuthenticator(Authenticator):
         # If we need to renew only do it if we're beyond the interval
         return self._must_renew and (last_auth is None or datetime.now() - last_auth > self._renew_interval)
 
+    def expires_at(self, last_auth: datetime) -> datetime:
+        if not self._has_authentication or not self._must_renew:
+            return None
+        return last_auth + self._renew_interval
+
     def obtain_auth(self) -> (str, str, str):
         if not self._has_authentication:
             raise CredentialsNotPresentError()
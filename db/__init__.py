@@ -1 +1,4 @@
 from .job_db import JobDb
+from .queue_db import QueueDb
+from .pool_db import PoolDb
+from .connection import RedisConfig
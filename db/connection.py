@@ -0,0 +1,83 @@
+import os
+
+import redis
+from redis.sentinel import Sentinel
+
+
+class RedisConfig:
+    """ The RedisConfig holds the settings for the redis client shared by
+    every part of swarmer. All connections come from one bounded pool, reads
+    and connects give up after a timeout instead of hanging the API threads,
+    and a timed out command is retried once on a fresh connection.
+
+    Redis is reached through one of, in order of preference, a list of
+    sentinels that track the current master, a unix socket, or a host and port.
+    """
+
+    def __init__(self, host=None, port=6379, socket_path=None, sentinels=None, sentinel_service='mymaster',
+                 max_connections=50, socket_timeout=5.0, connect_timeout=2.0, keepalive=True,
+                 retry_on_timeout=True):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.sentinels = sentinels or []
+        self.sentinel_service = sentinel_service
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.retry_on_timeout = retry_on_timeout
+
+    @classmethod
+    def from_environ(cls):
+        """ Create a new RedisConfig from REDIS_TARGET and REDIS_PORT, or
+        REDIS_SOCKET_PATH, or REDIS_SENTINELS and REDIS_SENTINEL_SERVICE, along
+        with the optional REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT,
+        REDIS_CONNECT_TIMEOUT, REDIS_KEEPALIVE and REDIS_RETRY_ON_TIMEOUT
+        """
+        sentinels = [_parse_address(a) for a in os.environ.get('REDIS_SENTINELS', '').split(',') if a.strip()]
+        return cls(host=os.environ.get('REDIS_TARGET'),
+                   port=int(os.environ.get('REDIS_PORT', '6379')),
+                   socket_path=os.environ.get('REDIS_SOCKET_PATH'),
+                   sentinels=sentinels,
+                   sentinel_service=os.environ.get('REDIS_SENTINEL_SERVICE', 'mymaster'),
+                   max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', '50')),
+                   socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', '5')),
+                   connect_timeout=float(os.environ.get('REDIS_CONNECT_TIMEOUT', '2')),
+                   keepalive=_is_true(os.environ.get('REDIS_KEEPALIVE', 'true')),
+                   retry_on_timeout=_is_true(os.environ.get('REDIS_RETRY_ON_TIMEOUT', 'true')))
+
+    def create_client(self) -> redis.StrictRedis:
+        """ Create a redis client backed by a connection pool with these settings """
+        options = {
+            'max_connections': self.max_connections,
+            'socket_timeout': self.socket_timeout,
+            'retry_on_timeout': self.retry_on_timeout
+        }
+
+        if self.socket_path and not self.sentinels:
+            # Connect timeouts and keep alive are TCP options, unix sockets don't take them
+            pool = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection, path=self.socket_path,
+                                        **options)
+            return redis.StrictRedis(connection_pool=pool)
+
+        options.update(socket_connect_timeout=self.connect_timeout, socket_keepalive=self.keepalive)
+        if self.sentinels:
+            sentinel = Sentinel(self.sentinels, socket_timeout=self.socket_timeout,
+                                socket_connect_timeout=self.connect_timeout)
+            return sentinel.master_for(self.sentinel_service, redis_class=redis.StrictRedis, **options)
+
+        if not self.host:
+            raise ValueError('One of REDIS_TARGET, REDIS_SOCKET_PATH or REDIS_SENTINELS must be set')
+
+        pool = redis.ConnectionPool(host=self.host, port=self.port, **options)
+        return redis.StrictRedis(connection_pool=pool)
+
+
+def _parse_address(address):
+    host, _, port = address.strip().partition(':')
+    return host, int(port or '26379')
+
+
+def _is_true(value):
+    return value.lower() in ['yes', 'y', 'true', 't', '1']
@@ -1,17 +1,208 @@
 import json
+import os
+import time
+import uuid
+import zlib
 
 import redis
 
 from log import LogManager
 
+# Writes ARGV[5..n] into the column hashes KEYS[5..n] for the task named ARGV[1],
+# but only if that task exists in the args hash KEYS[2], and when ARGV[4] is '1' only
+# if the task has not completed yet, returning -1 otherwise. Running this as a script
+# makes every task update a single atomic round trip. Columns created here take
+# on the expiry of the args hash, so they go away along with the rest of the job.
+#
+# The task counters in the job hash KEYS[1] follow along. A task has started once it
+# has a service id in KEYS[4] or has left the pending status ARGV[2] in KEYS[3], and
+# has completed once it left the pending status. Each task is only counted once no
+# matter how often it is updated, and the job is stamped with the time ARGV[3] when
+# its last task completes, in which case 2 is returned.
+SET_TASK_FIELDS_SCRIPT = """
+local name, pending, only_pending = ARGV[1], ARGV[2], ARGV[4]
+if redis.call('hexists', KEYS[2], name) == 0 then
+    return 0
+end
+local function state()
+    local status = redis.call('hget', KEYS[3], name)
+    local complete = status ~= false and status ~= pending
+    return complete, complete or redis.call('hexists', KEYS[4], name) == 1, status
+end
+local was_complete, was_started = state()
+if only_pending == '1' and was_complete then
+    return -1
+end
+local ttl = redis.call('pttl', KEYS[2])
+for i = 5, #KEYS do
+    redis.call('hset', KEYS[i], name, ARGV[i])
+    if ttl > 0 and redis.call('pttl', KEYS[i]) < 0 then
+        redis.call('pexpire', KEYS[i], ttl)
+    end
+end
+local complete, started, status = state()
+if started and not was_started then
+    redis.call('hincrby', KEYS[1], '__task_count_started', 1)
+end
+if complete and not was_complete then
+    if status ~= '0' then
+        redis.call('hincrby', KEYS[1], '__task_count_failed', 1)
+    end
+    local done = redis.call('hincrby', KEYS[1], '__task_count_complete', 1)
+    local total = redis.call('hget', KEYS[1], '__task_count_total')
+    if total and done >= tonumber(total) then
+        redis.call('hset', KEYS[1], '__finished_at', ARGV[3])
+        return 2
+    end
+end
+return 1
+"""
+
+# Appends ARGV[2] to the output key KEYS[3] of the task named ARGV[1], but only if that
+# task exists in the args hash KEYS[1], and records the output under ARGV[3] in the set
+# KEYS[2]. The output takes on the expiry of the args hash like the other columns.
+APPEND_OUTPUT_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+local size = redis.call('append', KEYS[3], ARGV[2])
+redis.call('sadd', KEYS[2], ARGV[3])
+local ttl = redis.call('pttl', KEYS[1])
+if ttl > 0 then
+    redis.call('pexpire', KEYS[2], ttl)
+    redis.call('pexpire', KEYS[3], ttl)
+end
+return size
+"""
+
 
 class JobDb:
     """ The JobDb is responsible for handling the redis job tracking
+
+    A job is stored as a hash of its metadata under the job identifier. The
+    tasks are split out into one hash per column (args, status, result and
+    service id), each keyed by task name, plus a list holding the task names
+    in submission order. Reading or updating a single task therefore only
+    touches that task's fields, no matter how many tasks the job has.
+
+    Results larger than the compression threshold are stored zlib compressed,
+    behind a prefix that JSON text can never start with, and are decompressed
+    transparently when read.
+
+    Task output larger than the inline limit is kept out of the result column,
+    in a key of its own per task and stream, and the result only carries a
+    reference to it. Tasks can also upload their output there directly.
+
+    Each change to the tasks of a job increments a version in the job hash
+    and publishes the new version on a channel of the job, so clients can
+    wait for a job to change instead of polling it.
+
+    Every key of a job expires job_ttl seconds after the job is added or its
+    last task completed, so jobs that are never cleared don't stay in redis
+    forever. Clearing a job only shortens the expiry to the retention window,
+    which keeps its status readable for a while after its results were sent.
     """
 
-    def __init__(self, rd: redis.StrictRedis):
+    # Each column lives in its own hash under '<identifier>:<column>'
+    ARGS_COLUMN = 'args'
+    STATUS_COLUMN = 'status'
+    RESULT_COLUMN = 'result'
+    TASK_ID_COLUMN = 'task_id'
+    TASK_COLUMNS = (ARGS_COLUMN, STATUS_COLUMN, RESULT_COLUMN, TASK_ID_COLUMN)
+
+    # The list of task names, in the order they were submitted
+    NAMES_KEY = 'names'
+
+    # The resources and constraints of the tasks that have any, kept so the job can be recovered
+    SPEC_KEY = 'spec'
+
+    # The set of '<task name>:<stream>' outputs stored apart from the results
+    OUTPUTS_KEY = 'outputs'
+
+    # The streams a task can store output for
+    OUTPUT_STREAMS = ('stdout', 'stderr')
+
+    # Output over the inline limit is staged in a key of its own for this many seconds
+    # at most, it only replaces the stored output once its result has been written
+    STAGED_OUTPUT_TTL = 600
+
+    # The field of the job hash counting the changes to its tasks
+    VERSION_FIELD = '__version'
+
+    # The name of the changed task is published on '<prefix><identifier>', or nothing when the job is cleared
+    CHANGES_CHANNEL = 'swarmer:changes:'
+
+    # Fields of the job hash counting its tasks by state, kept up to date by SET_TASK_FIELDS_SCRIPT
+    TASK_COUNT_TOTAL = '__task_count_total'
+    TASK_COUNT_STARTED = '__task_count_started'
+    TASK_COUNT_COMPLETE = '__task_count_complete'
+    TASK_COUNT_FAILED = '__task_count_failed'
+    TASK_COUNTS = (TASK_COUNT_TOTAL, TASK_COUNT_STARTED, TASK_COUNT_COMPLETE, TASK_COUNT_FAILED)
+
+    # The field of the job hash holding the time its last task completed
+    FINISHED_AT_FIELD = '__finished_at'
+
+    # The key each task column is returned under in the task details
+    TASK_FIELDS = {ARGS_COLUMN: 'args', STATUS_COLUMN: 'status', RESULT_COLUMN: 'result', TASK_ID_COLUMN: '__task_id'}
+
+    # Marks a stored value as zlib compressed JSON
+    COMPRESSED_PREFIX = b'zlib:'
+
+    # The identifiers of the jobs that have not been cleared yet
+    ACTIVE_JOBS_KEY = 'swarmer:active_jobs'
+
+    # The most keys checked in one round trip when sweeping
+    SWEEP_BATCH = 500
+
+    # Older versions stored every task of a job in this field as one JSON list
+    LEGACY_TASKS_FIELD = 'tasks'
+
+    # Job identifiers are ULIDs, so only keys of their length can be jobs
+    JOB_KEY_PATTERN = '?' * 26
+
+    # The status a task has until its results are reported
+    PENDING_STATUS = 500
+
+    # Job results that could not be delivered to their callback
+    DEAD_LETTERS_KEY = 'swarmer:dead_letters'
+
+    def __init__(self, rd: redis.StrictRedis, job_ttl=None, retention=None, inline_limit=None,
+                 compress_threshold=None, dead_letter_limit=1000):
         self._redis = rd
+        self._dead_letter_limit = dead_letter_limit
+        self._job_ttl = job_ttl
+        self._retention = retention
+        self._inline_limit = inline_limit
+        self._compress_threshold = compress_threshold
         self._logger = LogManager(__name__)
+        self._set_task_fields = rd.register_script(SET_TASK_FIELDS_SCRIPT)
+        self._append_output = rd.register_script(APPEND_OUTPUT_SCRIPT)
+
+    @classmethod
+    def from_environ(cls, rd: redis.StrictRedis):
+        """ Create a new JobDb configured by the optional environment variables
+        SWARMER_JOB_TTL and SWARMER_JOB_RETENTION, in seconds, and
+        SWARMER_OUTPUT_INLINE_LIMIT and SWARMER_COMPRESS_THRESHOLD, in bytes,
+        where 0 turns any of them off, and SWARMER_DEAD_LETTER_LIMIT, the
+        number of dead letters to keep
+        """
+        return cls(rd,
+                   job_ttl=int(os.environ.get('SWARMER_JOB_TTL', '604800')) or None,
+                   retention=int(os.environ.get('SWARMER_JOB_RETENTION', '3600')) or None,
+                   inline_limit=int(os.environ.get('SWARMER_OUTPUT_INLINE_LIMIT', '65536')) or None,
+                   compress_threshold=int(os.environ.get('SWARMER_COMPRESS_THRESHOLD', '1024')) or None,
+                   dead_letter_limit=max(1, int(os.environ.get('SWARMER_DEAD_LETTER_LIMIT', '1000'))))
+
+    def ping(self) -> bool:
+        """ Check whether redis can be reached
+
+        :returns: True if redis answered
+        """
+        try:
+            return bool(self._redis.ping())
+        except redis.RedisError as ex:
+            self._logger.error('JobDb: Unable to reach redis: {e}'.format(e=ex))
+            return False
 
     def add_job(self, identifier: str, image_name: str, callback: str):
         """ Add a new job to the tracking database
@@ -22,8 +213,11 @@ class JobDb:
         """
         self._log_operation('Adding new job {i}'.format(i=identifier))
 
-        initial_state = {'__image': image_name, '__callback': callback, 'tasks': []}
+        initial_state = {'__image': image_name, '__callback': callback}
         self._redis.hmset(identifier, initial_state)
+        self._redis.sadd(self.ACTIVE_JOBS_KEY, identifier)
+        if self._job_ttl:
+            self._redis.expire(identifier, self._job_ttl)
 
     def add_job_with_tasks(self, identifier: str, image_name: str, callback: str, tasks: list):
         self.add_job(identifier, image_name, callback)
@@ -42,11 +236,25 @@ class JobDb:
             raise ValueError(
                 'Can not find item with identifier: {id}'.format(id=identifier))
 
-        task_dict = {'tasks': json.dumps([{
-            'args': t['task_args'], 'status': 500, 'result': {'stdout': None, 'stderr': None}, 'name': t['task_name']}
-            for t in tasks])}
+        pipe = self._redis.pipeline()
+        self._write_tasks(pipe, identifier, self._new_tasks(tasks))
+        self._expire_job(pipe, identifier, self._job_ttl)
+        pipe.execute()
+
+    def add_jobs(self, jobs: list):
+        """ Add several jobs along with their tasks in one pipelined write
 
-        self._redis.hmset(identifier, task_dict)
+        :param jobs: A list of JobEntry items
+        """
+        self._log_operation('Adding {n} new jobs'.format(n=len(jobs)))
+
+        pipe = self._redis.pipeline()
+        for job in jobs:
+            pipe.hmset(job.identifier, {'__image': job.image, '__callback': job.callback})
+            pipe.sadd(self.ACTIVE_JOBS_KEY, job.identifier)
+            self._write_tasks(pipe, job.identifier, self._new_tasks(job.tasks))
+            self._expire_job(pipe, job.identifier, self._job_ttl)
+        pipe.execute()
 
     def update_status(self, identifier: str, task_name: str, status: int):
         """ Update the status of a run
@@ -58,11 +266,7 @@ class JobDb:
         self._log_operation(
             'Updating status of task {tn} for job {i} with {s}'.format(tn=task_name, i=identifier, s=status))
 
-        task = self._get_task(identifier, task_name)
-        task['status'] = status
-        task_list = self._get_task_list(identifier)
-        update = [task if t['name'] == task['name'] else t for t in task_list]
-        self._redis.hset(identifier, 'tasks', json.dumps(update))
+        self._write_task_fields(identifier, task_name, {self.STATUS_COLUMN: status})
 
     def update_result(self, identifier: str, task_name: str, result: dict):
         """ Update the result of a task run
@@ -71,32 +275,113 @@ class JobDb:
         :param task_name: The individual task name
         :param result: A dict with the stdout and stderr output, if any was present
         """
-        self._log_operation('Updating result of task {tn} for job {i} with {res}'.format(tn=task_name, i=identifier,
-                                                                                         res=json.dumps(result)))
-        task = self._get_task(identifier, task_name)
-        task['result'] = result
-        task_list = self._get_task_list(identifier)
-        update = [task if t['name'] == task['name'] else t for t in task_list]
-        self._redis.hset(identifier, 'tasks', json.dumps(update))
+        self._log_operation('Updating result of task {tn} for job {i}'.format(tn=task_name, i=identifier))
+        result, staged = self._stage_large_outputs(identifier, task_name, result)
+        self._write_task_fields(identifier, task_name, {self.RESULT_COLUMN: result}, staged=staged)
 
-    def get_job(self, identifier: str):
+    def complete_task(self, identifier: str, task_name: str, status: int, result: dict) -> bool:
+        """ Record the exit status and result of a task run in a single atomic
+        operation, but only while the task is still pending, so duplicate or
+        late callbacks can not overwrite the results of a completed task
+
+        :param identifier: The unique job identifier
+        :param task_name: The individual task name
+        :param status: The exit status of the task
+        :param result: A dict with the stdout and stderr output, if any was present
+        :returns: False if the task had already completed and nothing was written
+        """
+        self._log_operation('Completing task {tn} for job {i} with status {s}'.format(tn=task_name, i=identifier,
+                                                                                     s=status))
+        result, staged = self._stage_large_outputs(identifier, task_name, result)
+        return self._write_task_fields(identifier, task_name, {self.STATUS_COLUMN: status, self.RESULT_COLUMN: result},
+                                       completing=True, staged=staged)
+
+    def get_job(self, identifier: str, fields=None):
         """ Retrieve the tracking dict for the given job
 
         :param identifier: The unique job identifier
+        :param fields: The names of the task fields to return, all of them
+                       when None. Only the columns holding them are read.
+
+        :returns: The job metadata, with the list of all tasks under 'tasks'
         """
         self._log_operation('Getting job {i}'.format(i=identifier))
         if not self._redis.exists(identifier):
             raise ValueError(
                 'Can not find job with id: {id}'.format(id=identifier))
-        job = self._redis.hgetall(identifier)
 
-        def check_and_decode(value):
-            try:
-                return value.decode('utf-8')
-            except (ValueError, AttributeError):
-                return value
+        pipe = self._redis.pipeline()
+        pipe.hgetall(identifier)
+        columns = self._read_tasks(pipe, identifier, fields)
+        job, *results = pipe.execute()
+
+        details = {_decode(k): _decode(v) for k, v in job.items()}
+        if self.LEGACY_TASKS_FIELD in details:
+            self._migrate_legacy_job(identifier)
+            return self.get_job(identifier, fields)
+
+        for field in (self.VERSION_FIELD,) + self.TASK_COUNTS:
+            if field in details:
+                details[field] = int(details[field])
+        if self.FINISHED_AT_FIELD in details:
+            details[self.FINISHED_AT_FIELD] = float(details[self.FINISHED_AT_FIELD])
 
-        return {check_and_decode(k): check_and_decode(v) for k, v in job.items()}
+        tasks = self._build_tasks(columns, results, identifier)
+        if fields is not None:
+            tasks = [{k: v for k, v in t.items() if k in fields} for t in tasks]
+        details['tasks'] = tasks
+        return details
+
+    def get_summary(self, identifier: str) -> dict:
+        """ Count the tasks of a job by state, from the counters in the job
+        hash rather than from the tasks themselves
+
+        :param identifier: The unique job identifier
+        :returns: A dict with the image and version of the job, the time its
+                  last task completed if it has, and the total, pending,
+                  running, complete and failed task counts under 'counts'
+        """
+        self._log_operation('Getting summary of job {i}'.format(i=identifier))
+        image, version, finished_at, *counts = self._redis.hmget(
+            identifier, '__image', self.VERSION_FIELD, self.FINISHED_AT_FIELD, *self.TASK_COUNTS)
+        if image is None:
+            raise ValueError('Can not find job with id: {id}'.format(id=identifier))
+
+        if counts[0] is None:
+            # Jobs stored before the counters were kept are counted from their tasks
+            if self._migrate_legacy_job(identifier):
+                return self.get_summary(identifier)
+            counts = self._count_tasks(identifier)
+        total, started, complete, failed = [int(c or 0) for c in counts]
+
+        return {
+            '__image': _decode(image),
+            self.VERSION_FIELD: int(version or 0),
+            self.FINISHED_AT_FIELD: None if finished_at is None else float(finished_at),
+            'counts': {'total': total, 'pending': total - started, 'running': started - complete,
+                       'complete': complete, 'failed': failed}
+        }
+
+    def get_task_count(self, identifier: str, count: str) -> int:
+        """ Get one of the task counters of a job
+
+        :param identifier: The unique job identifier
+        :param count: One of the TASK_COUNTS fields
+        """
+        return int(self._redis.hget(identifier, count) or 0)
+
+    def modify_task_count(self, identifier: str, count: str, increment: int) -> int:
+        """ Adjust one of the task counters of a job, for corrections the task
+        updates don't cover
+
+        :param identifier: The unique job identifier
+        :param count: One of the TASK_COUNTS fields
+        :param increment: The amount to add, negative to subtract
+        :returns: The new value of the counter
+        """
+        if count not in self.TASK_COUNTS:
+            raise ValueError('Unknown task count {c}'.format(c=count))
+        return self._redis.hincrby(identifier, count, increment)
 
     def get_task(self, identifier: str, task_name: str):
         """ Retrieve the status for an individual run in a job
@@ -119,6 +404,76 @@ class JobDb:
 
         return self._get_task_list(identifier)
 
+    def get_version(self, identifier: str) -> int:
+        """ Get the number of times the tasks of a job have changed, without
+        reading the job itself
+
+        :param identifier: The unique job identifier
+        :returns: The version of the job, 0 if it never changed or does not exist
+        """
+        return int(self._redis.hget(identifier, self.VERSION_FIELD) or 0)
+
+    def listen_for_changes(self, poll_timeout=1.0):
+        """ Follow the changes published for every job. This holds a
+        connection of its own for as long as it is iterated, and only ends when
+        the connection fails.
+
+        :param poll_timeout: The seconds to wait for a message at a time, kept
+                             below the socket timeout of the connection
+        :returns: A generator of (identifier, task name) tuples, the name is
+                  empty when the job was cleared
+        """
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.CHANGES_CHANNEL + '*')
+        try:
+            while True:
+                message = pubsub.get_message(timeout=poll_timeout)
+                if message is not None and message['type'] == 'pmessage':
+                    yield _decode(message['channel'])[len(self.CHANGES_CHANNEL):], _decode(message['data'])
+        finally:
+            pubsub.close()
+
+    def append_output(self, identifier: str, task_name: str, stream: str, data: bytes) -> int:
+        """ Append to the output of a task stream, kept apart from its result
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the individual task
+        :param stream: Either stdout or stderr
+        :param data: The output to append
+        :returns: The size of the stored output after appending
+        """
+        if stream not in self.OUTPUT_STREAMS:
+            raise ValueError('Unknown output stream {s}'.format(s=stream))
+
+        size = self._append_output(keys=[_column_key(identifier, self.ARGS_COLUMN),
+                                         _column_key(identifier, self.OUTPUTS_KEY),
+                                         _output_key(identifier, task_name, stream)],
+                                   args=[task_name, data, _output_name(task_name, stream)])
+        if size < 0:
+            raise ValueError('Unable to locate task {name} in job {id}'.format(name=task_name, id=identifier))
+        return size
+
+    def read_output(self, identifier: str, task_name: str, stream: str, chunk_size=65536):
+        """ Read the stored output of a task stream in chunks
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the individual task
+        :param stream: Either stdout or stderr
+        :param chunk_size: The most bytes to read from redis at once
+        :returns: A generator of the output, chunk by chunk
+        """
+        key = _output_key(identifier, task_name, stream)
+        size = self._redis.strlen(key)
+        if not size:
+            raise ValueError('Unable to find {s} output of task {name} in job {id}'.format(s=stream, name=task_name,
+                                                                                          id=identifier))
+
+        def chunks():
+            for start in range(0, size, chunk_size):
+                yield self._redis.getrange(key, start, min(start + chunk_size, size) - 1)
+
+        return chunks()
+
     def set_task_id(self, identifier: str, task_name: str, task_id: str):
         """ Set the docker service identifier for the task
 
@@ -129,14 +484,11 @@ class JobDb:
         self._log_operation(
             'Setting task id {ti} for task {tn} for job {i}'.format(ti=task_id, tn=task_name, i=identifier))
 
-        task = self._get_task(identifier, task_name)
-        task['__task_id'] = task_id
-        task_list = self._get_task_list(identifier)
-        update = [task if t['name'] == task['name'] else t for t in task_list]
-        self._redis.hset(identifier, 'tasks', json.dumps(update))
+        self._write_task_fields(identifier, task_name, {self.TASK_ID_COLUMN: task_id})
 
     def clear_job(self, identifier: str):
-        """ Remove an entire job from the tracking DB
+        """ Remove an entire job from the tracking DB, once the retention
+        window has passed if there is one
 
         :param identifier: The unique job identifier
         """
@@ -146,31 +498,455 @@ class JobDb:
             raise ValueError(
                 'Can not find job with id: {id}'.format(id=identifier))
 
-        self._redis.delete(identifier)
+        outputs = self._output_keys(identifier)
+        pipe = self._redis.pipeline()
+        # Announced along with the expiry, watchers then see the job's final state or that it is gone
+        self._publish_change(pipe, identifier)
+        pipe.srem(self.ACTIVE_JOBS_KEY, identifier)
+        if self._retention:
+            self._expire_job(pipe, identifier, self._retention)
+            for key in outputs:
+                pipe.expire(key, self._retention)
+        else:
+            pipe.delete(identifier, *self._job_keys(identifier), *outputs)
+        pipe.execute()
+
+    def get_active_jobs(self) -> list:
+        """ Get the identifiers of every job that has not been cleared, jobs
+        that expired in the meantime are dropped along the way
+
+        :returns: The identifiers of the active jobs
+        """
+        self._log_operation('Getting active jobs')
+
+        active, _ = self._prune_active_jobs()
+        return sorted(active)
+
+    def get_task_specs(self, identifier: str) -> dict:
+        """ Get the resources and constraints the tasks of a job were submitted with
+
+        :param identifier: The unique job identifier
+        :returns: A dict of task name to a dict with 'resources' and 'constraints',
+                  for the tasks that have either
+        """
+        specs = self._redis.hgetall(_column_key(identifier, self.SPEC_KEY))
+        return {_decode(k): json.loads(v) for k, v in specs.items()}
+
+    def sweep_keys(self) -> int:
+        """ Find the job keys that would otherwise stay in redis forever. Jobs
+        without an expiry, for example ones added before the job TTL was set,
+        are given one, task columns left behind by a job that is gone are
+        removed, and so are active jobs that expired. Only the keys of task
+        columns are scanned for, and they are checked in pipelined batches.
+
+        :returns: The number of jobs and columns that were swept
+        """
+        self._log_operation('Sweeping for orphaned job keys')
+
+        columns = self.TASK_COLUMNS + (self.NAMES_KEY, self.SPEC_KEY, self.OUTPUTS_KEY)
+        swept = 0
+        for batch in _batches(self._redis.scan_iter(match='*:*', count=self.SWEEP_BATCH), self.SWEEP_BATCH):
+            keys = []
+            for key in batch:
+                identifier, _, column = _decode(key).partition(':')
+                if column in columns or column.startswith('output:'):
+                    keys.append((key, identifier, column))
+            swept += self._sweep_columns(keys)
+
+        _, expired = self._prune_active_jobs()
+        swept += len(expired)
+
+        self._log_operation('Swept {n} orphaned job keys'.format(n=swept))
+        return swept
+
+    def add_dead_letter(self, identifier: str, callback, error: str):
+        """ Record a job whose results could not be delivered. Only the most
+        recent dead_letter_limit are kept, and the results themselves stay with
+        the job, which is kept for the job_ttl from now so they can be fetched,
+        but is no longer active.
+
+        :param identifier: The unique job identifier
+        :param callback: The URL the results were to be posted to, if known
+        :param error: A description of the last delivery failure
+        """
+        self._log_operation('Storing dead letter for job {i} with callback {cb}'.format(i=identifier, cb=callback))
+
+        outputs = self._output_keys(identifier) if self._job_ttl else []
+        pipe = self._redis.pipeline()
+        pipe.lpush(self.DEAD_LETTERS_KEY, json.dumps({'id': identifier, 'callback': callback, 'error': error,
+                                                      'failed': time.time()}))
+        pipe.ltrim(self.DEAD_LETTERS_KEY, 0, self._dead_letter_limit - 1)
+        pipe.srem(self.ACTIVE_JOBS_KEY, identifier)
+        self._expire_job(pipe, identifier, self._job_ttl)
+        for key in outputs:
+            pipe.expire(key, self._job_ttl)
+        pipe.execute()
+
+    def get_dead_letters(self, count: int = 100) -> list:
+        """ Get the most recent job results that could not be delivered
+
+        :param count: The maximum number of dead letters to return
+        """
+        self._log_operation('Getting dead letters')
+
+        return [json.loads(d) for d in self._redis.lrange(self.DEAD_LETTERS_KEY, 0, count - 1)]
+
+    def migrate_legacy_jobs(self) -> int:
+        """ Convert every job still stored with a single 'tasks' JSON field
+        into the per-task layout. Jobs are also converted lazily the first time
+        they are accessed, so this only needs to run once after an upgrade, for
+        unfinished jobs to be recovered. Only keys of the length of a job
+        identifier are scanned for, and they are checked in pipelined batches.
+
+        :returns: The number of jobs that were migrated
+        """
+        self._log_operation('Scanning for jobs in the legacy storage layout')
+
+        migrated = 0
+        for batch in _batches(self._redis.scan_iter(match=self.JOB_KEY_PATTERN, count=self.SWEEP_BATCH),
+                              self.SWEEP_BATCH):
+            identifiers = [i for i in map(_decode, batch) if ':' not in i]
+            pipe = self._redis.pipeline(transaction=False)
+            for identifier in identifiers:
+                pipe.type(identifier)
+            hashes = [i for i, t in zip(identifiers, pipe.execute()) if t == b'hash']
+            if not hashes:
+                continue
+
+            pipe = self._redis.pipeline(transaction=False)
+            for identifier in hashes:
+                pipe.hexists(identifier, self.LEGACY_TASKS_FIELD)
+            for identifier, legacy in zip(hashes, pipe.execute()):
+                if legacy and self._migrate_legacy_job(identifier):
+                    migrated += 1
+
+        self._log_operation('Migrated {n} legacy jobs'.format(n=migrated))
+        return migrated
+
+    def _sweep_columns(self, keys):
+        """ Remove the task columns whose job is gone and give the jobs without
+        an expiry one, reading the expiry of all their jobs in one round trip
+
+        :param keys: The (key, job identifier, column) of each task column
+        :returns: The number of columns and jobs that were swept
+        """
+        if not keys:
+            return 0
+
+        pipe = self._redis.pipeline(transaction=False)
+        for _, identifier, _ in keys:
+            pipe.ttl(identifier)
+        ttls = pipe.execute()
+
+        # A TTL of -2 means the job is gone, and -1 that it never expires
+        orphans = [key for (key, _, _), ttl in zip(keys, ttls) if ttl == -2]
+        unexpiring = [identifier for (_, identifier, column), ttl in zip(keys, ttls)
+                      if self._job_ttl and ttl == -1 and column == self.ARGS_COLUMN]
+        if not orphans and not unexpiring:
+            return 0
+
+        pipe = self._redis.pipeline()
+        if orphans:
+            pipe.delete(*orphans)
+        for identifier in unexpiring:
+            self._expire_job(pipe, identifier, self._job_ttl)
+        pipe.execute()
+        return len(orphans) + len(unexpiring)
+
+    def _prune_active_jobs(self):
+        """ Drop the jobs that expired from the active jobs, checking them in
+        pipelined batches
+
+        :returns: The identifiers of the jobs that are still active, and of the ones that were dropped
+        """
+        active, expired = [], []
+        for batch in _batches(self._redis.sscan_iter(self.ACTIVE_JOBS_KEY, count=self.SWEEP_BATCH),
+                              self.SWEEP_BATCH):
+            identifiers = [_decode(m) for m in batch]
+            pipe = self._redis.pipeline(transaction=False)
+            for identifier in identifiers:
+                pipe.exists(identifier)
+            gone = []
+            for identifier, exists in zip(identifiers, pipe.execute()):
+                (active if exists else gone).append(identifier)
+            if gone:
+                self._redis.srem(self.ACTIVE_JOBS_KEY, *gone)
+            expired.extend(gone)
+        return active, expired
 
     def _get_task(self, identifier, name):
         self._log_operation('Retrieving task {t} for {i}'.format(t=name, i=identifier))
-        if not self._redis.hexists(identifier, 'tasks'):
-            raise ValueError(
-                'Unable to find job with identifier {id} that has any tasks'.format(id=identifier))
-        tasks = json.loads(self._redis.hget(identifier, 'tasks'))
 
-        if not any(t['name'] == name for t in tasks):
+        pipe = self._redis.pipeline()
+        for column in self.TASK_COLUMNS:
+            pipe.hget(_column_key(identifier, column), name)
+        args, status, result, task_id = pipe.execute()
+
+        if args is None:
+            if self._migrate_legacy_job(identifier):
+                return self._get_task(identifier, name)
             raise ValueError('Unable to locate task {name} in job {id}'.format(
                 name=name, id=identifier))
 
-        val = [t for t in tasks if t['name'] == name]
-
-        return val[0]
+        return _build_task(name, args, status, result, task_id)
 
     def _get_task_list(self, identifier):
         self._log_operation('Retrieving task list for {ident}'.format(ident=identifier))
 
-        if not self._redis.hexists(identifier, 'tasks'):
+        pipe = self._redis.pipeline()
+        columns = self._read_tasks(pipe, identifier)
+        results = pipe.execute()
+
+        if not any(results[0]):
+            if self._migrate_legacy_job(identifier):
+                return self._get_task_list(identifier)
             raise ValueError(
                 'Unable to find job with identifier {id} that has any tasks'.format(id=identifier))
 
-        return json.loads(self._redis.hget(identifier, 'tasks'))
+        return self._build_tasks(columns, results, identifier)
+
+    def _write_task_fields(self, identifier, name, fields: dict, completing=False, staged=None) -> bool:
+        """ Write fields of a task. Completing a task only writes while it is
+        still pending, and once the last task of the job completed its expiry
+        counts from then, so finished jobs stay around for job_ttl whatever
+        they took to run. The staged outputs of the task are only moved into
+        place once the fields were written, otherwise they are dropped.
+        """
+        staged = staged or {}
+        columns = list(fields.keys())
+        keys = [identifier] + [_column_key(identifier, c) for c in [self.ARGS_COLUMN, self.STATUS_COLUMN,
+                                                                    self.TASK_ID_COLUMN] + columns]
+        args = [name, json.dumps(self.PENDING_STATUS), repr(time.time()), '1' if completing else '0'] + [
+            self._dump_field(c, fields[c]) for c in columns]
+
+        try:
+            written = self._set_task_fields(keys=keys, args=args)
+            if not written and self._migrate_legacy_job(identifier):
+                written = self._set_task_fields(keys=keys, args=args)
+        except Exception:
+            self._drop_staged_outputs(staged)
+            raise
+        if written <= 0:
+            self._drop_staged_outputs(staged)
+        if not written:
+            raise ValueError('Unable to locate task {name} in job {id}'.format(name=name, id=identifier))
+        if written < 0:
+            return False
+
+        finished = written > 1
+        outputs = self._output_keys(identifier) if finished and self._job_ttl else []
+        pipe = self._redis.pipeline()
+        self._move_staged_outputs(pipe, identifier, name, staged)
+        self._publish_change(pipe, identifier, name)
+        if finished:
+            self._expire_job(pipe, identifier, self._job_ttl)
+            for key in outputs:
+                pipe.expire(key, self._job_ttl)
+        pipe.execute()
+        return True
+
+    def _publish_change(self, pipe, identifier, task_name=''):
+        pipe.hincrby(identifier, self.VERSION_FIELD, 1)
+        pipe.publish(self.CHANGES_CHANNEL + identifier, task_name)
+
+    def _dump_field(self, column, value):
+        dumped = json.dumps(value)
+        if column != self.RESULT_COLUMN or not self._compress_threshold or len(dumped) <= self._compress_threshold:
+            return dumped
+        return self.COMPRESSED_PREFIX + zlib.compress(dumped.encode('utf-8'))
+
+    def _migrate_legacy_job(self, identifier) -> bool:
+        """ Split the legacy 'tasks' JSON field of a job out into the per-task
+        hashes. The job is watched while doing so, so that concurrent migrations
+        of the same job only ever apply once. Jobs with unfinished tasks become
+        active jobs, so they are recovered like any other.
+        """
+
+        def migrate(pipe):
+            legacy = pipe.hget(identifier, self.LEGACY_TASKS_FIELD)
+            if legacy is None:
+                return False
+            self._log_operation('Migrating job {i} to per-task storage'.format(i=identifier))
+            tasks = json.loads(legacy)
+            pipe.multi()
+            pipe.delete(*self._job_keys(identifier))
+            self._write_tasks(pipe, identifier, tasks)
+            pipe.hdel(identifier, self.LEGACY_TASKS_FIELD)
+            if any(t['status'] == self.PENDING_STATUS for t in tasks):
+                pipe.sadd(self.ACTIVE_JOBS_KEY, identifier)
+            return True
+
+        return self._redis.transaction(migrate, identifier, value_from_callable=True)
+
+    def _stage_large_outputs(self, identifier, name, result):
+        """ Write the output streams of a result that are over the inline limit
+        to staging keys of their own. They replace the stored output of the
+        task once the result is written, and are read back through the output
+        references.
+
+        :returns: The result without those streams, and the staging key of each stream
+        """
+        if not self._inline_limit or not result:
+            return result, {}
+
+        stored, staged = dict(result), {}
+        for stream in self.OUTPUT_STREAMS:
+            output = result.get(stream)
+            if isinstance(output, str) and len(output) > self._inline_limit:
+                staged[stream] = '{k}:staged:{u}'.format(k=_output_key(identifier, name, stream), u=uuid.uuid4().hex)
+                self._redis.set(staged[stream], output.encode('utf-8'), ex=self.STAGED_OUTPUT_TTL)
+                stored[stream] = None
+        return stored, staged
+
+    def _move_staged_outputs(self, pipe, identifier, name, staged):
+        outputs = _column_key(identifier, self.OUTPUTS_KEY)
+        for stream, key in staged.items():
+            output = _output_key(identifier, name, stream)
+            pipe.rename(key, output)
+            pipe.sadd(outputs, _output_name(name, stream))
+            # The rename carries over the expiry of the staging key
+            if self._job_ttl:
+                pipe.expire(output, self._job_ttl)
+                pipe.expire(outputs, self._job_ttl)
+            else:
+                pipe.persist(output)
+
+    def _drop_staged_outputs(self, staged):
+        if staged:
+            self._redis.delete(*staged.values())
+
+    def _new_tasks(self, tasks):
+        new_tasks = []
+        for t in tasks:
+            task = {'args': t['task_args'], 'status': self.PENDING_STATUS, 'result': {'stdout': None, 'stderr': None},
+                    'name': t['task_name']}
+            if t.get('resources') or t.get('constraints'):
+                task['spec'] = {'resources': t.get('resources'), 'constraints': t.get('constraints')}
+            new_tasks.append(task)
+        return new_tasks
+
+    def _write_tasks(self, pipe, identifier, tasks):
+        if not tasks:
+            return
+
+        pipe.rpush(_column_key(identifier, self.NAMES_KEY), *[t['name'] for t in tasks])
+        pipe.hmset(_column_key(identifier, self.ARGS_COLUMN), {t['name']: json.dumps(t['args']) for t in tasks})
+        pipe.hmset(_column_key(identifier, self.STATUS_COLUMN), {t['name']: json.dumps(t['status']) for t in tasks})
+        pipe.hmset(_column_key(identifier, self.RESULT_COLUMN), {t['name']: json.dumps(t['result']) for t in tasks})
+        task_ids = {t['name']: json.dumps(t['__task_id']) for t in tasks if '__task_id' in t}
+        if task_ids:
+            pipe.hmset(_column_key(identifier, self.TASK_ID_COLUMN), task_ids)
+        specs = {t['name']: json.dumps(t['spec']) for t in tasks if 'spec' in t}
+        if specs:
+            pipe.hmset(_column_key(identifier, self.SPEC_KEY), specs)
+
+        complete = [t for t in tasks if t['status'] != self.PENDING_STATUS]
+        if len(complete) < len(tasks):
+            pipe.hdel(identifier, self.FINISHED_AT_FIELD)
+        pipe.hincrby(identifier, self.TASK_COUNT_TOTAL, len(tasks))
+        pipe.hincrby(identifier, self.TASK_COUNT_STARTED,
+                     len([t for t in tasks if t['status'] != self.PENDING_STATUS or '__task_id' in t]))
+        pipe.hincrby(identifier, self.TASK_COUNT_COMPLETE, len(complete))
+        pipe.hincrby(identifier, self.TASK_COUNT_FAILED, len([t for t in complete if t['status'] != 0]))
+
+    def _read_tasks(self, pipe, identifier, fields=None):
+        """ Queue the reads of the task names and of the columns holding the
+        given fields, all of them when None
+
+        :returns: The columns read, in the order their results follow the names
+        """
+        columns = [c for c in self.TASK_COLUMNS if fields is None or self.TASK_FIELDS[c] in fields]
+        pipe.lrange(_column_key(identifier, self.NAMES_KEY), 0, -1)
+        for column in columns:
+            pipe.hgetall(_column_key(identifier, column))
+        if self.RESULT_COLUMN in columns:
+            pipe.smembers(_column_key(identifier, self.OUTPUTS_KEY))
+        return columns
+
+    def _build_tasks(self, columns, results, identifier):
+        names, *values = results
+        values = dict(zip(columns, values))
+        stored = {}
+        for output in results[-1] if self.RESULT_COLUMN in columns else []:
+            name, stream = _decode(output).rsplit(':', 1)
+            stored.setdefault(name, {})[stream] = '/output/{i}/{n}/{s}'.format(i=identifier, n=name, s=stream)
+
+        tasks = []
+        for name in names:
+            task = _build_task(_decode(name), *[values.get(c, {}).get(name) for c in self.TASK_COLUMNS])
+            if task['name'] in stored and task['result'] is not None:
+                task['result']['outputs'] = stored[task['name']]
+            tasks.append(task)
+        return tasks
+
+    def _count_tasks(self, identifier):
+        """ Count the tasks of a job by reading their status and service id
+        columns, in the same order as TASK_COUNTS
+        """
+        pipe = self._redis.pipeline()
+        pipe.hgetall(_column_key(identifier, self.STATUS_COLUMN))
+        pipe.hkeys(_column_key(identifier, self.TASK_ID_COLUMN))
+        status, with_task_id = pipe.execute()
+        complete = {name: _load(s) for name, s in status.items() if _load(s) != self.PENDING_STATUS}
+        started = set(complete) | set(with_task_id)
+        return [len(status), len(started), len(complete), len([s for s in complete.values() if s != 0])]
+
+    def _output_keys(self, identifier):
+        return [_output_key(identifier, *_decode(o).rsplit(':', 1))
+                for o in self._redis.smembers(_column_key(identifier, self.OUTPUTS_KEY))]
+
+    def _expire_job(self, pipe, identifier, seconds):
+        if not seconds:
+            return
+        for key in [identifier] + self._job_keys(identifier):
+            pipe.expire(key, seconds)
+
+    def _job_keys(self, identifier):
+        return [_column_key(identifier, c) for c in self.TASK_COLUMNS + (self.NAMES_KEY, self.SPEC_KEY,
+                                                                          self.OUTPUTS_KEY)]
 
     def _log_operation(self, message: str):
         self._logger.info('JobDb: {msg}'.format(msg=message))
+
+
+def _column_key(identifier, column):
+    return '{i}:{c}'.format(i=identifier, c=column)
+
+
+def _output_name(name, stream):
+    return '{n}:{s}'.format(n=name, s=stream)
+
+
+def _output_key(identifier, name, stream):
+    return '{i}:output:{o}'.format(i=identifier, o=_output_name(name, stream))
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _build_task(name, args, status, result, task_id):
+    task = {'args': _load(args), 'status': _load(status), 'result': _load(result), 'name': name}
+    if task_id is not None:
+        task['__task_id'] = _load(task_id)
+    return task
+
+
+def _load(value):
+    if isinstance(value, bytes) and value.startswith(JobDb.COMPRESSED_PREFIX):
+        value = zlib.decompress(value[len(JobDb.COMPRESSED_PREFIX):])
+    return None if value is None else json.loads(value)
+
+
+def _decode(value):
+    try:
+        return value.decode('utf-8')
+    except (ValueError, AttributeError):
+        return value
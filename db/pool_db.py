@@ -0,0 +1,203 @@
+import json
+import time
+
+import redis
+
+from log import LogManager
+
+# The pools in KEYS[1] map to the time they were last active, or to the negated time
+# their service started being stopped.
+#
+# Pushes task ARGV[2] onto the list KEYS[2] of pool ARGV[1] and counts it as in flight
+# in KEYS[4], once per task key ARGV[3] recorded in KEYS[3]. Unless the pool is being
+# stopped, its last activity in KEYS[1] becomes ARGV[4] and its image in KEYS[5] ARGV[5].
+# Returns 1 when the pool was not known, and so needs to be started.
+PUSH_TASK_SCRIPT = """
+local state = redis.call('hget', KEYS[1], ARGV[1])
+redis.call('lpush', KEYS[2], ARGV[2])
+if redis.call('hset', KEYS[3], ARGV[3], ARGV[1]) == 1 then
+    redis.call('hincrby', KEYS[4], ARGV[1], 1)
+end
+if state and tonumber(state) < 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[4])
+redis.call('hset', KEYS[5], ARGV[1], ARGV[5])
+if not state then
+    return 1
+end
+return 0
+"""
+
+# Takes task key ARGV[1] out of flight, dropping it from KEYS[1] and the count of its
+# pool in KEYS[2], and records ARGV[2] as the last activity of the pool in KEYS[3].
+# Returns the pool of the task, or nothing if the task was not handed to a pool.
+FINISH_TASK_SCRIPT = """
+local pool = redis.call('hget', KEYS[1], ARGV[1])
+if not pool then
+    return false
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+if redis.call('hincrby', KEYS[2], pool, -1) <= 0 then
+    redis.call('hdel', KEYS[2], pool)
+end
+local state = redis.call('hget', KEYS[3], pool)
+if state and tonumber(state) >= 0 then
+    redis.call('hset', KEYS[3], pool, ARGV[2])
+end
+return pool
+"""
+
+# Marks pool ARGV[1] in KEYS[1] as stopping from ARGV[3], but only if it has no tasks
+# in flight in KEYS[2] and was last active before ARGV[2]. Only one process gets to stop
+# a pool, unless it started stopping before ARGV[2] and so the process stopping it died.
+CLAIM_IDLE_POOL_SCRIPT = """
+local last = tonumber(redis.call('hget', KEYS[1], ARGV[1]))
+if not last or math.abs(last) >= tonumber(ARGV[2]) then
+    return 0
+end
+if last >= 0 and tonumber(redis.call('hget', KEYS[2], ARGV[1]) or 0) > 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], -tonumber(ARGV[3]))
+return 1
+"""
+
+# Forgets stopped pool ARGV[1] in KEYS[1] and its image in KEYS[3], unless tasks were
+# handed to it while it was stopping. Those are counted in KEYS[2], the pool is then
+# marked active at ARGV[2] and its image returned so it can be started again.
+RELEASE_POOL_SCRIPT = """
+if tonumber(redis.call('hget', KEYS[2], ARGV[1]) or 0) > 0 then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+    return redis.call('hget', KEYS[3], ARGV[1])
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+return false
+"""
+
+
+class PoolDb:
+    """ The PoolDb holds the tasks handed to worker pools in redis, one list
+    per pool, along with the last time each pool was active and how many of
+    its tasks are waiting or running. Keeping them in redis lets a worker pull
+    its task from any swarmer process.
+
+    A pool only counts as idle once every task handed to it has finished, and
+    handing out tasks and stopping idle pools are atomic scripts, so a task
+    can not be handed to a pool that is being removed without the pool being
+    started again.
+    """
+
+    POOLS_KEY = 'swarmer:pools'
+    POOL_TASKS_PREFIX = 'swarmer:pool:'
+
+    # The number of tasks waiting or running per pool, and the pool of each of those tasks
+    IN_FLIGHT_KEY = 'swarmer:pool_in_flight'
+    TASK_POOLS_KEY = 'swarmer:pool_task_pools'
+
+    # The image each pool runs, kept to start it again
+    IMAGES_KEY = 'swarmer:pool_images'
+
+    def __init__(self, rd: redis.StrictRedis):
+        self._redis = rd
+        self._logger = LogManager(__name__)
+        self._push_task = rd.register_script(PUSH_TASK_SCRIPT)
+        self._finish_task = rd.register_script(FINISH_TASK_SCRIPT)
+        self._claim_idle_pool = rd.register_script(CLAIM_IDLE_POOL_SCRIPT)
+        self._release_pool = rd.register_script(RELEASE_POOL_SCRIPT)
+
+    def push_task(self, pool_id: str, image: str, task: dict) -> bool:
+        """ Hand a task to a pool
+
+        :param pool_id: The identifier of the pool
+        :param image: The image the pool runs
+        :param task: The task details the worker receives
+        :returns: Whether the pool was not known, and so needs to be started
+        """
+        return bool(self._push_task(keys=[self.POOLS_KEY, self.POOL_TASKS_PREFIX + pool_id, self.TASK_POOLS_KEY,
+                                          self.IN_FLIGHT_KEY, self.IMAGES_KEY],
+                                    args=[pool_id, json.dumps(task), _task_key(task), time.time(), image]))
+
+    def withdraw_task(self, pool_id: str, task: dict):
+        """ Take back a task that was handed to a pool but will never run
+
+        :param pool_id: The identifier of the pool
+        :param task: The task details that were pushed
+        """
+        self._redis.lrem(self.POOL_TASKS_PREFIX + pool_id, 1, json.dumps(task))
+        self.finish_task(task['job_id'], task['task_name'])
+
+    def pop_task(self, pool_id: str):
+        """ Take the next task handed to a pool
+
+        :param pool_id: The identifier of the pool
+        :returns: The task details, or None if there are none
+        """
+        task = self._redis.rpop(self.POOL_TASKS_PREFIX + pool_id)
+        return None if task is None else json.loads(task)
+
+    def finish_task(self, identifier: str, name: str):
+        """ Record that a task handed to a pool has finished, which counts as
+        activity of the pool
+
+        :param identifier: The unique job identifier
+        :param name: The name of the task
+        :returns: The pool of the task, or None if it was not handed to a pool
+        """
+        pool_id = self._finish_task(keys=[self.TASK_POOLS_KEY, self.IN_FLIGHT_KEY, self.POOLS_KEY],
+                                    args=[_task_key({'job_id': identifier, 'task_name': name}), time.time()])
+        return None if pool_id is None else _decode(pool_id)
+
+    def get_idle_pools(self, cutoff: float) -> list:
+        """ List the pools that were last active, or started being stopped,
+        before the cutoff. Whether they still have tasks in flight is only
+        checked by claim_idle_pool.
+        """
+        return [_decode(p) for p, last in self._redis.hgetall(self.POOLS_KEY).items() if abs(float(last)) < cutoff]
+
+    def claim_idle_pool(self, pool_id: str, cutoff: float) -> bool:
+        """ Mark a pool as stopping, if it has no tasks in flight and was last
+        active before the cutoff, or if it was left stopping since before the
+        cutoff. Every claimed pool must be released.
+
+        :param pool_id: The identifier of the pool
+        :param cutoff: The time the pool must have been idle since
+        :returns: Whether the pool was claimed and its service should be stopped
+        """
+        return bool(self._claim_idle_pool(keys=[self.POOLS_KEY, self.IN_FLIGHT_KEY],
+                                          args=[pool_id, cutoff, time.time()]))
+
+    def release_pool(self, pool_id: str):
+        """ Forget a pool whose service was stopped
+
+        :param pool_id: The identifier of the pool
+        :returns: The image of the pool if tasks were handed to it while it was
+                  stopping, it then has to be started again, otherwise None
+        """
+        self._log_operation('Releasing pool {p}'.format(p=pool_id))
+        image = self._release_pool(keys=[self.POOLS_KEY, self.IN_FLIGHT_KEY, self.IMAGES_KEY],
+                                   args=[pool_id, time.time()])
+        return None if image is None else _decode(image)
+
+    def remove_pool(self, pool_id: str):
+        """ Forget a pool """
+        self._log_operation('Removing pool {p}'.format(p=pool_id))
+        pipe = self._redis.pipeline()
+        pipe.hdel(self.POOLS_KEY, pool_id)
+        pipe.hdel(self.IMAGES_KEY, pool_id)
+        pipe.execute()
+
+    def _log_operation(self, message: str):
+        self._logger.info('PoolDb: {msg}'.format(msg=message))
+
+
+def _task_key(task):
+    return '{i}:{n}'.format(i=task['job_id'], n=task['task_name'])
+
+
+def _decode(value):
+    try:
+        return value.decode('utf-8')
+    except (ValueError, AttributeError):
+        return value
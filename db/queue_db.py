@@ -0,0 +1,315 @@
+import json
+import time
+
+import redis
+
+from log import LogManager
+from models import DEFAULT_PRIORITY, job_tenant, task_reservation
+
+# Moves task keys into the running hash KEYS[2] and returns their entries from KEYS[3],
+# until ARGV[1] tasks are running. Tasks are taken from the per job queues named
+# ARGV[5] .. job, always from the job with the lowest pass in the sorted set KEYS[1].
+# Taking a task moves the job's pass forward by its stride, the number of queued jobs
+# of its tenant (KEYS[9] and KEYS[10]) divided by its priority (KEYS[8]), and records
+# the pass taken as the virtual time in KEYS[7] where new jobs start. When a capacity of
+# ARGV[3] cpus and ARGV[4] bytes of memory is given, claiming stops at the first task
+# whose reservation, held in KEYS[5] and KEYS[6], does not fit next to the totals held
+# in KEYS[4], unless nothing is running. Doing this in one script keeps the limits exact
+# no matter how many workers are claiming at once.
+CLAIM_TASKS_SCRIPT = """
+local free = tonumber(ARGV[1]) - redis.call('hlen', KEYS[2])
+local cpus = tonumber(ARGV[3])
+local memory = tonumber(ARGV[4])
+local claimed = {}
+while free > 0 do
+    local head = redis.call('zrange', KEYS[1], 0, 0, 'withscores')
+    if #head == 0 then
+        break
+    end
+    local job, pass = head[1], tonumber(head[2])
+    local queue = ARGV[5] .. job
+    local key = redis.call('lindex', queue, -1)
+    if key then
+        local task_cpus = tonumber(redis.call('hget', KEYS[5], key) or 0)
+        local task_memory = tonumber(redis.call('hget', KEYS[6], key) or 0)
+        if cpus and redis.call('hlen', KEYS[2]) > 0 then
+            local reserved_cpus = tonumber(redis.call('hget', KEYS[4], 'cpus') or 0)
+            local reserved_memory = tonumber(redis.call('hget', KEYS[4], 'memory') or 0)
+            if reserved_cpus + task_cpus > cpus or reserved_memory + task_memory > memory then
+                break
+            end
+        end
+        redis.call('rpop', queue)
+        redis.call('hset', KEYS[2], key, ARGV[2])
+        redis.call('hincrbyfloat', KEYS[4], 'cpus', task_cpus)
+        redis.call('hincrbyfloat', KEYS[4], 'memory', task_memory)
+        table.insert(claimed, redis.call('hget', KEYS[3], key))
+        free = free - 1
+    end
+    redis.call('set', KEYS[7], pass)
+    local tenant = redis.call('hget', KEYS[9], job) or ('job:' .. job)
+    if redis.call('llen', queue) == 0 then
+        redis.call('zrem', KEYS[1], job)
+        if redis.call('hincrby', KEYS[10], tenant, -1) <= 0 then
+            redis.call('hdel', KEYS[10], tenant)
+        end
+    else
+        local priority = tonumber(redis.call('hget', KEYS[8], job) or 1)
+        local stride = tonumber(redis.call('hget', KEYS[10], tenant) or 1) / priority
+        redis.call('zadd', KEYS[1], pass + stride, job)
+    end
+end
+return claimed
+"""
+
+# Puts job ARGV[1] in the sorted set KEYS[1] at the virtual time in KEYS[2], unless it
+# is already queued, and counts it against its tenant in KEYS[3]. The job's priority
+# ARGV[2] and tenant ARGV[3] are kept in KEYS[4] and KEYS[5] until it completes.
+ACTIVATE_JOB_SCRIPT = """
+redis.call('hset', KEYS[4], ARGV[1], ARGV[2])
+redis.call('hset', KEYS[5], ARGV[1], ARGV[3])
+if redis.call('zscore', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], redis.call('get', KEYS[2]) or 0, ARGV[1])
+redis.call('hincrby', KEYS[3], ARGV[3], 1)
+return 1
+"""
+
+# Sets the running details of task ARGV[1], but only if it is still running
+MARK_STARTED_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# Removes task ARGV[1] of job ARGV[2] from the running hash, releases its reservation
+# in KEYS[6] and KEYS[7] from the totals in KEYS[5] and counts it against the job.
+# When the last task of a job completes, its priority and tenant are dropped from
+# KEYS[8] and KEYS[9] and the job is pushed onto the finished list.
+COMPLETE_TASK_SCRIPT = """
+local running = redis.call('hget', KEYS[1], ARGV[1])
+if not running then
+    return false
+end
+redis.call('hincrbyfloat', KEYS[5], 'cpus', -tonumber(redis.call('hget', KEYS[6], ARGV[1]) or 0))
+redis.call('hincrbyfloat', KEYS[5], 'memory', -tonumber(redis.call('hget', KEYS[7], ARGV[1]) or 0))
+redis.call('hdel', KEYS[6], ARGV[1])
+redis.call('hdel', KEYS[7], ARGV[1])
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+local remaining = redis.call('hincrby', KEYS[3], ARGV[2], -1)
+if remaining <= 0 then
+    redis.call('hdel', KEYS[3], ARGV[2])
+    redis.call('hdel', KEYS[8], ARGV[2])
+    redis.call('hdel', KEYS[9], ARGV[2])
+    redis.call('lpush', KEYS[4], ARGV[2])
+end
+return running
+"""
+
+# Puts a running task ARGV[1] of job ARGV[3] back on its job's queue KEYS[2], releasing
+# its reservation in KEYS[5] and KEYS[6] from the totals in KEYS[4], and records its
+# service ARGV[2] as overdue. If the job had no tasks left queued it is put back in
+# the sorted set KEYS[7] at the virtual time in KEYS[8], counted against its tenant.
+# Only the first worker to see an overdue task gets to requeue it.
+REQUEUE_TASK_SCRIPT = """
+if redis.call('hdel', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('hincrbyfloat', KEYS[4], 'cpus', -tonumber(redis.call('hget', KEYS[5], ARGV[1]) or 0))
+redis.call('hincrbyfloat', KEYS[4], 'memory', -tonumber(redis.call('hget', KEYS[6], ARGV[1]) or 0))
+redis.call('lpush', KEYS[2], ARGV[1])
+if not redis.call('zscore', KEYS[7], ARGV[3]) then
+    redis.call('zadd', KEYS[7], redis.call('get', KEYS[8]) or 0, ARGV[3])
+    redis.call('hincrby', KEYS[9], redis.call('hget', KEYS[10], ARGV[3]) or ('job:' .. ARGV[3]), 1)
+end
+if ARGV[2] ~= '' then
+    redis.call('sadd', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+
+class QueueDb:
+    """ The QueueDb holds the shared task queue in redis, so that every worker
+    and every swarmer replica schedules from the same queue and shares the same
+    limit on the number of running tasks.
+
+    Each job has its own queue of task keys, and the jobs with queued tasks are
+    kept in a sorted set by their pass, so tasks are handed out between jobs
+    the same way the FairTaskQueue does for a single process.
+    """
+
+    # Every job with queued tasks scored by its pass, along with the queue of each job
+    PASSES_KEY = 'swarmer:passes'
+    JOB_QUEUE_PREFIX = 'swarmer:queue:'
+    VIRTUAL_TIME_KEY = 'swarmer:virtual_time'
+    PRIORITIES_KEY = 'swarmer:priorities'
+    JOB_TENANTS_KEY = 'swarmer:job_tenants'
+    TENANT_JOBS_KEY = 'swarmer:tenant_jobs'
+
+    ENTRIES_KEY = 'swarmer:entries'
+    RUNNING_KEY = 'swarmer:running'
+    JOBS_KEY = 'swarmer:jobs'
+    FINISHED_KEY = 'swarmer:finished'
+    OVERDUE_KEY = 'swarmer:overdue'
+
+    # The cpus and memory reserved by all running tasks, and by each queued or running task
+    RESERVED_KEY = 'swarmer:reserved'
+    CPU_RESERVATIONS_KEY = 'swarmer:reservations:cpus'
+    MEMORY_RESERVATIONS_KEY = 'swarmer:reservations:memory'
+
+    def __init__(self, rd: redis.StrictRedis):
+        self._redis = rd
+        self._logger = LogManager(__name__)
+        self._claim_tasks = rd.register_script(CLAIM_TASKS_SCRIPT)
+        self._activate_job = rd.register_script(ACTIVATE_JOB_SCRIPT)
+        self._mark_started = rd.register_script(MARK_STARTED_SCRIPT)
+        self._complete_task = rd.register_script(COMPLETE_TASK_SCRIPT)
+        self._requeue_task = rd.register_script(REQUEUE_TASK_SCRIPT)
+
+    def push_jobs(self, jobs: list):
+        """ Queue up every task of the given jobs
+
+        :param jobs: A list of JobEntry items
+        """
+        self._log_operation('Queueing {n} jobs'.format(n=len(jobs)))
+
+        pipe = self._redis.pipeline()
+        for job in jobs:
+            entries = {task_key(job.identifier, t['task_name']): json.dumps(
+                {'identifier': job.identifier, 'name': t['task_name'], 'args': t['task_args'], 'image': job.image,
+                 'resources': t.get('resources'), 'constraints': t.get('constraints'), 'batch_size': job.batch_size})
+                for t in job.tasks}
+            reservations = {task_key(job.identifier, t['task_name']): task_reservation(t.get('resources'))
+                            for t in job.tasks}
+            cpus = {k: r[0] for k, r in reservations.items() if r[0]}
+            memory = {k: r[1] for k, r in reservations.items() if r[1]}
+            pipe.hincrby(self.JOBS_KEY, job.identifier, len(entries))
+            pipe.hmset(self.ENTRIES_KEY, entries)
+            if cpus:
+                pipe.hmset(self.CPU_RESERVATIONS_KEY, cpus)
+            if memory:
+                pipe.hmset(self.MEMORY_RESERVATIONS_KEY, memory)
+            pipe.lpush(self.JOB_QUEUE_PREFIX + job.identifier, *entries.keys())
+            self._activate_job(keys=[self.PASSES_KEY, self.VIRTUAL_TIME_KEY, self.TENANT_JOBS_KEY, self.PRIORITIES_KEY,
+                                     self.JOB_TENANTS_KEY],
+                               args=[job.identifier, job.priority or DEFAULT_PRIORITY,
+                                     job_tenant(job.identifier, job.tenant)],
+                               client=pipe)
+        pipe.execute()
+
+    def claim_tasks(self, limit: int, capacity=None) -> list:
+        """ Move as many tasks from the queue into the running set as the limits allow
+
+        :param limit: The maximum number of tasks that may run across the cluster
+        :param capacity: The (cpus, memory bytes) running tasks may reserve in total, if limited
+        :returns: The entries of the claimed tasks as dicts
+        """
+        cpus, memory = ('', '') if capacity is None else capacity
+        claimed = self._claim_tasks(keys=[self.PASSES_KEY, self.RUNNING_KEY, self.ENTRIES_KEY, self.RESERVED_KEY,
+                                          self.CPU_RESERVATIONS_KEY, self.MEMORY_RESERVATIONS_KEY,
+                                          self.VIRTUAL_TIME_KEY, self.PRIORITIES_KEY, self.JOB_TENANTS_KEY,
+                                          self.TENANT_JOBS_KEY],
+                                    args=[limit, json.dumps({'task_id': None, 'started': time.time()}), cpus, memory,
+                                          self.JOB_QUEUE_PREFIX])
+        return [json.loads(c) for c in claimed]
+
+    def mark_started(self, identifier: str, name: str, task_id):
+        """ Record the service running a task
+
+        :param identifier: The unique job identifier
+        :param name: The name of the task
+        :param task_id: The id of the service running the task
+        :returns: True if the task was still running
+        """
+        return bool(self._mark_started(keys=[self.RUNNING_KEY],
+                                       args=[task_key(identifier, name),
+                                             json.dumps({'task_id': task_id, 'started': time.time()})]))
+
+    def complete_task(self, identifier: str, name: str):
+        """ Remove a task from the running set
+
+        :param identifier: The unique job identifier
+        :param name: The name of the task
+        :returns: The running details of the task, or None if it was not running
+        """
+        running = self._complete_task(keys=[self.RUNNING_KEY, self.ENTRIES_KEY, self.JOBS_KEY, self.FINISHED_KEY,
+                                            self.RESERVED_KEY, self.CPU_RESERVATIONS_KEY,
+                                            self.MEMORY_RESERVATIONS_KEY, self.PRIORITIES_KEY, self.JOB_TENANTS_KEY],
+                                      args=[task_key(identifier, name), identifier])
+        return None if running is None else json.loads(running)
+
+    def requeue_task(self, key: str, task_id) -> bool:
+        """ Put a running task back on the queue and mark its service as overdue
+
+        :param key: The queue key of the task
+        :param task_id: The id of the service running the task, if any
+        :returns: Whether the task was requeued by this call
+        """
+        identifier = key.split(':', 1)[0]
+        return bool(self._requeue_task(keys=[self.RUNNING_KEY, self.JOB_QUEUE_PREFIX + identifier, self.OVERDUE_KEY,
+                                             self.RESERVED_KEY, self.CPU_RESERVATIONS_KEY,
+                                             self.MEMORY_RESERVATIONS_KEY, self.PASSES_KEY, self.VIRTUAL_TIME_KEY,
+                                             self.TENANT_JOBS_KEY, self.JOB_TENANTS_KEY],
+                                       args=[key, '' if task_id is None else task_id, identifier]))
+
+    def is_running(self, identifier: str, name: str) -> bool:
+        """ Query whether a task is currently running """
+        return self._redis.hexists(self.RUNNING_KEY, task_key(identifier, name))
+
+    def get_running_task(self, identifier: str, name: str):
+        """ Get the running details of a task, or None if it is not running """
+        running = self._redis.hget(self.RUNNING_KEY, task_key(identifier, name))
+        return None if running is None else json.loads(running)
+
+    def get_running(self) -> dict:
+        """ Get the details of every running task, keyed by queue key """
+        return {_decode(k): json.loads(v) for k, v in self._redis.hgetall(self.RUNNING_KEY).items()}
+
+    def pop_overdue(self) -> list:
+        """ Remove and return the ids of all services found to be overdue """
+        pipe = self._redis.pipeline()
+        pipe.smembers(self.OVERDUE_KEY)
+        pipe.delete(self.OVERDUE_KEY)
+        overdue, _ = pipe.execute()
+        return [_decode(o) for o in overdue]
+
+    def has_capacity(self, limit: int) -> bool:
+        """ Query whether there are queued tasks and room to run them """
+        pipe = self._redis.pipeline()
+        pipe.hlen(self.RUNNING_KEY)
+        pipe.zcard(self.PASSES_KEY)
+        running, queued = pipe.execute()
+        return running < limit and queued > 0
+
+    def wait_for_finished_job(self, timeout: int):
+        """ Block until a job has finished all of its tasks
+
+        :param timeout: The number of seconds to wait
+        :returns: The identifier of the finished job, or None on timeout
+        """
+        # The wait has to end before the socket read times out
+        socket_timeout = getattr(getattr(self._redis, 'connection_pool', None), 'connection_kwargs', {}).get(
+            'socket_timeout')
+        if socket_timeout:
+            timeout = max(1, min(timeout, int(socket_timeout) - 1))
+        popped = self._redis.brpop(self.FINISHED_KEY, timeout=timeout)
+        return None if popped is None else _decode(popped[1])
+
+    def _log_operation(self, message: str):
+        self._logger.info('QueueDb: {msg}'.format(msg=message))
+
+
+def task_key(identifier, name):
+    return '{i}:{n}'.format(i=identifier, n=name)
+
+
+def _decode(value):
+    try:
+        return value.decode('utf-8')
+    except (ValueError, AttributeError):
+        return value
@@ -0,0 +1,89 @@
+import os
+from threading import Thread
+
+from jobs.queue import JobQueue
+from jobs.scheduler import Scheduler
+from log import LogManager
+from wrapper import DockerWrapper
+
+
+class CapacityMonitor:
+    """ The CapacityMonitor periodically reads the nodes of the swarm and sets
+    the number of tasks the job queue may run at once to fit them. Each node
+    is given the fewest tasks allowed by the per node, per task cpu and per
+    task memory targets that are set, and the total is kept within the
+    minimum and maximum. The total cpus and memory of the nodes are also given
+    to the queue, so it only admits tasks whose reservations fit.
+    """
+
+    # Seconds between reads of the swarm nodes
+    CHECK_INTERVAL = 60
+
+    # Used when none of the per node targets are given
+    DEFAULT_TASKS_PER_NODE = 4
+
+    def __init__(self, client: DockerWrapper, job_queue: JobQueue, min_tasks=1, max_tasks=None, tasks_per_node=None,
+                 cpus_per_task=None, memory_per_task=None, thread_builder=Thread, interval=None):
+        if tasks_per_node is None and cpus_per_task is None and memory_per_task is None:
+            tasks_per_node = self.DEFAULT_TASKS_PER_NODE
+
+        self._client = client
+        self._job_queue = job_queue
+        self._min_tasks = min_tasks
+        self._max_tasks = max_tasks
+        self._tasks_per_node = tasks_per_node
+        self._cpus_per_task = cpus_per_task
+        self._memory_per_task = memory_per_task
+        self._logger = LogManager(__name__)
+        self._scheduler = Scheduler(self.update, thread_builder=thread_builder,
+                                    interval=self.CHECK_INTERVAL if interval is None else interval)
+        self._scheduler.wake()
+
+    @classmethod
+    def from_environ(cls, client: DockerWrapper, job_queue: JobQueue):
+        """ Create a new CapacityMonitor configured by the optional environment
+        variables SWARMER_MIN_TASKS, SWARMER_MAX_TASKS, SWARMER_TASKS_PER_NODE,
+        SWARMER_CPUS_PER_TASK, SWARMER_MEMORY_PER_TASK and SWARMER_CAPACITY_INTERVAL
+        """
+        return cls(client, job_queue,
+                   min_tasks=int(os.environ.get('SWARMER_MIN_TASKS', '1')),
+                   max_tasks=_optional(os.environ, 'SWARMER_MAX_TASKS', int),
+                   tasks_per_node=_optional(os.environ, 'SWARMER_TASKS_PER_NODE', int),
+                   cpus_per_task=_optional(os.environ, 'SWARMER_CPUS_PER_TASK', float),
+                   memory_per_task=_optional(os.environ, 'SWARMER_MEMORY_PER_TASK', int),
+                   interval=_optional(os.environ, 'SWARMER_CAPACITY_INTERVAL', int))
+
+    def update(self):
+        """ Read the swarm nodes and set the queue length and resource capacity to match them """
+        nodes = self._client.node_resources()
+        self._job_queue.resource_capacity = (sum(n[0] for n in nodes), sum(n[1] for n in nodes))
+
+        limit = self.compute_limit(nodes)
+        if limit != self._job_queue.queue_len:
+            self._logger.info('CapacityMonitor: Setting the concurrent task limit to {n}'.format(n=limit))
+            self._job_queue.queue_len = limit
+
+    def compute_limit(self, nodes) -> int:
+        """ Work out how many tasks the given nodes can run at once
+
+        :param nodes: A list of (cpus, memory bytes) tuples, one per node
+        :returns: The number of tasks to run at once
+        """
+        total = sum(self._node_limit(cpus, memory) for cpus, memory in nodes)
+        total = max(total, self._min_tasks)
+        return total if self._max_tasks is None else min(total, self._max_tasks)
+
+    def _node_limit(self, cpus, memory) -> int:
+        limits = []
+        if self._tasks_per_node is not None:
+            limits.append(self._tasks_per_node)
+        if self._cpus_per_task:
+            limits.append(int(cpus // self._cpus_per_task))
+        if self._memory_per_task:
+            limits.append(int(memory // self._memory_per_task))
+        return min(limits)
+
+
+def _optional(environ, name, convert):
+    value = environ.get(name)
+    return None if value in (None, '') else convert(value)
@@ -0,0 +1,131 @@
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from db import JobDb
+from jobs.links import OutputLinks
+from log import LogManager
+
+
+class ResultDelivery:
+    """ The ResultDelivery posts the results of finished jobs to their
+    callback URLs from a bounded pool of worker threads. Connections are
+    kept alive and pooled per host, every request has a timeout, failed
+    deliveries are retried with exponential backoff and the ones that still
+    fail are stored as dead letters in redis. Task output stored apart from
+    the results is sent as links to fetch it, rather than in the body, and
+    the body itself can be gzipped for callbacks that accept it.
+    """
+
+    # Responses with these statuses are worth retrying, along with any 5xx
+    RETRY_STATUSES = (408, 429)
+
+    def __init__(self, job_db: JobDb, workers=8, timeout=10, retries=3, backoff=1.0, session=None,
+                 executor_builder=ThreadPoolExecutor, sleep=time.sleep, links: OutputLinks = None, compress=False):
+        self._job_db = job_db
+        self._links = links
+        self._compress = compress
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._sleep = sleep
+        self._logger = LogManager(__name__)
+        self._session = session if session is not None else _build_session(workers)
+        self._executor = executor_builder(max_workers=workers)
+
+    @classmethod
+    def from_environ(cls, job_db: JobDb):
+        """ Create a new ResultDelivery configured by the optional environment
+        variables SWARMER_CALLBACK_WORKERS, SWARMER_CALLBACK_TIMEOUT,
+        SWARMER_CALLBACK_RETRIES, SWARMER_CALLBACK_BACKOFF and
+        SWARMER_CALLBACK_GZIP, the output links are configured as described in
+        OutputLinks.from_environ
+        """
+        return cls(job_db,
+                   workers=int(os.environ.get('SWARMER_CALLBACK_WORKERS', '8')),
+                   timeout=float(os.environ.get('SWARMER_CALLBACK_TIMEOUT', '10')),
+                   retries=int(os.environ.get('SWARMER_CALLBACK_RETRIES', '3')),
+                   backoff=float(os.environ.get('SWARMER_CALLBACK_BACKOFF', '1')),
+                   links=OutputLinks.from_environ(),
+                   compress=os.environ.get('SWARMER_CALLBACK_GZIP', 'false').lower() in ['yes', 'y', 'true', 't', '1'])
+
+    def send(self, jobs):
+        """ Queue the results of finished jobs for delivery, this does not
+        wait for any of them to be sent
+
+        :param jobs: The (job identifier, job details) to post, one per job
+        """
+        for identifier, details in jobs:
+            self._executor.submit(self._deliver, identifier, details)
+
+    def _deliver(self, identifier, details):
+        """ Post the results of a job and clear the job once they were sent.
+        Results that can't be sent, for whatever reason, are stored as a dead
+        letter instead, which keeps the job for its results to be fetched.
+        """
+        callback = details.get('__callback')
+        try:
+            error = self._post(callback, details)
+        except Exception as ex:
+            self._logger.error('Unable to post results of job {i} to {cb}: {e}'.format(i=identifier, cb=callback,
+                                                                                       e=ex))
+            error = str(ex)
+
+        if error is None:
+            try:
+                self._job_db.clear_job(identifier)
+            except Exception as ex:
+                self._logger.error('Unable to clear delivered job {i}: {e}'.format(i=identifier, e=ex))
+            return
+
+        self._logger.error('Giving up on posting results to {cb}, storing as dead letter'.format(cb=callback))
+        try:
+            self._job_db.add_dead_letter(identifier, callback, error)
+        except Exception as ex:
+            self._logger.error('Unable to store a dead letter for job {i}: {e}'.format(i=identifier, e=ex))
+
+    def _post(self, callback, details):
+        """ Post the results to the callback, retrying failed attempts
+
+        :returns: None once posted, otherwise the last error
+        """
+        if self._links is not None:
+            details = self._links.resolve(details)
+        payload = self._encode(details)
+        error = None
+        for attempt in range(1, self._retries + 1):
+            try:
+                response = self._session.post(callback, timeout=self._timeout, **payload)
+                if response.status_code < 400:
+                    return None
+                error = 'Callback responded with status {s}'.format(s=response.status_code)
+                if response.status_code < 500 and response.status_code not in self.RETRY_STATUSES:
+                    break
+            except requests.RequestException as ex:
+                error = str(ex)
+
+            self._logger.error('Attempt {a} to post results to {cb} failed: {e}'.format(a=attempt, cb=callback,
+                                                                                          e=error))
+            if attempt < self._retries:
+                self._sleep(self._backoff * 2 ** (attempt - 1))
+        return error
+
+    def _encode(self, details):
+        """ Get the body of the post, gzipped once for every attempt when compressing """
+        if not self._compress:
+            return {'json': details}
+        return {'data': gzip.compress(json.dumps(details).encode('utf-8')),
+                'headers': {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}}
+
+
+def _build_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
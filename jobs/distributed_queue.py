@@ -0,0 +1,120 @@
+import datetime
+import time
+from threading import Thread
+from typing import List
+
+from redis import RedisError
+
+from db import JobDb, QueueDb
+from jobs.delivery import ResultDelivery
+from jobs.queue import JobQueue
+from models import JobEntry, RunnableTask
+
+
+class DistributedJobQueue(JobQueue):
+    """ The DistributedJobQueue keeps the queued and running tasks in redis
+    instead of in process memory. Every gunicorn worker and every swarmer
+    replica pointed at the same redis schedules from the same queue, the
+    queue_len limit applies to the whole cluster, and a task result can be
+    reported to any of them.
+    """
+
+    # Seconds the background threads wait before trying again when redis can't be reached
+    REDIS_RETRY_DELAY = 5
+
+    def __init__(self, job_db: JobDb, queue_db: QueueDb, queue_len=12, thread_builder=Thread,
+                 delivery: ResultDelivery = None, sweep_interval=0):
+        self._queue_db = queue_db
+        super().__init__(job_db, queue_len=queue_len, thread_builder=thread_builder, delivery=delivery,
+                         sweep_interval=sweep_interval)
+
+    def _enqueue_jobs(self, jobs: List[JobEntry]):
+        self._queue_db.push_jobs(jobs)
+
+    def recover(self, services: dict) -> int:
+        # The queue already lives in redis, there is nothing to rebuild
+        return 0
+
+    def complete_task(self, identifier, name, status, result) -> (List[int], bool):
+        # Duplicate and stale callbacks are turned away before anything is written
+        if not self._queue_db.is_running(identifier, name):
+            self._logger.error(
+                'Was expected to find task "{tn}" for job "{jn}" but it was not present'.format(tn=name,
+                                                                                                jn=identifier))
+            return [], self._should_run()
+
+        # The results are stored first, the job may be picked up for delivery
+        # by another worker as soon as its last task leaves the running set.
+        # The running slot is released even if the job is gone from the store,
+        # or its task was already completed there.
+        try:
+            written = self._job_db.complete_task(identifier, name, status, result)
+        except ValueError:
+            self._queue_db.complete_task(identifier, name)
+            raise
+        if not written:
+            self._logger.error('Task "{tn}" for job "{jn}" was already completed'.format(tn=name, jn=identifier))
+
+        running = self._queue_db.complete_task(identifier, name)
+        if running is None:
+            return [], self._should_run()
+
+        task_list = [] if running['task_id'] is None else [running['task_id']]
+        task_list.extend(self._queue_db.pop_overdue())
+        return task_list, self._should_run()
+
+    def get_next_tasks(self) -> List[RunnableTask]:
+        """ Claim the next tasks to run from the shared queue
+
+        :return: A list of the next tasks to run
+        """
+        return [RunnableTask(t['identifier'], t['name'], t['args'], t['image'], t.get('resources'),
+                             t.get('constraints'), t.get('batch_size'))
+                for t in self._queue_db.claim_tasks(self._queue_len, self._resource_capacity)]
+
+    def mark_task_started(self, identifier, name, task_id):
+        if self._queue_db.mark_started(identifier, name, task_id):
+            self._record_started(identifier, name, task_id)
+
+    def is_task_running(self, identifier, name, task_id=None) -> bool:
+        if task_id is None:
+            return self._queue_db.is_running(identifier, name)
+        running = self._queue_db.get_running_task(identifier, name)
+        return running is not None and running['task_id'] == task_id
+
+    def get_started_tasks(self):
+        return [{'id': r['task_id'], 'started': datetime.datetime.fromtimestamp(r['started'])}
+                for r in self._queue_db.get_running().values() if r['task_id'] is not None]
+
+    def _scan_for_dead_jobs(self):
+        while True:
+            time.sleep(self.DEAD_SCAN_INTERVAL)
+            try:
+                cutoff = time.time() - self.DEAD_JOB_INTERVAL.total_seconds()
+                for key, running in self._queue_db.get_running().items():
+                    if running['started'] < cutoff:
+                        self._queue_db.requeue_task(key, running['task_id'])
+                self._signal_should_run()
+            except RedisError as ex:
+                self._logger.error('Unable to scan for overdue tasks: {e}'.format(e=ex))
+
+    def _process_completed_jobs(self):
+        # Finished jobs are pushed to redis by whichever worker completed their
+        # last task, and are picked up here by exactly one worker
+        while True:
+            try:
+                identifier = self._queue_db.wait_for_finished_job(self.COMPLETED_WAIT_TIMEOUT)
+                if identifier is None:
+                    continue
+
+                details = self._collect_completed_job(identifier)
+                if details is not None:
+                    self._delivery.send([(identifier, details)])
+                self._signal_should_run()
+            except RedisError as ex:
+                self._logger.error('Unable to process finished jobs: {e}'.format(e=ex))
+                time.sleep(self.REDIS_RETRY_DELAY)
+
+    def _should_run(self):
+        return self._queue_db.has_capacity(self._queue_len)
+
@@ -0,0 +1,77 @@
+import heapq
+from collections import deque
+from itertools import count
+
+from models import DEFAULT_PRIORITY, job_tenant
+
+
+class FairTaskQueue:
+    """ The FairTaskQueue holds the queued tasks of every job and hands them
+    out with stride scheduling. Each job keeps a pass value that moves forward
+    by its stride every time one of its tasks is taken, and the job with the
+    lowest pass goes next. A job's stride is the number of queued jobs of its
+    tenant divided by its priority, so higher priority jobs get a larger share
+    and every tenant gets the same share no matter how many jobs it submits.
+    Jobs without a tenant count as a tenant of their own.
+
+    New jobs start at the pass of the last task taken, so a small job submitted
+    behind a large one runs right away instead of waiting for it to drain.
+
+    This is not thread safe, the owner is expected to hold a lock around it.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._weights = {}
+        self._tenant_jobs = {}
+        self._passes = []
+        self._order = count()
+        self._virtual_time = 0.0
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def __bool__(self):
+        return bool(self._passes)
+
+    def push(self, identifier, task, priority=None, tenant=None):
+        """ Add a task to the back of its job's queue
+
+        :param identifier: The identifier of the job the task belongs to
+        :param task: The task to queue
+        :param priority: The priority of the job, higher runs more often
+        :param tenant: The tenant that submitted the job, if any
+        """
+        if identifier not in self._queues:
+            self._queues[identifier] = deque()
+            self._weights[identifier] = (priority or DEFAULT_PRIORITY, job_tenant(identifier, tenant))
+            tenant_key = self._weights[identifier][1]
+            self._tenant_jobs[tenant_key] = self._tenant_jobs.get(tenant_key, 0) + 1
+            heapq.heappush(self._passes, (self._virtual_time, next(self._order), identifier))
+
+        self._queues[identifier].appendleft(task)
+
+    def peek(self):
+        """ Get the task that would be taken next without taking it """
+        return self._queues[self._passes[0][2]][-1] if self._passes else None
+
+    def pop(self):
+        """ Take the next task, moving its job's pass forward """
+        job_pass, order, identifier = heapq.heappop(self._passes)
+        self._virtual_time = job_pass
+        queue = self._queues[identifier]
+        task = queue.pop()
+
+        priority, tenant_key = self._weights[identifier]
+        if queue:
+            stride = self._tenant_jobs[tenant_key] / priority
+            heapq.heappush(self._passes, (job_pass + stride, order, identifier))
+        else:
+            del self._queues[identifier]
+            del self._weights[identifier]
+            self._tenant_jobs[tenant_key] -= 1
+            if not self._tenant_jobs[tenant_key]:
+                del self._tenant_jobs[tenant_key]
+
+        return task
+
@@ -0,0 +1,74 @@
+import copy
+import hashlib
+import hmac
+import os
+import time
+
+
+class OutputLinks:
+    """ The OutputLinks turn the output references in job results into links
+    that can be fetched from swarmer. When a secret is set, the links are
+    signed and expire, and fetching output requires a valid signature.
+    """
+
+    def __init__(self, base_url: str, secret: str = None, ttl=86400, clock=time.time):
+        self._base_url = base_url.rstrip('/')
+        self._secret = secret.encode('utf-8') if secret else None
+        self._ttl = ttl
+        self._clock = clock
+
+    @classmethod
+    def from_environ(cls):
+        """ Create new OutputLinks from the optional environment variables
+        SWARMER_PUBLIC_URL, which defaults to the runner address,
+        SWARMER_OUTPUT_SECRET and SWARMER_OUTPUT_LINK_TTL
+        """
+        base_url = os.environ.get('SWARMER_PUBLIC_URL') or 'http://{h}:{p}'.format(h=os.environ['RUNNER_HOST_NAME'],
+                                                                                 p=os.environ['RUNNER_PORT'])
+        return cls(base_url, secret=os.environ.get('SWARMER_OUTPUT_SECRET'),
+                   ttl=int(os.environ.get('SWARMER_OUTPUT_LINK_TTL', '86400')))
+
+    def link(self, path: str) -> str:
+        """ Get the link to fetch the output at path
+
+        :param path: The path of the output, starting with /output
+        """
+        if self._secret is None:
+            return self._base_url + path
+
+        expires = int(self._clock()) + self._ttl
+        return '{b}{p}?expires={e}&signature={s}'.format(b=self._base_url, p=path, e=expires,
+                                                         s=self._sign(path, expires))
+
+    def verify(self, path: str, expires, signature) -> bool:
+        """ Check whether a request for the output at path may be answered
+
+        :param path: The path of the output that was requested
+        :param expires: The expires parameter of the link
+        :param signature: The signature parameter of the link
+        """
+        if self._secret is None:
+            return True
+
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        if expires < self._clock() or signature is None:
+            return False
+        return hmac.compare_digest(self._sign(path, expires), signature)
+
+    def resolve(self, details: dict) -> dict:
+        """ Get a copy of job details with the output references of every
+        task turned into links
+        """
+        resolved = copy.deepcopy(details)
+        for task in resolved.get('tasks', []):
+            outputs = (task.get('result') or {}).get('outputs')
+            if outputs:
+                task['result']['outputs'] = {stream: self.link(path) for stream, path in outputs.items()}
+        return resolved
+
+    def _sign(self, path, expires):
+        message = '{p}:{e}'.format(p=path, e=expires).encode('utf-8')
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
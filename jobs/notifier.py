@@ -0,0 +1,124 @@
+import time
+from threading import Condition, Lock, Thread
+
+from redis import RedisError
+
+from db import JobDb
+from log import LogManager
+
+
+class StatusNotifier:
+    """ The StatusNotifier follows the job changes published in redis on a
+    single background connection, and wakes the requests waiting on the jobs
+    that changed. Changes are only tracked for jobs that someone is watching.
+
+    Changes published while the connection is down are missed, so waiters
+    should check the version of the job themselves once their wait times out.
+    """
+
+    # Seconds to wait before listening again after the connection failed
+    RECONNECT_DELAY = 5
+
+    def __init__(self, job_db: JobDb, thread_builder=Thread):
+        self._job_db = job_db
+        self._logger = LogManager(__name__)
+        self._lock = Lock()
+        # Job identifier to the watch state of the job
+        self._watched = {}
+        self._thread = thread_builder(target=self._listen, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, identifier: str) -> int:
+        """ Start tracking the changes to a job, every call must be matched
+        by a call to unwatch
+
+        :param identifier: The unique job identifier
+        :returns: The number of changes seen so far, to pass to wait
+        """
+        with self._lock:
+            watched = self._watched.get(identifier)
+            if watched is None:
+                watched = self._watched[identifier] = _WatchedJob(self._lock)
+            watched.watchers += 1
+            return watched.changes
+
+    def unwatch(self, identifier: str):
+        """ Stop tracking the changes to a job for one of its watchers
+
+        :param identifier: The unique job identifier
+        """
+        with self._lock:
+            watched = self._watched.get(identifier)
+            if watched is None:
+                return
+            watched.watchers -= 1
+            if watched.watchers <= 0:
+                del self._watched[identifier]
+
+    def wait(self, identifier: str, seen: int, timeout: float):
+        """ Wait for a watched job to change
+
+        :param identifier: The unique job identifier
+        :param seen: The number of changes the caller has already seen
+        :param timeout: The most seconds to wait
+        :returns: The new number of changes, or None if the timeout passed first
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            watched = self._watched.get(identifier)
+            if watched is None:
+                raise ValueError('Job {i} is not being watched'.format(i=identifier))
+            while watched.changes <= seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                watched.changed.wait(remaining)
+            return watched.changes
+
+    def changed_tasks(self, identifier: str, seen: int):
+        """ Get the tasks of a watched job that changed since the caller last looked
+
+        :param identifier: The unique job identifier
+        :param seen: The number of changes the caller has already seen
+        :returns: The set of task names, or None when the change was to the
+                  whole job, such as it being cleared
+        """
+        with self._lock:
+            watched = self._watched.get(identifier)
+            if watched is None:
+                raise ValueError('Job {i} is not being watched'.format(i=identifier))
+            names = {n for n, change in watched.tasks.items() if change > seen}
+            return None if '' in names else names
+
+    def notify(self, identifier: str, task_name: str = ''):
+        """ Wake the watchers of a job that changed
+
+        :param identifier: The unique job identifier
+        :param task_name: The task that changed, empty when the whole job did
+        """
+        with self._lock:
+            watched = self._watched.get(identifier)
+            if watched is not None:
+                watched.changes += 1
+                watched.tasks[task_name] = watched.changes
+                watched.changed.notify_all()
+
+    def _listen(self):
+        while True:
+            try:
+                for identifier, task_name in self._job_db.listen_for_changes():
+                    self.notify(identifier, task_name)
+            except RedisError as ex:
+                self._logger.error('StatusNotifier: Lost the connection for job changes: {e}'.format(e=ex))
+            time.sleep(self.RECONNECT_DELAY)
+
+
+class _WatchedJob:
+    def __init__(self, lock):
+        self.watchers = 0
+        self.changes = 0
+        # Task name to the last change made to it, bounded by the tasks in the job
+        self.tasks = {}
+        # Shares the notifier lock, so a change can't slip in between checking and waiting
+        self.changed = Condition(lock)
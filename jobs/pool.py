@@ -0,0 +1,98 @@
+import hashlib
+import os
+import time
+from threading import Thread
+
+from docker.errors import DockerException
+from requests import RequestException
+
+from db import PoolDb
+from jobs.scheduler import Scheduler
+from log import LogManager
+from models import RunnableTask
+from wrapper import DockerWrapper
+
+
+class WorkerPool:
+    """ The WorkerPool runs tasks on long lived worker services, one service
+    per image, instead of creating a new service for every task. Tasks are
+    handed to the pool of their image and the workers pull them from swarmer,
+    so short tasks don't pay for service scheduling and container start up.
+    Pools that have had no task waiting or running for a while are removed.
+    """
+
+    # Seconds between checks for idle pools
+    IDLE_CHECK_INTERVAL = 60
+
+    def __init__(self, client: DockerWrapper, pool_db: PoolDb, size=4, idle_timeout=600, thread_builder=Thread):
+        self._client = client
+        self._pool_db = pool_db
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._logger = LogManager(__name__)
+        self._reaper = Scheduler(self._remove_idle_pools, thread_builder=thread_builder,
+                                 interval=self.IDLE_CHECK_INTERVAL)
+
+    @classmethod
+    def from_environ(cls, client: DockerWrapper, pool_db: PoolDb):
+        """ Create a new WorkerPool configured by the optional environment
+        variables SWARMER_POOL_SIZE and SWARMER_POOL_IDLE_TIMEOUT
+        """
+        return cls(client, pool_db,
+                   size=int(os.environ.get('SWARMER_POOL_SIZE', '4')),
+                   idle_timeout=int(os.environ.get('SWARMER_POOL_IDLE_TIMEOUT', '600')))
+
+    def submit(self, task: RunnableTask):
+        """ Hand a task to the pool for its image, starting the pool if needed
+
+        :param task: The task to run
+        """
+        pool_id = pool_id_for(task.image)
+        details = {'job_id': task.identifier, 'task_name': task.name, 'task_args': task.args}
+        if not self._pool_db.push_task(pool_id, task.image, details):
+            return
+
+        try:
+            self._client.start_pool(pool_id, task.image, self._size)
+        except (DockerException, RequestException):
+            # Forget the pool so the next task tries to start it again
+            self._pool_db.withdraw_task(pool_id, details)
+            self._pool_db.remove_pool(pool_id)
+            raise
+
+    def finish_task(self, identifier: str, task_name: str):
+        """ Record that a task has finished, a pool is only idle once all of
+        the tasks handed to it have
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the task
+        """
+        self._pool_db.finish_task(identifier, task_name)
+
+    def next_task(self, pool_id: str):
+        """ Take the next task for a worker of the given pool
+
+        :param pool_id: The identifier of the pool
+        :returns: The task details, or None if there are none
+        """
+        return self._pool_db.pop_task(pool_id)
+
+    def _remove_idle_pools(self):
+        cutoff = time.time() - self._idle_timeout
+        for pool_id in self._pool_db.get_idle_pools(cutoff):
+            if not self._pool_db.claim_idle_pool(pool_id, cutoff):
+                continue
+            self._logger.info('WorkerPool: Removing idle pool {p}'.format(p=pool_id))
+            try:
+                self._client.stop_pool(pool_id)
+            finally:
+                image = self._pool_db.release_pool(pool_id)
+                if image is not None:
+                    self._logger.info('WorkerPool: Starting pool {p} again for the tasks handed to it while it '
+                                      'stopped'.format(p=pool_id))
+                    self._client.start_pool(pool_id, image, self._size)
+
+
+def pool_id_for(image: str) -> str:
+    """ Get the identifier of the pool that runs an image """
+    return hashlib.sha1(image.encode('utf-8')).hexdigest()[:12]
@@ -1,15 +1,14 @@
 import datetime
-import json
 import time
-from collections import deque
-from threading import Lock, Thread
+from threading import Condition, Lock, Thread
 from typing import List
 
-import requests
-
 from db import JobDb
+from jobs.delivery import ResultDelivery
+from jobs.fair_queue import FairTaskQueue
+from jobs.scheduler import Scheduler
 from log import LogManager
-from models import RunnableTask, TaskEntry
+from models import JobEntry, RunnableTask, TaskEntry, task_reservation
 
 
 class JobQueue:
@@ -22,8 +21,8 @@ class JobQueue:
     # We scan for bad tasks every 10 minutes
     DEAD_SCAN_INTERVAL = 600
 
-    # We scan for completed jobs every minute
-    COMPLETED_SCAN_INTERVAL = 60
+    # The longest we block while waiting for a job to complete before checking again
+    COMPLETED_WAIT_TIMEOUT = 60
 
     # For now, anything above 30 minutes is stalled
     DEAD_JOB_INTERVAL = datetime.timedelta(minutes=30)
@@ -31,23 +30,60 @@ class JobQueue:
     # If set, we use this to signal that more tasks should be run
     _run_signal = None
 
-    def __init__(self, job_db: JobDb, queue_len=12, thread_builder=Thread):
+    def __init__(self, job_db: JobDb, queue_len=12, thread_builder=Thread, delivery: ResultDelivery = None,
+                 sweep_interval=0):
         self._job_db = job_db
+        self._delivery = delivery if delivery is not None else ResultDelivery(job_db)
         self._queue_len = queue_len
+        # The (cpus, memory bytes) that running tasks may reserve in total, if limited
+        self._resource_capacity = None
         self._logger = LogManager(__name__)
-        self._tasks = deque()
-        self._running_tasks = []
-        self._jobs = set()
+        # Queued tasks, handed out fairly between jobs by priority and tenant
+        self._tasks = FairTaskQueue()
+        # Running tasks keyed by (job identifier, task name)
+        self._running_tasks = {}
+        # The number of tasks of each job that have not been completed yet
+        self._jobs = {}
+        # The (priority, tenant) of each job, kept so overdue tasks can be queued again
+        self._job_weights = {}
+        # Jobs whose last task was completed, waiting for their results to be sent
+        self._completed_jobs = []
         self._lock = Lock()
+        self._job_completed = Condition(self._lock)
         self._overdue_tasks = set()
         # Set up the cleanup process
         self._bg_cleanup_thread = thread_builder(target=self._scan_for_dead_jobs, args=())
         self._bg_cleanup_thread.daemon = True
         self._bg_cleanup_thread.start()
         # Set up the completed job process
-        self._bg_completed_thread = thread_builder(target=self._scan_for_completed_jobs, args=())
+        self._bg_completed_thread = thread_builder(target=self._process_completed_jobs, args=())
         self._bg_completed_thread.daemon = True
         self._bg_completed_thread.start()
+        # Periodically look for job keys in redis that nothing will ever clear
+        self._sweeper = Scheduler(job_db.sweep_keys, thread_builder=thread_builder,
+                                  interval=sweep_interval) if sweep_interval else None
+
+    @property
+    def queue_len(self):
+        return self._queue_len
+
+    @queue_len.setter
+    def queue_len(self, value):
+        with self._lock:
+            grown = value > self._queue_len
+            self._queue_len = value
+        if grown:
+            self._signal_should_run()
+
+    @property
+    def resource_capacity(self):
+        return self._resource_capacity
+
+    @resource_capacity.setter
+    def resource_capacity(self, value):
+        with self._lock:
+            self._resource_capacity = value
+        self._signal_should_run()
 
     @property
     def run_signal(self):
@@ -57,13 +93,16 @@ class JobQueue:
     def run_signal(self, value):
         self._run_signal = value
 
-    def add_new_job(self, identifier, image_name, callback, tasks):
+    def add_new_job(self, identifier, image_name, callback, tasks, priority=None, tenant=None, batch_size=None):
         """ Add a new job to the job queue
 
         :param identifier: The identifier for the job
         :param image_name: The name of the image to run each task
         :param callback: The callback URL to report results
         :param tasks: The individual tasks to run
+        :param priority: The priority of the job, jobs with a higher priority get a larger share
+        :param tenant: The tenant submitting the job, tenants share the queue equally
+        :param batch_size: The most tasks of the job to run together in one service
         """
         if not tasks:
             self._logger.error('No tasks provided when submitting job {i}'.format(i=identifier))
@@ -71,115 +110,271 @@ class JobQueue:
 
         self._logger.info('Adding job {i} to the queue'.format(i=identifier))
         self._job_db.add_job(identifier, image_name, callback)
+        self._job_db.add_tasks(identifier, tasks)
 
-        self._jobs.add(identifier)
+        self._enqueue_jobs([JobEntry(identifier, image_name, callback, tasks, priority, tenant, batch_size)])
 
-        for t in tasks:
-            self._tasks.appendleft(TaskEntry(identifier, t['task_name'], t['task_args'], image_name, None, None))
+    def add_new_jobs(self, jobs: List[JobEntry]):
+        """ Add several new jobs to the job queue, storing them with a single
+        batched write
 
-        self._job_db.add_tasks(identifier, tasks)
+        :param jobs: The jobs to add
+        """
+        if not all(j.tasks for j in jobs):
+            self._logger.error('No tasks provided when submitting a batch of jobs')
+            raise ValueError('Tasks must be provided with every job')
 
-    def complete_task(self, identifier, name, status, result) -> (List[int], bool):
+        self._logger.info('Adding {n} jobs to the queue'.format(n=len(jobs)))
+        self._job_db.add_jobs(jobs)
+        self._enqueue_jobs(jobs)
+
+    def _enqueue_jobs(self, jobs: List[JobEntry]):
         with self._lock:
-            task = [t for t in self._running_tasks if t.name == name]
+            for job in jobs:
+                self._jobs[job.identifier] = self._jobs.get(job.identifier, 0) + len(job.tasks)
+                self._job_weights[job.identifier] = (job.priority, job.tenant)
+
+                for t in job.tasks:
+                    self._tasks.push(job.identifier,
+                                     TaskEntry(job.identifier, t['task_name'], t['task_args'], job.image, None, None,
+                                               t.get('resources'), t.get('constraints'), job.batch_size),
+                                     job.priority, job.tenant)
+
+    def recover(self, services: dict) -> int:
+        """ Rebuild the queue from the jobs stored in redis, after a restart
+        lost the state held in memory. Tasks that still have a service are
+        tracked as running again, the other unfinished tasks are queued and
+        jobs that had already finished are sent on for delivery.
+
+        Recovered jobs run at the default priority, without a tenant and
+        without batching, since those are not stored with the job.
+
+        :param services: A dict of (job identifier, task name) to the id of the service running it
+        :return: The number of jobs recovered
+        """
+        recovered = 0
+        for identifier in self._job_db.get_active_jobs():
+            with self._lock:
+                if identifier in self._jobs:
+                    continue
+
             try:
-                task_id = task[0]
-                self._job_db.update_result(identifier, name, result)
-                self._job_db.update_status(identifier, name, status)
-
-                # Remove this task from the running tasks
-                self._running_tasks = [t for t in self._running_tasks if t.name != name]
-
-                # Return the task id we had recorded and whether to start any more tasks which
-                # is based on whether we are already running at capacity and whether we have
-                # any more to run. We also use this time to empty out all 'dead' processes
-                task_list = [task_id]
-                while any(self._overdue_tasks):
-                    task_list.append(self._overdue_tasks.pop())
-
-                return task_list, len(self._running_tasks) < self._queue_len and any(self._tasks)
-            except IndexError:
-                self._logger.error(
-                    'Was expected to find task "{tn}" for job "{jn}" but it was not present'.format(tn=name,
-                                                                                                    jn=identifier))
+                details = self._job_db.get_job(identifier)
+                specs = self._job_db.get_task_specs(identifier)
+            except ValueError:
+                continue
+
+            pending = [t for t in details['tasks'] if t['status'] == JobDb.PENDING_STATUS]
+            self._logger.info('Recovering job {i} with {n} unfinished tasks'.format(i=identifier, n=len(pending)))
+            recovered += 1
+            with self._lock:
+                if not pending:
+                    self._completed_jobs.append(identifier)
+                    self._job_completed.notify()
+                    continue
+
+                self._jobs[identifier] = len(pending)
+                self._job_weights[identifier] = (None, None)
+                for task in pending:
+                    spec = specs.get(task['name'], {})
+                    entry = TaskEntry(identifier, task['name'], task['args'], details['__image'], None, None,
+                                      spec.get('resources'), spec.get('constraints'))
+                    service = services.get((identifier, task['name']))
+                    if service is None:
+                        self._tasks.push(identifier, entry)
+                    else:
+                        self._running_tasks[(identifier, task['name'])] = entry._replace(
+                            task_id=service, started=datetime.datetime.now())
+
+        self._signal_should_run()
+        return recovered
+
+    def complete_task(self, identifier, name, status, result) -> (List[int], bool):
+        # Duplicate and stale callbacks are turned away before anything is written
+        if not self.is_task_running(identifier, name):
+            self._logger.error(
+                'Was expected to find task "{tn}" for job "{jn}" but it was not present'.format(tn=name,
+                                                                                                jn=identifier))
+            return [], self._should_run()
+
+        # The results are stored before the task is released, so the job can
+        # never be picked up as completed before its last result is recorded.
+        # Only the first of two racing callbacks gets to store them, but a run
+        # whose task was already completed in the store still frees its slot.
+        if not self._job_db.complete_task(identifier, name, status, result):
+            self._logger.error('Task "{tn}" for job "{jn}" was already completed'.format(tn=name, jn=identifier))
+
+        with self._lock:
+            task = self._running_tasks.pop((identifier, name), None)
+            if task is None:
+                return [], self._should_run()
+
+            self._count_completed(identifier)
+
+            # Return the task id we had recorded and whether to start any more tasks which
+            # is based on whether we are already running at capacity and whether we have
+            # any more to run. We also use this time to empty out all 'dead' processes
+            task_list = [] if task.task_id is None else [task.task_id]
+            while any(self._overdue_tasks):
+                task_list.append(self._overdue_tasks.pop())
+
+            return task_list, self._should_run()
 
     def get_next_tasks(self) -> List[RunnableTask]:
-        """ Query the queue for the next tasks to run
+        """ Query the queue for the next tasks to run. Tasks are admitted in
+        turn while their reservations fit in the resource capacity, a task is
+        always admitted when nothing is running so large tasks can not stall
+        the queue.
 
         :return: A list of the next tasks to run
         """
         tasks = []
         with self._lock:
-            if len(self._running_tasks) >= self._queue_len or not any(self._tasks):
+            if len(self._running_tasks) >= self._queue_len or not self._tasks:
                 return tasks
 
+            reserved_cpus, reserved_memory = self._reserved_resources()
             for _ in range(self._queue_len - len(self._running_tasks)):
-                if not any(self._tasks):
+                if not self._tasks:
+                    break
+                cpus, memory = task_reservation(self._tasks.peek().resources)
+                if any(self._running_tasks) and not self._fits(reserved_cpus + cpus, reserved_memory + memory):
                     break
+                reserved_cpus, reserved_memory = reserved_cpus + cpus, reserved_memory + memory
+
                 next_task = self._tasks.pop()
-                tasks.append(RunnableTask(next_task.identifier, next_task.name, next_task.args, next_task.image))
-                self._running_tasks.append(next_task)
+                tasks.append(RunnableTask(next_task.identifier, next_task.name, next_task.args, next_task.image,
+                                          next_task.resources, next_task.constraints, next_task.batch_size))
+                self._running_tasks[(next_task.identifier, next_task.name)] = next_task
 
         return tasks
 
     def mark_task_started(self, identifier, name, task_id):
-        def set_details(entry: TaskEntry):
-            if entry.identifier != identifier or entry.name != name:
-                return entry
-            return TaskEntry(entry.identifier, entry.name, entry.args, entry.image, task_id, datetime.datetime.now())
-
         with self._lock:
-            self._running_tasks = list(map(set_details, self._running_tasks))
+            entry = self._running_tasks.get((identifier, name))
+            if entry is None:
+                return
+            self._running_tasks[(identifier, name)] = entry._replace(task_id=task_id,
+                                                                     started=datetime.datetime.now())
+        self._record_started(identifier, name, task_id)
+
+    def is_task_running(self, identifier, name, task_id=None) -> bool:
+        with self._lock:
+            entry = self._running_tasks.get((identifier, name))
+            return entry is not None and (task_id is None or entry.task_id == task_id)
 
     def get_started_tasks(self):
         with self._lock:
             return list(map(lambda it: {'id': it.task_id, 'started': it.started},
-                            filter(lambda it: it.task_id is not None and it.started is not None, self._running_tasks)))
+                            filter(lambda it: it.task_id is not None and it.started is not None,
+                                   self._running_tasks.values())))
 
-    def get_job_details(self, identifier):
-        job = self._job_db.get_job(identifier)
-        job['tasks'] = json.loads(job['tasks'])
-        return job
+    def is_healthy(self) -> bool:
+        """ Check whether the job store can be reached """
+        return self._job_db.ping()
 
-    def _scan_for_dead_jobs(self):
-        def item_filter(entry: TaskEntry):
-            return entry.task_id not in self._overdue_tasks
+    def append_task_output(self, identifier, name, stream, data) -> int:
+        return self._job_db.append_output(identifier, name, stream, data)
+
+    def read_task_output(self, identifier, name, stream):
+        return self._job_db.read_output(identifier, name, stream)
+
+    def get_job_details(self, identifier, fields=None):
+        return self._job_db.get_job(identifier, fields=fields)
+
+    def get_job_summary(self, identifier):
+        return self._job_db.get_summary(identifier)
+
+    def get_task_details(self, identifier, name):
+        return self._job_db.get_task(identifier, name)
+
+    def get_job_version(self, identifier) -> int:
+        return self._job_db.get_version(identifier)
+
+    def _record_started(self, identifier, name, task_id):
+        """ Store the service of a started task with the job, which also
+        counts the task as running in the job summary
+        """
+        try:
+            self._job_db.set_task_id(identifier, name, task_id)
+        except ValueError as ex:
+            self._logger.error('Unable to record the start of task "{tn}" for job "{jn}": {e}'.format(
+                tn=name, jn=identifier, e=ex))
+
+    def _count_completed(self, identifier):
+        remaining = self._jobs.get(identifier, 0) - 1
+        if remaining > 0:
+            self._jobs[identifier] = remaining
+            return
+
+        self._jobs.pop(identifier, None)
+        self._job_weights.pop(identifier, None)
+        self._completed_jobs.append(identifier)
+        self._job_completed.notify()
 
+    def _scan_for_dead_jobs(self):
         while True:
             time.sleep(self.DEAD_SCAN_INTERVAL)
             with self._lock:
-                overdue = [t for t in self._running_tasks if
-                           datetime.datetime.now() - t.started > self.DEAD_JOB_INTERVAL]
+                overdue = [t for t in self._running_tasks.values() if
+                           t.started is not None and datetime.datetime.now() - t.started > self.DEAD_JOB_INTERVAL]
                 for task in overdue:
+                    del self._running_tasks[(task.identifier, task.name)]
                     self._overdue_tasks.add(task.task_id)
-                    self._tasks.appendleft(TaskEntry(task.identifier, task.name, task.args, task.image, None, None))
-                self._running_tasks = list(filter(item_filter, self._running_tasks))
+                    self._tasks.push(task.identifier, task._replace(task_id=None, started=None),
+                                     *self._job_weights.get(task.identifier, (None, None)))
             self._signal_should_run()
 
-    def _scan_for_completed_jobs(self):
+    def _process_completed_jobs(self):
+        # Woken as soon as the last task of a job is completed
         while True:
-            time.sleep(self.COMPLETED_SCAN_INTERVAL)
             with self._lock:
-                job_details = []
-                completed = [jid for jid in self._jobs if
-                             not any([it for it in self._running_tasks if it.identifier == jid]) and not any(
-                                 [it for it in self._tasks if it.identifier == jid])]
-                for item in completed:
-                    self._jobs.remove(item)
-                    job_details.append(self._job_db.get_job(item))
-                    self._job_db.clear_job(item)
-
-            _send_job_results(job_details)
+                while not self._completed_jobs:
+                    self._job_completed.wait(self.COMPLETED_WAIT_TIMEOUT)
+                completed, self._completed_jobs = self._completed_jobs, []
+
+            job_details = []
+            for item in completed:
+                details = self._collect_completed_job(item)
+                if details is not None:
+                    job_details.append((item, details))
+
+            self._delivery.send(job_details)
             self._signal_should_run()
 
-    def _signal_should_run(self):
-        if self._run_signal and len(self._running_tasks) < self._queue_len and any(self._tasks):
-            self._run_signal()
+    def _collect_completed_job(self, identifier):
+        """ Read a completed job for delivery, which clears the job once its
+        results were sent. A job that can't be read, for example because it
+        expired, is stored as a dead letter rather than stopping the delivery
+        of every job after it.
+
+        :returns: The job details, or None if the job could not be read
+        """
+        try:
+            return self._job_db.get_job(identifier)
+        except Exception as ex:
+            self._logger.error('Unable to collect the results of job "{jn}": {e}'.format(jn=identifier, e=ex))
+            try:
+                self._job_db.add_dead_letter(identifier, None, str(ex))
+            except Exception as dead_ex:
+                self._logger.error('Unable to store a dead letter for job "{jn}": {e}'.format(jn=identifier,
+                                                                                             e=dead_ex))
+            return None
+
+    def _reserved_resources(self):
+        reservations = [task_reservation(t.resources) for t in self._running_tasks.values()]
+        return sum(r[0] for r in reservations), sum(r[1] for r in reservations)
 
+    def _fits(self, cpus, memory):
+        if self._resource_capacity is None:
+            return True
+        capacity_cpus, capacity_memory = self._resource_capacity
+        return cpus <= capacity_cpus and memory <= capacity_memory
 
-def _send_job_results(details):
-    if not any(details):
-        return
+    def _should_run(self):
+        return len(self._running_tasks) < self._queue_len and bool(self._tasks)
+
+    def _signal_should_run(self):
+        if self._run_signal and self._should_run():
+            self._run_signal()
 
-    for det in details:
-        requests.post(det['__callback'], json=det)
@@ -1,28 +1,96 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, Thread
 
 import ulid
 
+from db import JobDb
+from jobs.links import OutputLinks
+from jobs.notifier import StatusNotifier
+from jobs.pool import WorkerPool
 from jobs.queue import JobQueue
+from jobs.scheduler import Scheduler
+from jobs.warmer import ImageWarmer
 from log import LogManager
+from models import JobEntry
 from wrapper import DockerWrapper
 
 
 class JobRunner:
-    def __init__(self, client: DockerWrapper, job_queue: JobQueue):
+    # The status recorded for a task whose service could not be created, the
+    # same status docker run exits with when the daemon fails to run a container
+    START_FAILED_STATUS = 125
+
+    # The status recorded for a task whose container ran out of memory
+    OOM_KILLED_STATUS = 137
+
+    # The status recorded for a task whose container exited cleanly without reporting results
+    NO_RESULTS_STATUS = 1
+
+    def __init__(self, client: DockerWrapper, job_queue: JobQueue, dispatch_workers=8,
+                 executor_builder=ThreadPoolExecutor, thread_builder=Thread, prune_interval=0,
+                 pool: WorkerPool = None, warmer: ImageWarmer = None, links: OutputLinks = None,
+                 notifier: StatusNotifier = None):
         self._docker = client
         self._job_queue = job_queue
+        # When set, tasks are handed to long lived workers instead of getting their own service
+        self._pool = pool
+        # When set, the images of new jobs are pulled onto the nodes while they wait in the queue
+        self._warmer = warmer
+        # When set, the output references in job details are turned into links
+        self._links = links
+        # When set, watchers of a job are woken as soon as it changes, otherwise they only see changes on a timeout
+        self._notifier = notifier
+        self._dispatch_executor = executor_builder(max_workers=dispatch_workers)
+        self._removal_lock = Lock()
+        self._pending_removals = []
+        # All docker work happens on the scheduler thread, requests only wake it
+        self._scheduler = Scheduler(self._dispatch, thread_builder=thread_builder)
+        # Periodically reclaim finished services that were never removed
+        self._pruner = Scheduler(client.prune_services, thread_builder=thread_builder,
+                                 interval=prune_interval) if prune_interval else None
         # Not sure I'm a fan of this, probably need another refactor in the future
-        job_queue.run_signal = self._run_tasks
+        job_queue.run_signal = self._scheduler.wake
         self._logger = LogManager(__name__)
 
-    def create_new_job(self, image_name, callback, tasks):
+    def create_new_job(self, image_name, callback, tasks, priority=None, tenant=None, batch_size=None):
         self._log_operation('Creating new job with image {img} and callback {cb}'.format(img=image_name, cb=callback))
 
         identifier = ulid.new().str
-        self._job_queue.add_new_job(identifier, image_name, callback, tasks)
-        self._run_tasks()
+        self._job_queue.add_new_job(identifier, image_name, callback, tasks, priority=priority, tenant=tenant,
+                                    batch_size=batch_size)
+        self._warm_images([image_name])
+        self._scheduler.wake()
         return identifier
 
+    def create_new_jobs(self, jobs):
+        """ Create several jobs at once, storing them all in one batch
+
+        :param jobs: An iterable of (image_name, callback, tasks, priority, tenant, batch_size) tuples,
+                     the priority, tenant and batch size may be left off
+        :return: The unique identifiers of the new jobs, in the same order
+        """
+        entries = [JobEntry(ulid.new().str, *job) for job in jobs]
+        self._log_operation('Creating {n} new jobs'.format(n=len(entries)))
+
+        self._job_queue.add_new_jobs(entries)
+        self._warm_images(e.image for e in entries)
+        self._scheduler.wake()
+        return [e.identifier for e in entries]
+
+    def recover(self):
+        """ Pick up the jobs that were in flight when swarmer last stopped,
+        matching their tasks against the services still running them
+
+        :return: The number of jobs recovered
+        """
+        recovered = self._job_queue.recover(self._docker.task_services())
+        self._log_operation('Recovered {n} jobs'.format(n=recovered))
+        if recovered:
+            self._scheduler.wake()
+        return recovered
+
     def complete_task(self, identifier: str, task_name: str, status: int, result: dict):
         """ Signal that a task run has been completed
 
@@ -31,31 +99,360 @@ class JobRunner:
         :param status: The exit status of the task
         :param result: The output from the task as a dict with 'stdout' and 'stderr' fields where appropriate
         """
-        self._log_operation(
-            'Completing task {tn} in job {i} with status {s} and result:\n{r}'.format(tn=task_name, i=identifier,
-                                                                                      s=status, r=json.dumps(result)))
+        self._log_operation('Completing task {tn} in job {i} with status {s}'.format(tn=task_name, i=identifier,
+                                                                                    s=status))
         services, run_more = self._job_queue.complete_task(identifier, task_name, status, result)
+        self._finish_pool_task(identifier, task_name)
 
-        self._docker.remove_service(services)
+        self._queue_removal(services)
 
-        if run_more:
-            self._run_tasks()
+        if run_more or any(services):
+            self._scheduler.wake()
 
-    def get_job(self, identifier: str):
+    def complete_tasks(self, identifier: str, results):
+        """ Signal that several tasks of a job, usually run together in one
+        batch, have been completed
+
+        :param identifier: The unique job identifier
+        :param results: An iterable of (task name, status, result) tuples
+        """
+        services, run_more = [], False
+        for task_name, status, result in results:
+            self._log_operation('Completing task {tn} in job {i} with status {s}'.format(tn=task_name, i=identifier,
+                                                                                        s=status))
+            task_services, task_run_more = self._job_queue.complete_task(identifier, task_name, status, result)
+            self._finish_pool_task(identifier, task_name)
+            services.extend(s for s in task_services if s not in services)
+            run_more = run_more or task_run_more
+
+        self._queue_removal(services)
+
+        if run_more or any(services):
+            self._scheduler.wake()
+
+    def handle_task_exit(self, identifier: str, task_name: str, exit_code: int, oom_killed: bool,
+                         service_id: str = None):
+        """ Handle the container of a task having exited. If the task never
+        reported its results, it is completed as failed to free its slot.
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the individual task
+        :param exit_code: The exit code of the task container
+        :param oom_killed: Whether the container was killed for running out of memory
+        :param service_id: The service the container belonged to, exits from a service
+                           other than the one now running the task are from an earlier
+                           run and are ignored
+        """
+        if not self._job_queue.is_task_running(identifier, task_name, task_id=service_id):
+            return
+
+        if oom_killed:
+            status = self.OOM_KILLED_STATUS
+            message = 'The task container was killed after running out of memory'
+        else:
+            # A container that exits cleanly without reporting still failed the task
+            status = exit_code or self.NO_RESULTS_STATUS
+            message = 'The task container exited with code {c} without reporting results'.format(c=exit_code)
+
+        self._logger.error('JobRunner: Task {tn} in job {i} failed: {m}'.format(tn=task_name, i=identifier,
+                                                                               m=message))
+        self.complete_task(identifier, task_name, status, {'stdout': None, 'stderr': message})
+
+    def next_pool_task(self, pool_id: str):
+        """ Take the next task for a worker of a pool
+
+        :param pool_id: The identifier of the pool
+        :return: The task details, or None if there are none
+        """
+        if self._pool is None:
+            return None
+        return self._pool.next_task(pool_id)
+
+    def is_healthy(self) -> bool:
+        """ Check whether the runner can reach the services it depends on
+
+        :return: True if the job store can be reached
+        """
+        return self._job_queue.is_healthy()
+
+    def get_job(self, identifier: str, fields=None):
         """ Retrieve details about a given job
 
         :param identifier: The unique job identifier
+        :param fields: The names of the task fields to include, all of them when None
         :return: The job details, if it exists
         """
         self._log_operation('Getting job {i}'.format(i=identifier))
-        return self._job_queue.get_job_details(identifier)
+        details = self._job_queue.get_job_details(identifier, fields=fields)
+        return details if self._links is None else self._links.resolve(details)
+
+    def get_job_summary(self, identifier: str):
+        """ Retrieve the task counts of a job and how long it has been running,
+        without reading any of its tasks
+
+        :param identifier: The unique job identifier
+        :return: The job summary, with the seconds between the job being created
+                 and its last task completing, or now, under 'elapsed'
+        """
+        self._log_operation('Getting summary of job {i}'.format(i=identifier))
+        summary = self._job_queue.get_job_summary(identifier)
+        try:
+            created = ulid.from_str(identifier).timestamp().timestamp
+        except ValueError:
+            created = None
+        finished = summary.get(JobDb.FINISHED_AT_FIELD)
+        summary['elapsed'] = None if created is None else round((finished or time.time()) - created, 3)
+        return summary
+
+    def watch_job(self, identifier: str, since: int = None, timeout=30, full=False):
+        """ Wait for a job to change, for clients long polling its status
+
+        :param identifier: The unique job identifier
+        :param since: The version of the job the caller has seen, None to get the details right away
+        :param timeout: The most seconds to wait for a change
+        :param full: Whether a change should return every task rather than only the ones that changed
+        :return: The job details if the caller is behind, the job summary with the
+                 tasks that changed once its version is past since, or None if the
+                 timeout passed first
+        """
+        seen = self._watch(identifier)
+        try:
+            summary = self._job_queue.get_job_summary(identifier)
+            if since is None or summary[JobDb.VERSION_FIELD] > since:
+                return self.get_job(identifier)
+            changed = self._wait(identifier, seen, timeout)
+            if changed is None:
+                if self._job_queue.get_job_version(identifier) <= since:
+                    return None
+                return self.get_job(identifier)
+            return self._get_changes(identifier, self._changed_tasks(identifier, seen), full)
+        finally:
+            self._unwatch(identifier)
+
+    def follow_job(self, identifier: str, since: int = None, keepalive=15, duration=3600, full=False):
+        """ Follow the changes to a job, for clients streaming its status.
+        The job is looked up right away, so a missing job raises here rather
+        than once the stream has started.
+
+        :param identifier: The unique job identifier
+        :param since: The version of the job the caller has seen, None to start with the current details
+        :param keepalive: The most seconds to go without yielding
+        :param duration: The seconds after which to stop following the job
+        :param full: Whether each change should carry every task rather than only the ones that changed
+        :return: A generator of the job details to start with if the caller is
+                 behind, then the job summary with the tasks that changed each
+                 time it changes, or None when nothing changed for keepalive
+                 seconds. It ends once every task has finished, the job is gone
+                 or the duration has passed.
+        """
+        seen = self._watch(identifier)
+        try:
+            details = self._job_queue.get_job_summary(identifier)
+            if since is None or details[JobDb.VERSION_FIELD] > since:
+                details = self.get_job(identifier)
+        except Exception:
+            self._unwatch(identifier)
+            raise
+
+        def changes(details, since, seen):
+            deadline = time.monotonic() + duration
+            try:
+                while True:
+                    if 'tasks' in details:
+                        since = details.get(JobDb.VERSION_FIELD, 0)
+                        yield details
+                    if _is_finished(details):
+                        return
+
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return
+                        changed = self._wait(identifier, seen, min(keepalive, remaining))
+                        try:
+                            if changed is not None:
+                                details = self._get_changes(identifier, self._changed_tasks(identifier, seen), full)
+                                seen = changed
+                                break
+                            # Changes published while the notifier was reconnecting are caught here
+                            if self._job_queue.get_job_version(identifier) > since:
+                                details = self.get_job(identifier)
+                                break
+                        except ValueError:
+                            return
+                        yield None
+            finally:
+                self._unwatch(identifier)
+
+        return changes(details, since, seen)
+
+    def append_task_output(self, identifier: str, task_name: str, stream: str, data: bytes) -> int:
+        """ Append to the output of a task, stored apart from its result
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the individual task
+        :param stream: Either stdout or stderr
+        :param data: The output to append
+        :return: The size of the stored output
+        """
+        return self._job_queue.append_task_output(identifier, task_name, stream, data)
+
+    def read_task_output(self, identifier: str, task_name: str, stream: str):
+        """ Read the stored output of a task
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the individual task
+        :param stream: Either stdout or stderr
+        :return: A generator of the output in chunks
+        """
+        return self._job_queue.read_task_output(identifier, task_name, stream)
+
+    def can_read_output(self, path: str, expires, signature) -> bool:
+        """ Check whether a request for stored output carries a valid link signature
+
+        :param path: The path that was requested
+        :param expires: The expires parameter of the request
+        :param signature: The signature parameter of the request
+        """
+        return self._links is None or self._links.verify(path, expires, signature)
+
+    def _dispatch(self):
+        """ Remove the services of finished tasks and start the next tasks,
+        this only ever runs on the scheduler thread
+        """
+        with self._removal_lock:
+            services, self._pending_removals = self._pending_removals, []
+        if any(services):
+            self._docker.remove_service(services)
+
+        self._run_tasks()
+
+    def _watch(self, identifier):
+        return 0 if self._notifier is None else self._notifier.watch(identifier)
+
+    def _unwatch(self, identifier):
+        if self._notifier is not None:
+            self._notifier.unwatch(identifier)
+
+    def _wait(self, identifier, seen, timeout):
+        if self._notifier is None:
+            time.sleep(timeout)
+            return None
+        return self._notifier.wait(identifier, seen, timeout)
+
+    def _changed_tasks(self, identifier, seen):
+        return None if self._notifier is None else self._notifier.changed_tasks(identifier, seen)
+
+    def _get_changes(self, identifier, names, full):
+        """ Read only the tasks that changed along with the job summary, rather
+        than every task of the job, unless the whole job is asked for or it is
+        not known which tasks changed
+        """
+        if full or names is None:
+            return self.get_job(identifier)
+        details = self._job_queue.get_job_summary(identifier)
+        details['tasks'] = [self._job_queue.get_task_details(identifier, name) for name in sorted(names)]
+        return details if self._links is None else self._links.resolve(details)
+
+    def _finish_pool_task(self, identifier, task_name):
+        if self._pool is not None:
+            self._pool.finish_task(identifier, task_name)
+
+    def _warm_images(self, images):
+        if self._warmer is None:
+            return
+        for image in set(images):
+            self._warmer.warm(image)
+
+    def _queue_removal(self, services):
+        with self._removal_lock:
+            self._pending_removals.extend(services)
 
     def _run_tasks(self):
-        """ Query the job queue for more jobs to run """
+        """ Query the job queue for more jobs to run, and start their services
+        concurrently. A task that can not be started, for whatever reason, is
+        completed as failed so that it does not hold on to its slot.
+        """
         next_tasks = self._job_queue.get_next_tasks()
-        for task in next_tasks:
-            sid = self._docker.start_task(task.identifier, task.image, task.name, task.args)
-            self._job_queue.mark_task_started(task.identifier, task.name, sid)
+        started = {self._dispatch_executor.submit(self._start_batch, batch): batch
+                   for batch in self._group_batches(next_tasks)}
+        for future in as_completed(started):
+            batch = started[future]
+            try:
+                sid = future.result()
+            except Exception as ex:
+                for task in batch:
+                    self._fail_task_start(task, ex)
+                continue
+            for task in batch:
+                self._job_queue.mark_task_started(task.identifier, task.name, sid)
+
+    def _group_batches(self, tasks):
+        """ Group the tasks of jobs submitted with a batch size into batches
+        that run in one service, tasks are only batched together when they
+        request the same resources and constraints
+        """
+        batches = []
+        open_batches = {}
+        for task in tasks:
+            if not task.batch_size or task.batch_size <= 1:
+                batches.append([task])
+                continue
+
+            key = (task.identifier, json.dumps(task.resources, sort_keys=True), json.dumps(task.constraints))
+            batch = open_batches.get(key)
+            if batch is None or len(batch) >= task.batch_size:
+                batch = open_batches[key] = []
+                batches.append(batch)
+            batch.append(task)
+        return batches
+
+    def _start_batch(self, batch):
+        if len(batch) > 1:
+            first = batch[0]
+            return self._docker.start_batch(first.identifier, first.image,
+                                            [{'task_name': t.name, 'task_args': t.args} for t in batch],
+                                            resources=first.resources, constraints=first.constraints)
+
+        task = batch[0]
+        if self._is_pooled(task):
+            # Pooled tasks have no service of their own to remove once they complete
+            self._pool.submit(task)
+            return None
+        return self._docker.start_task(task.identifier, task.image, task.name, task.args, resources=task.resources,
+                                       constraints=task.constraints)
+
+    def _is_pooled(self, task):
+        """ Check whether a task runs on the worker pool. Tasks that request
+        resources or constraints, or are batched, get a service of their own,
+        since pool workers are shared and run a single task at a time.
+        """
+        return (self._pool is not None and not task.resources and not task.constraints
+                and (not task.batch_size or task.batch_size <= 1))
+
+    def _fail_task_start(self, task, error):
+        self._logger.error('JobRunner: Unable to start task {tn} for job {i}: {e}'.format(tn=task.name,
+                                                                                         i=task.identifier, e=error))
+        try:
+            services, _ = self._job_queue.complete_task(
+                task.identifier, task.name, self.START_FAILED_STATUS,
+                {'stdout': None, 'stderr': 'Unable to start the task service: {e}'.format(e=error)})
+        except Exception as ex:
+            self._logger.error('JobRunner: Unable to fail task {tn} for job {i}: {e}'.format(tn=task.name,
+                                                                                            i=task.identifier, e=ex))
+            return
+        self._queue_removal(services)
+        self._scheduler.wake()
 
     def _log_operation(self, message):
         self._logger.info('JobRunner: {msg}'.format(msg=message))
+
+
+def _is_finished(details):
+    """ Check whether every task of a job has finished, from either its
+    summary or its details
+    """
+    counts = details.get('counts')
+    if counts is not None:
+        return counts['complete'] >= counts['total']
+    return all(t['status'] != JobDb.PENDING_STATUS for t in details['tasks'])
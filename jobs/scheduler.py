@@ -0,0 +1,41 @@
+from threading import Event, Thread
+
+from log import LogManager
+
+
+class Scheduler:
+    """ The Scheduler owns a single background thread that runs the dispatch
+    function whenever it is woken. Callers only signal that there may be work
+    to do and return right away, they never wait on the dispatch itself.
+    """
+
+    # Dispatch runs at least this often even if nothing wakes the scheduler, so
+    # work queued by other swarmer processes is still picked up
+    IDLE_INTERVAL = 30
+
+    def __init__(self, dispatch, thread_builder=Thread, interval=None):
+        self._dispatch = dispatch
+        self._interval = self.IDLE_INTERVAL if interval is None else interval
+        self._logger = LogManager(__name__)
+        self._wake_event = Event()
+        self._thread = thread_builder(target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """ Signal the scheduler that there may be tasks to dispatch """
+        self._wake_event.set()
+
+    def run_once(self):
+        """ Run a single dispatch pass on the calling thread """
+        # Cleared before dispatching, so a wake during the pass triggers another one
+        self._wake_event.clear()
+        try:
+            self._dispatch()
+        except Exception as ex:
+            self._logger.error('Scheduler: Dispatch failed: {e}'.format(e=ex))
+
+    def _run(self):
+        while True:
+            self._wake_event.wait(self._interval)
+            self.run_once()
@@ -0,0 +1,112 @@
+import os
+import time
+from threading import Lock, Thread
+
+from docker.errors import DockerException
+from requests import RequestException
+
+from jobs.scheduler import Scheduler
+from log import LogManager
+from wrapper import DockerWrapper
+
+
+class ImageWarmer:
+    """ The ImageWarmer pulls the image of a new job onto every node of the
+    swarm while the job waits in the queue, so its first tasks start as quickly
+    as the ones after them. Images that were pulled are remembered for a while
+    and not pulled again, after that they are pulled again to cover nodes that
+    joined the swarm since.
+    """
+
+    # Seconds between checks on the running pulls
+    CHECK_INTERVAL = 5
+
+    def __init__(self, client: DockerWrapper, warm_ttl=3600, pull_timeout=600, thread_builder=Thread):
+        self._client = client
+        self._warm_ttl = warm_ttl
+        self._pull_timeout = pull_timeout
+        self._logger = LogManager(__name__)
+        self._lock = Lock()
+        # Image to the time its pull finished
+        self._warm = {}
+        # Images waiting for their pull to be started
+        self._wanted = set()
+        # Image to the (service id, deadline) of its running pull
+        self._pulling = {}
+        # All docker work happens on this thread, warm only wakes it
+        self._worker = Scheduler(self._run, thread_builder=thread_builder, interval=self.CHECK_INTERVAL)
+
+    @classmethod
+    def from_environ(cls, client: DockerWrapper):
+        """ Create a new ImageWarmer configured by the optional environment
+        variables SWARMER_PREPULL_TTL and SWARMER_PREPULL_TIMEOUT
+        """
+        return cls(client,
+                   warm_ttl=int(os.environ.get('SWARMER_PREPULL_TTL', '3600')),
+                   pull_timeout=int(os.environ.get('SWARMER_PREPULL_TIMEOUT', '600')))
+
+    def is_warm(self, image: str) -> bool:
+        """ Check whether an image was pulled onto the nodes recently """
+        with self._lock:
+            return self._is_warm(image)
+
+    def warm(self, image: str):
+        """ Ask for an image to be pulled onto the nodes, unless it is already
+        there or being pulled. The pull is started on the background thread, so
+        this returns right away. Failures are logged, the tasks then pull the
+        image themselves as they would without the warmer.
+
+        :param image: The image to pull
+        """
+        with self._lock:
+            if self._is_warm(image) or image in self._pulling or image in self._wanted:
+                return
+            self._wanted.add(image)
+        self._worker.wake()
+
+    def _is_warm(self, image):
+        pulled = self._warm.get(image)
+        return pulled is not None and time.monotonic() - pulled < self._warm_ttl
+
+    def _run(self):
+        """ Start the wanted pulls and finish the ones that are done, this only
+        ever runs on the background thread
+        """
+        with self._lock:
+            wanted = list(self._wanted)
+        for image in wanted:
+            self._start_pull(image)
+
+        with self._lock:
+            pulling = list(self._pulling.items())
+        done = []
+        for image, (sid, deadline) in pulling:
+            if self._client.service_finished(sid):
+                self._logger.info('ImageWarmer: Image {img} is on the swarm nodes'.format(img=image))
+                done.append((image, sid, True))
+            elif time.monotonic() > deadline:
+                self._logger.error('ImageWarmer: Gave up waiting for image {img} to be pulled'.format(img=image))
+                done.append((image, sid, False))
+
+        if not done:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for image, _, pulled in done:
+                del self._pulling[image]
+                if pulled:
+                    self._warm[image] = now
+        self._client.remove_service([sid for _, sid, _ in done])
+
+    def _start_pull(self, image):
+        try:
+            service_id = self._client.prepull_image(image)
+        except (DockerException, RequestException) as ex:
+            self._logger.error('ImageWarmer: Unable to pull image {img}: {e}'.format(img=image, e=ex))
+            service_id = None
+
+        with self._lock:
+            self._wanted.discard(image)
+            if service_id is not None:
+                self._pulling[image] = (service_id, time.monotonic() + self._pull_timeout)
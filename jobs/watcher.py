@@ -0,0 +1,91 @@
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from docker.errors import DockerException
+from requests import RequestException
+
+from jobs.scheduler import Scheduler
+from log import LogManager
+from wrapper import DockerWrapper
+
+
+class TaskExitWatcher:
+    """ The TaskExitWatcher follows the docker event stream for task
+    containers that exit, and periodically lists the task states across the
+    swarm to catch exits on other nodes. Every exit is handed to on_exit after
+    a grace period, which gives the task time to report its own results first.
+    """
+
+    # Seconds a task has after its container exits to report its results
+    GRACE_PERIOD = 10
+
+    # Seconds between listings of the task states across the swarm
+    POLL_INTERVAL = 30
+
+    # Seconds to wait before reconnecting to a broken event stream
+    RECONNECT_DELAY = 5
+
+    def __init__(self, client: DockerWrapper, on_exit, thread_builder=Thread, grace_period=None,
+                 poll_interval=None):
+        self._client = client
+        self._on_exit = on_exit
+        self._grace_period = self.GRACE_PERIOD if grace_period is None else grace_period
+        self._logger = LogManager(__name__)
+        self._exits = deque()
+        self._exit_added = Condition()
+        self._event_thread = thread_builder(target=self._watch_events, args=())
+        self._event_thread.daemon = True
+        self._event_thread.start()
+        self._exit_thread = thread_builder(target=self._process_exits, args=())
+        self._exit_thread.daemon = True
+        self._exit_thread.start()
+        self._poller = Scheduler(self._poll_finished_tasks, thread_builder=thread_builder,
+                                 interval=self.POLL_INTERVAL if poll_interval is None else poll_interval)
+
+    def add_exit(self, identifier, task_name, exit_code, oom_killed, service_id=None):
+        """ Record that the container of a task has exited
+
+        :param identifier: The unique job identifier
+        :param task_name: The name of the task
+        :param exit_code: The exit code of the container
+        :param oom_killed: Whether the container was killed for running out of memory
+        :param service_id: The id of the service the container belonged to, if known
+        """
+        if identifier is None or task_name is None:
+            return
+
+        with self._exit_added:
+            self._exits.append((time.monotonic() + self._grace_period,
+                                (identifier, task_name, exit_code, oom_killed, service_id)))
+            self._exit_added.notify()
+
+    def _watch_events(self):
+        while True:
+            try:
+                for task_exit in self._client.task_exits():
+                    self.add_exit(*task_exit)
+            except (DockerException, RequestException) as ex:
+                self._logger.error('TaskExitWatcher: Event stream failed: {e}'.format(e=ex))
+            time.sleep(self.RECONNECT_DELAY)
+
+    def _poll_finished_tasks(self):
+        for task_exit in self._client.finished_tasks():
+            self.add_exit(*task_exit)
+
+    def _process_exits(self):
+        while True:
+            with self._exit_added:
+                while not self._exits:
+                    self._exit_added.wait()
+                deadline, task_exit = self._exits[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._exit_added.wait(delay)
+                    continue
+                self._exits.popleft()
+
+            try:
+                self._on_exit(*task_exit)
+            except Exception as ex:
+                self._logger.error('TaskExitWatcher: Unable to handle task exit: {e}'.format(e=ex))
@@ -2,5 +2,29 @@ from collections import namedtuple
 
 from .runner_cfg import RunnerConfig
 
-TaskEntry = namedtuple('TaskEntry', ['identifier', 'name', 'args', 'image', 'task_id', 'started'])
-RunnableTask = namedtuple('RunnableTask', ['identifier', 'name', 'args', 'image'])
+TaskEntry = namedtuple('TaskEntry', ['identifier', 'name', 'args', 'image', 'task_id', 'started', 'resources',
+                                     'constraints', 'batch_size'])
+TaskEntry.__new__.__defaults__ = (None, None, None)
+JobEntry = namedtuple('JobEntry', ['identifier', 'image', 'callback', 'tasks', 'priority', 'tenant', 'batch_size'])
+JobEntry.__new__.__defaults__ = (None, None, None)
+RunnableTask = namedtuple('RunnableTask', ['identifier', 'name', 'args', 'image', 'resources', 'constraints',
+                                           'batch_size'])
+RunnableTask.__new__.__defaults__ = (None, None, None)
+
+# The priority of jobs submitted without one
+DEFAULT_PRIORITY = 1
+
+
+def job_tenant(identifier, tenant) -> str:
+    """ Get the key a job is scheduled under, jobs without a tenant count as a tenant of their own """
+    return 'tenant:{t}'.format(t=tenant) if tenant else 'job:{i}'.format(i=identifier)
+
+
+def task_reservation(resources) -> (float, int):
+    """ Get the cpus and bytes of memory reserved by a task
+
+    :param resources: The resources requested by the task, if any
+    :returns: A (cpus, memory bytes) tuple
+    """
+    resources = resources or {}
+    return resources.get('cpu_reservation') or 0, resources.get('mem_reservation') or 0
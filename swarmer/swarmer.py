@@ -2,7 +2,7 @@ import os
 
 import falcon
 
-from api import add_api_routes
+from api import CompressionMiddleware, add_api_routes
 
 
 def _create_wrapper():
@@ -13,30 +13,82 @@ def _create_wrapper():
     from auth.authfactory import AuthenticationFactory
 
     socket_path = os.environ.get('DOCKER_SOCKET_PATH', 'unix://var/run/docker.sock')
-    return DockerWrapper(DockerClient(base_url=socket_path), RunnerConfig.from_environ(), AuthenticationFactory())
+    client = DockerClient(base_url=socket_path)
+    authenticator = AuthenticationFactory()
+    authenticator.start_refresher(client)
+    return DockerWrapper(client, RunnerConfig.from_environ(), authenticator)
 
 
-def _create_queue():
-    """ Creates the job queue """
-    from redis import StrictRedis
-    from db import JobDb
-    redis_host = os.environ['REDIS_TARGET']
-    redis_port = os.environ['REDIS_PORT']
+def _create_store():
+    """ Creates the redis client """
+    from db import RedisConfig
+    return RedisConfig.from_environ().create_client()
+
+
+def _create_queue(store, job_log):
+    """ Creates the job queue, either held in process memory or, when
+    SWARMER_QUEUE_MODE is set to 'redis', shared between all workers
+    through redis
+    """
+    sweep_interval = int(os.environ.get('SWARMER_SWEEP_INTERVAL', '3600'))
 
-    store = StrictRedis(host=redis_host, port=redis_port)
-    job_log = JobDb(store)
+    from jobs.delivery import ResultDelivery
+    delivery = ResultDelivery.from_environ(job_log)
+
+    if os.environ.get('SWARMER_QUEUE_MODE', 'local').lower() == 'redis':
+        from db import QueueDb
+        from jobs.distributed_queue import DistributedJobQueue
+        return DistributedJobQueue(job_log, QueueDb(store), delivery=delivery, sweep_interval=sweep_interval)
 
     from jobs.queue import JobQueue
-    return JobQueue(job_log)
+    return JobQueue(job_log, delivery=delivery, sweep_interval=sweep_interval)
 
 
 def build_runner():
     from jobs import JobRunner
-    return JobRunner(_create_wrapper(), _create_queue())
+    wrapper = _create_wrapper()
+    store = _create_store()
+    from db import JobDb
+    job_log = JobDb.from_environ(store)
+    if os.environ.get('SWARMER_MIGRATE_LEGACY_JOBS', 'false').lower() in ['yes', 'y', 'true', 't', '1']:
+        job_log.migrate_legacy_jobs()
+    job_queue = _create_queue(store, job_log)
+
+    pool = None
+    if os.environ.get('SWARMER_WORKER_POOL', 'false').lower() in ['yes', 'y', 'true', 't', '1']:
+        from db import PoolDb
+        from jobs.pool import WorkerPool
+        pool = WorkerPool.from_environ(wrapper, PoolDb(store))
+
+    warmer = None
+    if os.environ.get('SWARMER_PREPULL_IMAGES', 'false').lower() in ['yes', 'y', 'true', 't', '1']:
+        from jobs.warmer import ImageWarmer
+        warmer = ImageWarmer.from_environ(wrapper)
+
+    from jobs.links import OutputLinks
+    from jobs.notifier import StatusNotifier
+    runner = JobRunner(wrapper, job_queue,
+                       dispatch_workers=int(os.environ.get('SWARMER_DISPATCH_WORKERS', '8')),
+                       prune_interval=int(os.environ.get('SWARMER_PRUNE_INTERVAL', '600')),
+                       pool=pool, warmer=warmer, links=OutputLinks.from_environ(),
+                       notifier=StatusNotifier(job_log))
+
+    if os.environ.get('SWARMER_RECOVER_JOBS', 'true').lower() in ['yes', 'y', 'true', 't', '1']:
+        runner.recover()
+
+    if os.environ.get('SWARMER_WATCH_TASKS', 'true').lower() in ['yes', 'y', 'true', 't', '1']:
+        from jobs.watcher import TaskExitWatcher
+        TaskExitWatcher(wrapper, runner.handle_task_exit)
+
+    if os.environ.get('SWARMER_ADAPTIVE_CONCURRENCY', 'false').lower() in ['yes', 'y', 'true', 't', '1']:
+        from jobs.capacity import CapacityMonitor
+        CapacityMonitor.from_environ(wrapper, job_queue)
+
+    return runner
 
 
 def build_application(runner_fn=None):
-    application = falcon.API()
+    application = falcon.API(middleware=[CompressionMiddleware.from_environ()])
     runner = build_runner() if runner_fn is None else runner_fn()
     add_api_routes(application, runner)
     return application
@@ -44,4 +96,5 @@ def build_application(runner_fn=None):
 
 def main():
     os.execvp('gunicorn', ('gunicorn', '-b', '0.0.0.0:{port}'.format(port=os.environ.get('SWARMER_PORT', '8500')),
+                           '--threads', os.environ.get('SWARMER_API_THREADS', '32'),
                            '--log-level', 'INFO', 'swarmer.swarmer:build_application()'))
@@ -6,6 +6,7 @@ docker run --rm --name test-redis -p 6379:6379 -d redis:5
 When running, set the TEST_INCLUDE_REDIS environment variable
 """
 
+import json
 import os
 
 import pytest
@@ -28,7 +29,7 @@ class TestLiveJobLog:
         actual = TestLiveJobLog.job_log.get_job(job_key)
         assert actual == {'__image': 'an_image',
                           '__callback': 'www.example.com',
-                          'tasks': '[]'}
+                          'tasks': []}
         TestLiveJobLog.job_log.clear_job(job_key)
         with pytest.raises(ValueError):
             TestLiveJobLog.job_log.get_job(job_key) is None
@@ -40,9 +41,12 @@ class TestLiveJobLog:
                  {'task_name': 'second', 'task_args': [3, 4, 5]}]
         TestLiveJobLog.job_log.add_tasks(job_key, tasks)
         actual = TestLiveJobLog.job_log.get_job(job_key)
-        assert actual == {'__callback': 'www.example.com', '__image': 'an_image', '__task_count_complete': '0',
-                          '__task_count_started': '0', '__task_count_total': '2',
-                          'tasks': '[{"args": [1, 2, 3], "status": 500, "result": {"stdout": null, "stderr": null}, "name": "first"}, {"args": [3, 4, 5], "status": 500, "result": {"stdout": null, "stderr": null}, "name": "second"}]'}
+        assert actual == {'__callback': 'www.example.com', '__image': 'an_image', '__task_count_complete': 0,
+                          '__task_count_started': 0, '__task_count_total': 2, '__task_count_failed': 0,
+                          'tasks': [{'args': [1, 2, 3], 'status': 500, 'result': {'stdout': None, 'stderr': None},
+                                     'name': 'first'},
+                                    {'args': [3, 4, 5], 'status': 500, 'result': {'stdout': None, 'stderr': None},
+                                     'name': 'second'}]}
         TestLiveJobLog.job_log.clear_job(job_key)
         with pytest.raises(ValueError):
             TestLiveJobLog.job_log.get_job(job_key) is None
@@ -90,3 +94,81 @@ class TestLiveJobLog:
         incremented = int(TestLiveJobLog.job_log.get_task_count(
             job_key, name))
         assert incremented == expected
+
+    def test_summary_counts_running_tasks(self):
+        job_key = ulid.new().str
+        TestLiveJobLog.job_log.add_job(job_key, 'an_image', 'www.example.com')
+        TestLiveJobLog.job_log.add_tasks(job_key, [{'task_name': 'first', 'task_args': []},
+                                                   {'task_name': 'second', 'task_args': []}])
+        TestLiveJobLog.job_log.set_task_id(job_key, 'first', 'svc')
+        TestLiveJobLog.job_log.set_task_id(job_key, 'first', 'svc')
+        assert TestLiveJobLog.job_log.get_summary(job_key)['counts'] == {
+            'total': 2, 'pending': 1, 'running': 1, 'complete': 0, 'failed': 0}
+        TestLiveJobLog.job_log.complete_task(job_key, 'first', 1, {'stdout': None, 'stderr': None})
+        assert TestLiveJobLog.job_log.get_summary(job_key)['counts'] == {
+            'total': 2, 'pending': 1, 'running': 0, 'complete': 1, 'failed': 1}
+        TestLiveJobLog.job_log.clear_job(job_key)
+
+    def test_complete_task_only_once(self):
+        job_key = ulid.new().str
+        TestLiveJobLog.job_log.add_job(job_key, 'an_image', 'www.example.com')
+        TestLiveJobLog.job_log.add_tasks(job_key, [{'task_name': 'first', 'task_args': []}])
+        assert TestLiveJobLog.job_log.complete_task(job_key, 'first', 0, {'stdout': 'ok', 'stderr': None})
+        assert not TestLiveJobLog.job_log.complete_task(job_key, 'first', 1, {'stdout': 'late', 'stderr': None})
+        assert TestLiveJobLog.job_log.get_task(job_key, 'first')['result'] == {'stdout': 'ok', 'stderr': None}
+        assert TestLiveJobLog.job_log.get_summary(job_key)['counts']['failed'] == 0
+        TestLiveJobLog.job_log.clear_job(job_key)
+
+    def test_large_output_of_completed_task_is_kept(self):
+        job_log = JobDb(TestLiveJobLog.database, inline_limit=4)
+        job_key = ulid.new().str
+        job_log.add_job(job_key, 'an_image', 'www.example.com')
+        job_log.add_tasks(job_key, [{'task_name': 'first', 'task_args': []}])
+        assert job_log.complete_task(job_key, 'first', 0, {'stdout': 'FIRST', 'stderr': None})
+        assert not job_log.complete_task(job_key, 'first', 0, {'stdout': 'SECOND', 'stderr': None})
+        assert b''.join(job_log.read_output(job_key, 'first', 'stdout')) == b'FIRST'
+        assert job_log.get_job(job_key)['tasks'][0]['result']['outputs'] == {
+            'stdout': '/output/{i}/first/stdout'.format(i=job_key)}
+        job_log.clear_job(job_key)
+
+    def test_finishing_job_refreshes_ttl(self):
+        job_log = JobDb(TestLiveJobLog.database, job_ttl=100)
+        job_key = ulid.new().str
+        job_log.add_job(job_key, 'an_image', 'www.example.com')
+        job_log.add_tasks(job_key, [{'task_name': 'first', 'task_args': []},
+                                    {'task_name': 'second', 'task_args': []}])
+        TestLiveJobLog.database.expire(job_key, 50)
+        assert job_log.complete_task(job_key, 'first', 0, {'stdout': 'ok', 'stderr': None})
+        assert TestLiveJobLog.database.ttl(job_key) <= 50
+        assert job_log.complete_task(job_key, 'second', 0, {'stdout': 'ok', 'stderr': None})
+        assert TestLiveJobLog.database.ttl(job_key) > 50
+        job_log.clear_job(job_key)
+
+    def test_sweep_drops_expired_active_jobs(self):
+        job_key = ulid.new().str
+        TestLiveJobLog.job_log.add_job(job_key, 'an_image', 'www.example.com')
+        TestLiveJobLog.job_log.add_tasks(job_key, [{'task_name': 'first', 'task_args': []}])
+        TestLiveJobLog.database.delete(job_key)
+        assert TestLiveJobLog.job_log.sweep_keys() >= 2
+        assert not TestLiveJobLog.database.exists(job_key + ':args')
+        assert not TestLiveJobLog.database.sismember(JobDb.ACTIVE_JOBS_KEY, job_key)
+
+    def test_migrated_unfinished_job_is_recovered(self):
+        job_key = ulid.new().str
+        tasks = [{'args': [], 'status': 0, 'result': {'stdout': None, 'stderr': None}, 'name': 'first'},
+                 {'args': [], 'status': 500, 'result': {'stdout': None, 'stderr': None}, 'name': 'second'}]
+        TestLiveJobLog.database.hmset(job_key, {'__image': 'an_image', '__callback': 'www.example.com',
+                                                'tasks': json.dumps(tasks)})
+        assert TestLiveJobLog.job_log.get_summary(job_key)['counts']['pending'] == 1
+        assert job_key in TestLiveJobLog.job_log.get_active_jobs()
+        TestLiveJobLog.job_log.clear_job(job_key)
+
+    def test_migrate_legacy_jobs(self):
+        job_key = ulid.new().str
+        tasks = [{'args': [], 'status': 500, 'result': {'stdout': None, 'stderr': None}, 'name': 'first'}]
+        TestLiveJobLog.database.hmset(job_key, {'__image': 'an_image', '__callback': 'www.example.com',
+                                                'tasks': json.dumps(tasks)})
+        assert TestLiveJobLog.job_log.migrate_legacy_jobs() >= 1
+        assert not TestLiveJobLog.database.hexists(job_key, 'tasks')
+        assert TestLiveJobLog.database.sismember(JobDb.ACTIVE_JOBS_KEY, job_key)
+        TestLiveJobLog.job_log.clear_job(job_key)
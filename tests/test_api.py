@@ -1,19 +1,23 @@
+import gzip
+import json
+from threading import Thread
 from unittest.mock import Mock
 
 import falcon
 import pytest
+import redis
 import ulid
 from wrapper import DockerWrapper
 from falcon import testing
 
 from jobs import JobRunner
 from jobs.queue import JobQueue
-from models import RunnerConfig
+from models import JobEntry, RunnerConfig
 from swarmer.swarmer import build_application
 
 job_queue_mock = Mock(spec=JobQueue)
 dummy_cfg = RunnerConfig('127.0.0.1', '1234', 'swarmer-net')
-runner = JobRunner(Mock(spec=DockerWrapper), job_queue_mock)
+runner = JobRunner(Mock(spec=DockerWrapper), job_queue_mock, thread_builder=Mock(spec=Thread))
 
 
 def runner_fn():
@@ -41,7 +45,49 @@ def test_create_job(client, monkeypatch):
     result = client.simulate_post('/submit', json=req)
     assert result.json == exp
     assert result.status == falcon.HTTP_201
-    job_queue_mock.add_new_job.assert_called_once_with(id_str, 'some_image', 'http://callback.org', req['tasks'])
+    job_queue_mock.add_new_job.assert_called_once_with(id_str, 'some_image', 'http://callback.org', req['tasks'],
+                                                       priority=None, tenant=None, batch_size=None)
+
+
+def test_create_job_with_priority(client, monkeypatch):
+    identifier = ulid.new()
+    job_queue_mock.get_next_tasks = Mock(return_value=[])
+    monkeypatch.setattr(ulid, 'new', lambda: identifier)
+    req = {'image_name': 'some_image', 'callback_url': 'http://callback.org', 'priority': 10, 'tenant': 'team-a',
+           'tasks': [{'task_name': 'first', 'task_args': []}]}
+    result = client.simulate_post('/submit', json=req)
+    assert result.status == falcon.HTTP_201
+    job_queue_mock.add_new_job.assert_called_with(identifier.str, 'some_image', 'http://callback.org', req['tasks'],
+                                                  priority=10, tenant='team-a', batch_size=None)
+
+
+def test_create_job_requires_positive_priority(client):
+    req = {'image_name': 'some_image', 'callback_url': 'http://callback.org', 'priority': 0,
+           'tasks': [{'task_name': 'first', 'task_args': []}]}
+    result = client.simulate_post('/submit', json=req)
+    assert result.status == falcon.HTTP_400
+
+
+def test_create_job_batch(client, monkeypatch):
+    first, second = ulid.new(), ulid.new()
+    identifiers = iter([first, second])
+    job_queue_mock.get_next_tasks = Mock(return_value=[])
+    monkeypatch.setattr(ulid, 'new', lambda: next(identifiers))
+    jobs = [{'image_name': 'some_image', 'callback_url': 'http://callback.org',
+             'tasks': [{'task_name': 'first', 'task_args': ['a']}]},
+            {'image_name': 'other_image', 'callback_url': 'http://callback.org',
+             'tasks': [{'task_name': 'second', 'task_args': []}]}]
+    result = client.simulate_post('/submit/batch', json={'jobs': jobs})
+    assert result.json == {'ids': [first.str, second.str]}
+    assert result.status == falcon.HTTP_201
+    job_queue_mock.add_new_jobs.assert_called_once_with([
+        JobEntry(first.str, 'some_image', 'http://callback.org', jobs[0]['tasks']),
+        JobEntry(second.str, 'other_image', 'http://callback.org', jobs[1]['tasks'])])
+
+
+def test_create_job_batch_requires_jobs(client):
+    result = client.simulate_post('/submit/batch', json={'jobs': []})
+    assert result.status == falcon.HTTP_400
 
 
 def test_get_job_status(client):
@@ -51,4 +97,154 @@ def test_get_job_status(client):
 
     result = client.simulate_get('/status/abc123')
     assert result.json == dummy_job
-    job_queue_mock.get_job_details.assert_called_once_with('abc123')
+    job_queue_mock.get_job_details.assert_called_once_with('abc123', fields=None)
+
+
+def test_get_job_status_fields(client):
+    job_queue_mock.get_job_details = Mock(return_value={'tasks': [{'name': 'task', 'status': 0}]})
+    result = client.simulate_get('/status/abc123', params={'fields': 'status'})
+    assert result.json == {'tasks': [{'name': 'task', 'status': 0}]}
+    job_queue_mock.get_job_details.assert_called_once_with('abc123', fields=['name', 'status'])
+    result = client.simulate_get('/status/abc123', params={'fields': 'status,stdout'})
+    assert result.status == falcon.HTTP_400
+
+
+def test_get_job_summary(client):
+    identifier = ulid.new().str
+    counts = {'total': 3, 'pending': 1, 'running': 1, 'complete': 1, 'failed': 0}
+    job_queue_mock.get_job_summary = Mock(return_value={'__image': 'image', '__version': 2, '__finished_at': None,
+                                                        'counts': counts})
+    result = client.simulate_get('/status/{i}'.format(i=identifier), params={'view': 'summary'})
+    assert result.json['counts'] == counts
+    assert 0 <= result.json['elapsed'] < 60
+
+
+
+def test_get_job_status_compressed(client):
+    dummy_job = {'tasks': [{'args': [], 'status': 0, 'result': {'stdout': 'A' * 4096, 'stderr': ''}, 'name': 'task'}]}
+    job_queue_mock.get_job_details = Mock(return_value=dummy_job)
+
+    result = client.simulate_get('/status/abc123', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert result.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(result.content)) == dummy_job
+    result = client.simulate_get('/status/abc123', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in result.headers
+    assert result.json == dummy_job
+
+
+def test_compressed_callback(client):
+    job_queue_mock.complete_task = Mock(return_value=([], False))
+    body = gzip.compress(json.dumps({'task_name': 'one', 'task_status': 0,
+                                     'task_result': {'stdout': 'a', 'stderr': ''}}).encode())
+    result = client.simulate_post('/result/abc123', body=body, headers={'Content-Type': 'application/json',
+                                                                         'Content-Encoding': 'gzip'})
+    assert result.status == falcon.HTTP_204
+    job_queue_mock.complete_task.assert_called_with('abc123', 'one', 0, {'stdout': 'a', 'stderr': ''})
+    result = client.simulate_post('/result/abc123', body=body[:10], headers={'Content-Encoding': 'gzip'})
+    assert result.status == falcon.HTTP_400
+    result = client.simulate_post('/result/abc123', body=body, headers={'Content-Encoding': 'br'})
+    assert result.status == falcon.HTTP_415
+
+
+def dummy_summary(version, complete):
+    return {'__image': 'image', '__version': version, '__finished_at': None,
+            'counts': {'total': 1, 'pending': 0, 'running': 1 - complete, 'complete': complete, 'failed': 0}}
+
+
+def test_watch_job_status(client):
+    dummy_job = {'__version': 3, 'tasks': [{'args': [], 'status': 0, 'result': None, 'name': 'task'}]}
+    job_queue_mock.get_job_summary = Mock(return_value=dummy_summary(3, 0))
+    job_queue_mock.get_job_details = Mock(return_value=dummy_job)
+    result = client.simulate_get('/status/abc123/watch', params={'since': '2'})
+    assert result.json == dummy_job
+    job_queue_mock.get_job_version = Mock(return_value=3)
+    result = client.simulate_get('/status/abc123/watch', params={'since': '3', 'timeout': '0', 'full': 'true'})
+    assert result.status == falcon.HTTP_204
+    job_queue_mock.get_job_summary = Mock(side_effect=ValueError('Can not find job'))
+    assert client.simulate_get('/status/abc123/watch').status == falcon.HTTP_404
+
+
+def test_stream_job_status(client):
+    dummy_job = {'__version': 3, 'tasks': [{'args': [], 'status': 0, 'result': None, 'name': 'task'}]}
+    job_queue_mock.get_job_details = Mock(return_value=dummy_job)
+    job_queue_mock.get_job_summary = Mock(return_value=dummy_summary(3, 1))
+    result = client.simulate_get('/status/abc123/watch', headers={'Accept': 'text/event-stream'})
+    assert result.headers['Content-Type'] == 'text/event-stream'
+    assert result.text == 'id: 3\nevent: status\ndata: {d}\n\n'.format(d=json.dumps(dummy_job))
+    result = client.simulate_get('/status/abc123/watch', headers={'Accept': 'text/event-stream',
+                                                                  'Last-Event-ID': '3'})
+    assert result.text == ''
+
+
+def test_watchers_are_capped(monkeypatch):
+    dummy_job = {'__version': 3, 'tasks': [{'args': [], 'status': 0, 'result': None, 'name': 'task'}]}
+    job_queue_mock.get_job_summary = Mock(return_value=dummy_summary(3, 1))
+    job_queue_mock.get_job_details = Mock(return_value=dummy_job)
+    monkeypatch.setenv('SWARMER_MAX_WATCHERS', '1')
+    client = testing.TestClient(build_application(runner_fn))
+    # A finished stream and poll hand their slot back to the next watcher
+    for _ in range(2):
+        result = client.simulate_get('/status/abc123/watch', headers={'Accept': 'text/event-stream'})
+        assert result.status == falcon.HTTP_200
+        assert client.simulate_get('/status/abc123/watch').status == falcon.HTTP_200
+    job_queue_mock.get_job_summary = Mock(side_effect=ValueError('Can not find job'))
+    assert client.simulate_get('/status/abc123/watch').status == falcon.HTTP_404
+    assert client.simulate_get('/status/abc123/watch', headers={'Accept': 'text/event-stream'}).status == \
+        falcon.HTTP_404
+
+    monkeypatch.setenv('SWARMER_MAX_WATCHERS', '0')
+    client = testing.TestClient(build_application(runner_fn))
+    result = client.simulate_get('/status/abc123/watch')
+    assert result.status == falcon.HTTP_503
+    assert result.headers['Retry-After'] == '5'
+
+
+def test_pool_task_without_pool(client):
+    result = client.simulate_get('/pool/abc/task')
+    assert result.status == falcon.HTTP_204
+    assert result.headers['Retry-After'] == '1'
+
+
+def test_batch_callback(client, mocker):
+    job_queue_mock.complete_task = Mock(return_value=([], False))
+    results = [{'task_name': 'one', 'task_status': 0, 'task_result': {'stdout': 'a', 'stderr': ''}},
+               {'task_name': 'two', 'task_status': 1, 'task_result': {'stdout': '', 'stderr': 'b'}}]
+    result = client.simulate_post('/result/abc123/batch', json={'results': results})
+    assert result.status == falcon.HTTP_204
+    job_queue_mock.complete_task.assert_has_calls([
+        mocker.call('abc123', 'one', 0, {'stdout': 'a', 'stderr': ''}),
+        mocker.call('abc123', 'two', 1, {'stdout': '', 'stderr': 'b'})])
+
+
+def test_health(client):
+    job_queue_mock.is_healthy = Mock(return_value=True)
+    result = client.simulate_get('/health')
+    assert result.status == falcon.HTTP_200
+    assert result.json == {'redis': 'ok'}
+    job_queue_mock.is_healthy = Mock(return_value=False)
+    result = client.simulate_get('/health')
+    assert result.status == falcon.HTTP_503
+
+
+def test_store_unavailable(client):
+    job_queue_mock.get_job_details = Mock(side_effect=redis.TimeoutError('Timeout reading from socket'))
+    result = client.simulate_get('/status/abc')
+    assert result.status == falcon.HTTP_503
+    assert result.headers['Retry-After'] == '1'
+
+
+def test_upload_task_output(client):
+    job_queue_mock.append_task_output = Mock(return_value=5)
+    result = client.simulate_post('/output/abc/one/stdout', body=b'hello')
+    assert result.status == falcon.HTTP_204
+    job_queue_mock.append_task_output.assert_called_with('abc', 'one', 'stdout', b'hello')
+    job_queue_mock.append_task_output = Mock(side_effect=ValueError('Unable to locate task'))
+    assert client.simulate_post('/output/abc/two/stdout', body=b'hello').status == falcon.HTTP_404
+
+
+def test_read_task_output(client):
+    job_queue_mock.read_task_output = Mock(return_value=iter([b'hello ', b'world']))
+    result = client.simulate_get('/output/abc/one/stdout')
+    assert result.status == falcon.HTTP_200
+    assert result.content == b'hello world'
+    job_queue_mock.read_task_output.assert_called_with('abc', 'one', 'stdout')
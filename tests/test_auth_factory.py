@@ -0,0 +1,64 @@
+from datetime import timedelta
+from threading import Thread
+
+import docker
+
+from auth.authenticator import Authenticator
+from auth.authfactory import AuthenticationFactory
+
+
+def init_wrapper(f):
+    def get_provider_mock(mocker):
+        mocker.patch.object(AuthenticationFactory, '_setup_providers')
+        provider_mock = mocker.Mock(spec=Authenticator)
+        provider_mock.should_authenticate.side_effect = lambda last_auth=None: last_auth is None
+        provider_mock.obtain_auth.return_value = ('user', 'pass', 'registry')
+        provider_mock.expires_at.return_value = None
+        subject = AuthenticationFactory()
+        subject._providers['test'] = {AuthenticationFactory.PROVIDER_KEY: provider_mock,
+                                      AuthenticationFactory.LAST_LOGIN_KEY: None}
+        return f(provider_mock, subject, mocker.MagicMock(spec=docker.DockerClient), mocker)
+    return get_provider_mock
+
+
+@init_wrapper
+def test_refresh_logins_renews_before_expiry(provider_mock, subject, client_mock, mocker):
+    provider_mock.expires_at.side_effect = lambda last_auth: last_auth + timedelta(minutes=10)
+    subject.refresh_logins(client_mock)
+    subject.refresh_logins(client_mock)
+    assert client_mock.login.call_count == 2
+    client_mock.login.assert_called_with(username='user', password='pass', registry='registry', reauth=True)
+
+
+@init_wrapper
+def test_refresh_logins_waits_for_expiry(provider_mock, subject, client_mock, mocker):
+    provider_mock.expires_at.side_effect = lambda last_auth: last_auth + timedelta(hours=1)
+    delay = subject.refresh_logins(client_mock)
+    assert subject.RETRY_DELAY < delay <= subject.REFRESH_INTERVAL
+    subject.refresh_logins(client_mock)
+    client_mock.login.assert_called_once()
+
+
+@init_wrapper
+def test_refresh_logins_without_expiry(provider_mock, subject, client_mock, mocker):
+    subject.refresh_logins(client_mock)
+    subject.refresh_logins(client_mock)
+    client_mock.login.assert_called_once()
+
+
+@init_wrapper
+def test_refresher_takes_over_logins(provider_mock, subject, client_mock, mocker):
+    thread_mock = mocker.Mock(spec=Thread)
+    subject.start_refresher(client_mock, thread_builder=thread_mock)
+    client_mock.login.assert_called_once()
+    thread_mock.return_value.start.assert_called_once()
+    subject._providers['test'][AuthenticationFactory.LAST_LOGIN_KEY] = None
+    subject.ensure_logins(client_mock)
+    client_mock.login.assert_called_once()
+
+
+def test_refresher_needs_providers(mocker):
+    mocker.patch.object(AuthenticationFactory, '_setup_providers')
+    thread_mock = mocker.Mock(spec=Thread)
+    AuthenticationFactory().start_refresher(mocker.MagicMock(spec=docker.DockerClient), thread_builder=thread_mock)
+    thread_mock.assert_not_called()
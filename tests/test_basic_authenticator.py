@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from os import environ
 
 import pytest
@@ -56,3 +56,22 @@ def test_with_no_reauth(monkeypatch):
     assert subject.should_authenticate()
     _ = subject.obtain_auth()
     assert not subject.should_authenticate()
+
+
+def test_expires_at_renew_interval(monkeypatch):
+    data = {
+        CredBuilder.BASIC_AUTH_USER_KEY: 'aName',
+        CredBuilder.BASIC_AUTH_PASS_KEY: 'the-password',
+        CredBuilder.BASIC_AUTH_REGISTRY_KEY: 'https://some-url.com',
+        CredBuilder.BASIC_AUTH_REAUTH_KEY: 'true',
+        CredBuilder.BASIC_AUTH_REAUTH_INTERVAL_KEY: '2'
+    }
+
+    def mockreturn(key, default=None):
+        return data.get(key, default)
+
+    monkeypatch.setattr(environ, 'get', mockreturn)
+    monkeypatch.setattr(environ, 'keys', data.keys)
+    subject = BasicAuthenticator()
+    last_time = datetime.now()
+    assert subject.expires_at(last_time) == last_time + timedelta(hours=2)
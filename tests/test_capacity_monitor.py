@@ -0,0 +1,43 @@
+from threading import Thread
+
+from jobs.capacity import CapacityMonitor
+from jobs.queue import JobQueue
+from wrapper import DockerWrapper
+
+GB = 1024 ** 3
+
+
+def init_wrapper(**kwargs):
+    def decorator(f):
+        def get_monitor_mocks(mocker):
+            docker_mock = mocker.Mock(spec=DockerWrapper)
+            queue_mock = mocker.Mock(spec=JobQueue)
+            queue_mock.queue_len = 12
+            subject = CapacityMonitor(docker_mock, queue_mock, thread_builder=mocker.Mock(spec=Thread), **kwargs)
+            return f(subject, docker_mock, queue_mock, mocker)
+        return get_monitor_mocks
+    return decorator
+
+
+@init_wrapper()
+def test_default_tasks_per_node(subject, docker_mock, queue_mock, mocker):
+    assert subject.compute_limit([(2, GB), (8, 16 * GB)]) == 8
+
+
+@init_wrapper(tasks_per_node=6, cpus_per_task=1, memory_per_task=2 * GB)
+def test_smallest_target_per_node(subject, docker_mock, queue_mock, mocker):
+    assert subject.compute_limit([(4, 16 * GB), (16, 8 * GB), (16, 64 * GB)]) == 4 + 4 + 6
+
+
+@init_wrapper(min_tasks=5, max_tasks=50, tasks_per_node=2)
+def test_limit_is_bounded(subject, docker_mock, queue_mock, mocker):
+    assert subject.compute_limit([]) == 5
+    assert subject.compute_limit([(4, GB)] * 40) == 50
+
+
+@init_wrapper(tasks_per_node=3)
+def test_update_sets_queue_len(subject, docker_mock, queue_mock, mocker):
+    docker_mock.node_resources.return_value = [(4, GB)] * 3
+    subject.update()
+    assert queue_mock.queue_len == 9
+    assert queue_mock.resource_capacity == (12, 3 * GB)
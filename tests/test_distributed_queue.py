@@ -0,0 +1,124 @@
+from threading import Event, Thread
+
+import pytest
+
+from db import JobDb, QueueDb
+from jobs.delivery import ResultDelivery
+from jobs.distributed_queue import DistributedJobQueue
+from models import JobEntry
+
+
+def init_wrapper(f):
+    def get_queue_mocks(mocker):
+        job_log_mock = mocker.Mock(spec=JobDb)
+        queue_db_mock = mocker.Mock(spec=QueueDb)
+        subject = DistributedJobQueue(job_log_mock, queue_db_mock, queue_len=4,
+                                      thread_builder=mocker.Mock(spec=Thread))
+        return f(subject, job_log_mock, queue_db_mock, mocker)
+    return get_queue_mocks
+
+
+@init_wrapper
+def test_add_job(subject, job_log_mock, queue_db_mock, mocker):
+    tasks = [{'task_name': 'first', 'task_args': ['a']}]
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', tasks)
+    job_log_mock.add_job.assert_called_once_with('abc123', 'some-image', 'www.someurl.com')
+    job_log_mock.add_tasks.assert_called_once_with('abc123', tasks)
+    queue_db_mock.push_jobs.assert_called_once_with([JobEntry('abc123', 'some-image', 'www.someurl.com', tasks)])
+
+
+@init_wrapper
+def test_get_next_tasks(subject, job_log_mock, queue_db_mock, mocker):
+    queue_db_mock.claim_tasks.return_value = [{'identifier': 'abc', 'name': 'one', 'args': ['a'], 'image': 'img'}]
+    next_up = subject.get_next_tasks()
+    queue_db_mock.claim_tasks.assert_called_once_with(4, None)
+    assert len(next_up) == 1
+    assert next_up[0].identifier == 'abc'
+    assert next_up[0].name == 'one'
+    assert next_up[0].image == 'img'
+
+
+@init_wrapper
+def test_complete_task(subject, job_log_mock, queue_db_mock, mocker):
+    queue_db_mock.complete_task.return_value = {'task_id': 'svc', 'started': 1}
+    queue_db_mock.pop_overdue.return_value = ['old-svc']
+    queue_db_mock.has_capacity.return_value = True
+    services, run_more = subject.complete_task('abc', 'one', 0, {'stdout': 'ok', 'stderr': None})
+    job_log_mock.complete_task.assert_called_once_with('abc', 'one', 0, {'stdout': 'ok', 'stderr': None})
+    queue_db_mock.complete_task.assert_called_once_with('abc', 'one')
+    queue_db_mock.has_capacity.assert_called_once_with(4)
+    assert services == ['svc', 'old-svc']
+    assert run_more
+
+
+@init_wrapper
+def test_complete_unknown_task(subject, job_log_mock, queue_db_mock, mocker):
+    queue_db_mock.is_running.return_value = False
+    queue_db_mock.has_capacity.return_value = False
+    assert subject.complete_task('abc', 'one', 0, {'stdout': 'ok', 'stderr': None}) == ([], False)
+    job_log_mock.complete_task.assert_not_called()
+    queue_db_mock.complete_task.assert_not_called()
+    queue_db_mock.pop_overdue.assert_not_called()
+
+
+@init_wrapper
+def test_complete_task_already_completed(subject, job_log_mock, queue_db_mock, mocker):
+    job_log_mock.complete_task.return_value = False
+    queue_db_mock.has_capacity.return_value = False
+    queue_db_mock.complete_task.return_value = {'task_id': 'svc'}
+    queue_db_mock.pop_overdue.return_value = []
+    assert subject.complete_task('abc', 'one', 0, {'stdout': 'late', 'stderr': None}) == (['svc'], False)
+    queue_db_mock.complete_task.assert_called_once_with('abc', 'one')
+
+
+@init_wrapper
+def test_complete_task_of_expired_job_releases_slot(subject, job_log_mock, queue_db_mock, mocker):
+    job_log_mock.complete_task.side_effect = ValueError('Unable to locate task one in job abc')
+    with pytest.raises(ValueError):
+        subject.complete_task('abc', 'one', 0, {'stdout': 'ok', 'stderr': None})
+    queue_db_mock.complete_task.assert_called_once_with('abc', 'one')
+
+
+@init_wrapper
+def test_mark_task_started_records_service(subject, job_log_mock, queue_db_mock, mocker):
+    queue_db_mock.mark_started.return_value = False
+    subject.mark_task_started('abc', 'one', 'svc')
+    job_log_mock.set_task_id.assert_not_called()
+    queue_db_mock.mark_started.return_value = True
+    subject.mark_task_started('abc', 'one', 'svc')
+    job_log_mock.set_task_id.assert_called_once_with('abc', 'one', 'svc')
+
+
+@init_wrapper
+def test_is_task_running_for_service(subject, job_log_mock, queue_db_mock, mocker):
+    queue_db_mock.get_running_task.return_value = {'task_id': 'svc', 'started': 1}
+    assert subject.is_task_running('abc', 'one', task_id='svc')
+    assert not subject.is_task_running('abc', 'one', task_id='old-svc')
+    queue_db_mock.get_running_task.return_value = None
+    assert not subject.is_task_running('abc', 'one', task_id='svc')
+    queue_db_mock.get_running_task.assert_called_with('abc', 'one')
+
+
+def test_unreadable_finished_job_is_dead_lettered(mocker):
+    done = Event()
+    job_log_mock = mocker.Mock(spec=JobDb)
+    queue_db_mock = mocker.Mock(spec=QueueDb)
+    send_mock = mocker.Mock(spec=ResultDelivery)
+    subject = DistributedJobQueue(job_log_mock, queue_db_mock, thread_builder=mocker.Mock(spec=Thread),
+                                  delivery=send_mock)
+    finished = iter(['abc', 'def'])
+
+    def wait_for_finished_job(_):
+        identifier = next(finished, None)
+        if identifier is None:
+            # Waits without time.sleep, which other tests patch while this thread is still running
+            Event().wait(0.01)
+        return identifier
+
+    queue_db_mock.wait_for_finished_job.side_effect = wait_for_finished_job
+    job_log_mock.get_job.side_effect = [ValueError('Can not find job with id: abc'), {'tasks': []}]
+    send_mock.send.side_effect = lambda _: done.set()
+    Thread(target=subject._process_completed_jobs, daemon=True).start()
+    assert done.wait(timeout=2)
+    job_log_mock.add_dead_letter.assert_called_once_with('abc', None, 'Can not find job with id: abc')
+    send_mock.send.assert_called_once_with([('def', {'tasks': []})])
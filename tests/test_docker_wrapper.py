@@ -0,0 +1,210 @@
+from concurrent.futures import Executor
+
+import docker
+from docker.errors import APIError, NotFound
+
+from auth.authfactory import AuthenticationFactory
+from models import RunnerConfig
+from wrapper import DockerWrapper
+
+cfg = RunnerConfig('swarmer', '1234', 'overlay')
+
+
+class InlineExecutor(Executor):
+    def __init__(self, **_):
+        pass
+
+    def map(self, fn, *iterables, **_):
+        return map(fn, *iterables)
+
+
+def init_wrapper(f):
+    def get_client_mock(mocker):
+        client_mock = mocker.MagicMock(spec=docker.DockerClient)
+        client_mock.api = mocker.MagicMock(spec=docker.APIClient)
+        subject = DockerWrapper(client_mock, cfg, None, executor_builder=InlineExecutor)
+        return f(client_mock, subject, mocker)
+    return get_client_mock
+
+
+@init_wrapper
+def test_start_task_labels_service(client_mock, subject, mocker):
+    client_mock.services.create.return_value.id = 'svc'
+    assert subject.start_task('abc', 'image', 'one', ['a', 'b']) == 'svc'
+    labels = {'swarmer.managed': 'true', 'swarmer.job': 'abc', 'swarmer.task': 'one'}
+    _, kwargs = client_mock.services.create.call_args
+    assert kwargs['name'] == 'abc-one'
+    assert kwargs['labels'] == labels
+    assert kwargs['container_labels'] == labels
+    assert 'RUN_ARGS=a,b' in kwargs['env']
+    assert kwargs['resources'] is None
+    assert kwargs['constraints'] is None
+
+
+@init_wrapper
+def test_start_task_with_resources(client_mock, subject, mocker):
+    subject.start_task('abc', 'image', 'one', [], resources={'cpu_reservation': 0.5, 'cpu_limit': 2,
+                                                             'mem_reservation': 1024, 'generic_resources': {'gpu': 1}},
+                       constraints=['node.labels.gpu==true'])
+    _, kwargs = client_mock.services.create.call_args
+    assert kwargs['resources']['Reservations']['NanoCPUs'] == 500000000
+    assert kwargs['resources']['Reservations']['MemoryBytes'] == 1024
+    assert kwargs['resources']['Limits'] == {'NanoCPUs': 2000000000}
+    assert kwargs['constraints'] == ['node.labels.gpu==true']
+
+
+@init_wrapper
+def test_remove_service(client_mock, subject, mocker):
+    client_mock.api.remove_service.side_effect = [None, NotFound('gone'), APIError('busy')]
+    subject.remove_service(['one', None, 'two', 'three'])
+    assert [c[0][0] for c in client_mock.api.remove_service.call_args_list] == ['one', 'two', 'three']
+    client_mock.services.get.assert_not_called()
+
+
+@init_wrapper
+def test_prune_services(client_mock, subject, mocker):
+    client_mock.api.services.return_value = [{'ID': 'done'}, {'ID': 'running'}, {'ID': 'new'}]
+    client_mock.api.tasks.return_value = [
+        {'ServiceID': 'done', 'Status': {'State': 'complete'}},
+        {'ServiceID': 'done', 'Status': {'State': 'failed'}},
+        {'ServiceID': 'running', 'Status': {'State': 'running'}}
+    ]
+    assert subject.prune_services() == 1
+    client_mock.api.services.assert_called_once_with(filters={'label': 'swarmer.managed=true'})
+    client_mock.api.tasks.assert_called_once_with(filters={'service': ['done', 'running', 'new']})
+    client_mock.api.remove_service.assert_called_once_with('done')
+
+
+@init_wrapper
+def test_task_exits(client_mock, subject, mocker):
+    labels = {'swarmer.managed': 'true', 'swarmer.job': 'abc', 'swarmer.task': 'one',
+              'com.docker.swarm.service.id': 'svc'}
+    client_mock.events.return_value = iter([
+        {'Action': 'oom', 'Actor': {'ID': 'c1', 'Attributes': labels}},
+        {'Action': 'die', 'Actor': {'ID': 'c1', 'Attributes': dict(labels, exitCode='137')}},
+        {'Action': 'die', 'Actor': {'ID': 'c2', 'Attributes': dict(labels, exitCode='1')}}
+    ])
+    assert list(subject.task_exits()) == [('abc', 'one', 137, True, 'svc'), ('abc', 'one', 1, False, 'svc')]
+    client_mock.events.assert_called_once_with(decode=True, filters={
+        'type': 'container', 'event': ['oom', 'die'], 'label': 'swarmer.managed=true'})
+
+
+@init_wrapper
+def test_finished_tasks(client_mock, subject, mocker):
+    client_mock.api.services.return_value = [{'ID': 'svc'}]
+    labels = {'swarmer.job': 'abc', 'swarmer.task': 'one'}
+    client_mock.api.tasks.return_value = [
+        {'ServiceID': 'svc', 'Spec': {'ContainerSpec': {'Labels': labels}},
+         'Status': {'State': 'failed', 'ContainerStatus': {'ExitCode': 2}}},
+        {'ServiceID': 'svc', 'Spec': {'ContainerSpec': {'Labels': labels}}, 'Status': {'State': 'running'}}
+    ]
+    assert subject.finished_tasks() == [('abc', 'one', 2, False, 'svc')]
+
+
+@init_wrapper
+def test_node_resources(client_mock, subject, mocker):
+    resources = {'NanoCPUs': 4000000000, 'MemoryBytes': 8192}
+    client_mock.api.nodes.return_value = [
+        {'Status': {'State': 'ready'}, 'Spec': {'Availability': 'active'}, 'Description': {'Resources': resources}},
+        {'Status': {'State': 'down'}, 'Spec': {'Availability': 'active'}, 'Description': {'Resources': resources}},
+        {'Status': {'State': 'ready'}, 'Spec': {'Availability': 'drain'}, 'Description': {'Resources': resources}}
+    ]
+    assert subject.node_resources() == [(4.0, 8192)]
+
+
+@init_wrapper
+def test_start_pool(client_mock, subject, mocker):
+    client_mock.api.services.return_value = []
+    client_mock.services.create.return_value.id = 'pool-svc'
+    assert subject.start_pool('p1', 'image', 3) == 'pool-svc'
+    client_mock.api.services.assert_called_once_with(filters={'label': 'swarmer.pool=p1'})
+    _, kwargs = client_mock.services.create.call_args
+    assert kwargs['name'] == 'swarmer-pool-p1'
+    assert kwargs['mode'] == {'replicated': {'Replicas': 3}}
+    assert kwargs['labels'] == {'swarmer.pool': 'p1'}
+    assert 'SWARMER_POOL_ADDRESS=http://swarmer:1234/pool/p1/task' in kwargs['env']
+
+
+@init_wrapper
+def test_start_pool_reuses_running_service(client_mock, subject, mocker):
+    client_mock.api.services.return_value = [{'ID': 'pool-svc'}]
+    assert subject.start_pool('p1', 'image', 3) == 'pool-svc'
+    client_mock.services.create.assert_not_called()
+
+
+@init_wrapper
+def test_stop_pool(client_mock, subject, mocker):
+    client_mock.api.services.return_value = [{'ID': 'pool-svc'}]
+    subject.stop_pool('p1')
+    client_mock.api.remove_service.assert_called_once_with('pool-svc')
+
+
+@init_wrapper
+def test_start_batch(client_mock, subject, mocker):
+    client_mock.services.create.return_value.id = 'svc'
+    tasks = [{'task_name': 'one', 'task_args': ['a']}, {'task_name': 'two', 'task_args': []}]
+    assert subject.start_batch('abc', 'image', tasks) == 'svc'
+    _, kwargs = client_mock.services.create.call_args
+    assert kwargs['name'] == 'abc-batch-one'
+    assert kwargs['labels'] == {'swarmer.managed': 'true', 'swarmer.job': 'abc', 'swarmer.tasks': '["one", "two"]'}
+    assert 'SWARMER_ADDRESS=http://swarmer:1234/result/abc/batch' in kwargs['env']
+    assert 'SWARMER_TASKS=[{"task_name":"one","task_args":["a"]},{"task_name":"two","task_args":[]}]' in kwargs['env']
+
+
+@init_wrapper
+def test_task_exits_of_batch(client_mock, subject, mocker):
+    labels = {'swarmer.managed': 'true', 'swarmer.job': 'abc', 'swarmer.tasks': '["one", "two"]', 'exitCode': '1'}
+    client_mock.events.return_value = iter([{'Action': 'die', 'Actor': {'ID': 'c1', 'Attributes': labels}}])
+    assert list(subject.task_exits()) == [('abc', 'one', 1, False, None), ('abc', 'two', 1, False, None)]
+
+
+@init_wrapper
+def test_prepull_image(client_mock, subject, mocker):
+    client_mock.services.create.return_value.id = 'pull-svc'
+    assert subject.prepull_image('image') == 'pull-svc'
+    args, kwargs = client_mock.services.create.call_args
+    assert args == ('image',)
+    assert kwargs['mode'] == {'global': {}}
+    assert kwargs['labels'] == {'swarmer.prepull': 'image'}
+
+
+@init_wrapper
+def test_service_finished(client_mock, subject, mocker):
+    client_mock.api.tasks.return_value = []
+    assert not subject.service_finished('svc')
+    client_mock.api.tasks.return_value = [{'Status': {'State': 'complete'}}, {'Status': {'State': 'preparing'}}]
+    assert not subject.service_finished('svc')
+    client_mock.api.tasks.return_value = [{'Status': {'State': 'complete'}}, {'Status': {'State': 'failed'}}]
+    assert subject.service_finished('svc')
+    client_mock.api.tasks.assert_called_with(filters={'service': 'svc'})
+
+
+def test_logins_are_checked_once_per_interval(mocker):
+    mocker.patch.object(AuthenticationFactory, '_setup_providers')
+    provider = mocker.Mock()
+    provider.should_authenticate.return_value = True
+    provider.obtain_auth.return_value = ('user', 'pass', 'registry')
+    authenticator = AuthenticationFactory(check_interval=60)
+    authenticator._providers['basic'] = {AuthenticationFactory.PROVIDER_KEY: provider,
+                                         AuthenticationFactory.LAST_LOGIN_KEY: None}
+    client_mock = mocker.MagicMock(spec=docker.DockerClient)
+    subject = DockerWrapper(client_mock, cfg, authenticator, executor_builder=InlineExecutor)
+    subject.start_task('abc', 'image', 'one', [])
+    subject.start_task('abc', 'image', 'two', [])
+    client_mock.login.assert_called_once_with(username='user', password='pass', registry='registry', reauth=True)
+    assert provider.should_authenticate.call_count == 2
+
+
+@init_wrapper
+def test_task_services(client_mock, subject, mocker):
+    client_mock.api.services.return_value = [
+        {'ID': 'labelled', 'Spec': {'Name': 'abc-one', 'Labels': {'swarmer.managed': 'true', 'swarmer.job': 'abc',
+                                                                  'swarmer.task': 'one'}}},
+        {'ID': 'batch', 'Spec': {'Name': 'abc-batch-two', 'Labels': {'swarmer.managed': 'true', 'swarmer.job': 'abc',
+                                                                     'swarmer.tasks': '["two", "three"]'}}},
+        {'ID': 'old', 'Spec': {'Name': '01D2QZ5Y3J7V6N2K4T8B9C0F1E-four'}},
+        {'ID': 'pool', 'Spec': {'Name': 'swarmer-pool-p1', 'Labels': {'swarmer.pool': 'p1'}}},
+        {'ID': 'other', 'Spec': {'Name': 'redis'}}
+    ]
+    assert subject.task_services() == {('abc', 'one'): 'labelled', ('abc', 'two'): 'batch',
+                                       ('abc', 'three'): 'batch', ('01D2QZ5Y3J7V6N2K4T8B9C0F1E', 'four'): 'old'}
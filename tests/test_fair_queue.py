@@ -0,0 +1,46 @@
+from jobs.fair_queue import FairTaskQueue
+
+
+def drain(subject, count):
+    return [subject.pop() for _ in range(count)]
+
+
+def test_single_job_is_fifo():
+    subject = FairTaskQueue()
+    for t in ['a', 'b', 'c']:
+        subject.push('job', t)
+    assert len(subject) == 3
+    assert subject.peek() == 'a'
+    assert drain(subject, 3) == ['a', 'b', 'c']
+    assert not subject
+
+
+def test_small_job_is_not_starved():
+    subject = FairTaskQueue()
+    for i in range(1000):
+        subject.push('bulk', 'bulk-{i}'.format(i=i))
+    drain(subject, 10)
+    subject.push('small', 'small-0')
+    subject.push('small', 'small-1')
+    assert sorted(drain(subject, 4)) == ['bulk-10', 'bulk-11', 'small-0', 'small-1']
+
+
+def test_priority_sets_share():
+    subject = FairTaskQueue()
+    for i in range(100):
+        subject.push('low', 'low')
+        subject.push('high', 'high', priority=3)
+    taken = drain(subject, 40)
+    assert taken.count('high') == 30
+    assert taken.count('low') == 10
+
+
+def test_tenants_share_equally():
+    subject = FairTaskQueue()
+    for i in range(100):
+        for job in ['a1', 'a2', 'a3']:
+            subject.push(job, 'a', tenant='a')
+        subject.push('b1', 'b', tenant='b')
+    taken = drain(subject, 60)
+    assert taken.count('a') == 30
+    assert taken.count('b') == 30
@@ -0,0 +1,63 @@
+from threading import Thread
+
+from docker.errors import APIError
+
+from jobs.warmer import ImageWarmer
+from wrapper import DockerWrapper
+
+
+def init_wrapper(f):
+    def get_docker_mock(mocker):
+        docker_mock = mocker.Mock(spec=DockerWrapper)
+        subject = ImageWarmer(docker_mock, thread_builder=mocker.Mock(spec=Thread))
+        return f(docker_mock, subject, mocker)
+    return get_docker_mock
+
+
+@init_wrapper
+def test_warm_pulls_image_once(docker_mock, subject, mocker):
+    docker_mock.prepull_image.return_value = 'pull-svc'
+    docker_mock.service_finished.return_value = False
+    subject.warm('image')
+    subject.warm('image')
+    docker_mock.prepull_image.assert_not_called()
+    subject._worker.run_once()
+    subject.warm('image')
+    subject._worker.run_once()
+    docker_mock.prepull_image.assert_called_once_with('image')
+    assert not subject.is_warm('image')
+
+
+@init_wrapper
+def test_finished_pull_marks_image_warm(docker_mock, subject, mocker):
+    docker_mock.prepull_image.return_value = 'pull-svc'
+    docker_mock.service_finished.return_value = True
+    subject.warm('image')
+    subject._worker.run_once()
+    assert subject.is_warm('image')
+    docker_mock.remove_service.assert_called_once_with(['pull-svc'])
+    subject.warm('image')
+    subject._worker.run_once()
+    docker_mock.prepull_image.assert_called_once()
+
+
+def test_pull_gives_up_after_timeout(mocker):
+    docker_mock = mocker.Mock(spec=DockerWrapper)
+    subject = ImageWarmer(docker_mock, pull_timeout=-1, thread_builder=mocker.Mock(spec=Thread))
+    docker_mock.prepull_image.return_value = 'pull-svc'
+    docker_mock.service_finished.return_value = False
+    subject.warm('image')
+    subject._worker.run_once()
+    assert not subject.is_warm('image')
+    docker_mock.remove_service.assert_called_once_with(['pull-svc'])
+
+
+@init_wrapper
+def test_failed_pull_is_retried(docker_mock, subject, mocker):
+    docker_mock.prepull_image.side_effect = [APIError('no such image'), 'pull-svc']
+    docker_mock.service_finished.return_value = False
+    subject.warm('image')
+    subject._worker.run_once()
+    subject.warm('image')
+    subject._worker.run_once()
+    assert docker_mock.prepull_image.call_count == 2
@@ -1,9 +1,12 @@
-from unittest.mock import call
+import json
+import zlib
+from unittest.mock import ANY, call
 
 import pytest
 import redis
 
 from db import JobDb
+from models import JobEntry
 
 
 def init_wrapper(f):
@@ -15,12 +18,19 @@ def init_wrapper(f):
     return get_redis_mock
 
 
+def pipeline_mock(r_mock, mocker, results=None):
+    pipe = mocker.MagicMock()
+    pipe.execute = mocker.Mock(return_value=results)
+    r_mock.pipeline = mocker.Mock(return_value=pipe)
+    return pipe
+
+
 @init_wrapper
 def test_create(r_mock, subject, mocker):
     identifier = 'abc'
     image = 'image'
     callback = 'www.callback.com'
-    expected_set = {'__image': image, '__callback': callback, 'tasks': []}
+    expected_set = {'__image': image, '__callback': callback}
     subject.add_job(identifier, image, callback)
     r_mock.hmset.assert_called_once_with(identifier, expected_set)
 
@@ -28,11 +38,35 @@ def test_create(r_mock, subject, mocker):
 @init_wrapper
 def test_task(r_mock, subject, mocker):
     r_mock.exists = mocker.MagicMock(return_value=True)
+    pipe = pipeline_mock(r_mock, mocker)
     subject.add_tasks('abc', [{'task_name': 'one', 'task_args': [0, 1, 2]}, {
         'task_name': 'two', 'task_args': [2, 1, 0]}])
     r_mock.exists.assert_called_once_with('abc')
-    r_mock.hmset.assert_called_once_with('abc', {
-        'tasks': '[{"args": [0, 1, 2], "status": 500, "result": {"stdout": null, "stderr": null}, "name": "one"}, {"args": [2, 1, 0], "status": 500, "result": {"stdout": null, "stderr": null}, "name": "two"}]'})
+    pipe.rpush.assert_called_once_with('abc:names', 'one', 'two')
+    pipe.hmset.assert_has_calls([
+        call('abc:args', {'one': '[0, 1, 2]', 'two': '[2, 1, 0]'}),
+        call('abc:status', {'one': '500', 'two': '500'}),
+        call('abc:result', {'one': '{"stdout": null, "stderr": null}', 'two': '{"stdout": null, "stderr": null}'})
+    ])
+    pipe.execute.assert_called_once_with()
+    r_mock.hmset.assert_not_called()
+
+
+@init_wrapper
+def test_add_jobs(r_mock, subject, mocker):
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.add_jobs([JobEntry('abc', 'image', 'www.callback.com', [{'task_name': 'one', 'task_args': []}]),
+                      JobEntry('def', 'image', 'www.callback.com', [{'task_name': 'two', 'task_args': ['a']}])])
+    r_mock.pipeline.assert_called_once_with()
+    pipe.hmset.assert_has_calls([
+        call('abc', {'__image': 'image', '__callback': 'www.callback.com'}),
+        call('abc:args', {'one': '[]'}),
+        call('def', {'__image': 'image', '__callback': 'www.callback.com'}),
+        call('def:args', {'two': '["a"]'})
+    ], any_order=True)
+    pipe.rpush.assert_has_calls([call('abc:names', 'one'), call('def:names', 'two')])
+    pipe.execute.assert_called_once_with()
+    r_mock.exists.assert_not_called()
 
 
 @init_wrapper
@@ -43,53 +77,155 @@ def test_task_raises(r_mock, subject, mocker):
             'task_name': 'two', 'task_args': [2, 1, 0]}])
 
 
+def task_keys(*columns):
+    return ['abc', 'abc:args', 'abc:status', 'abc:task_id'] + ['abc:' + c for c in columns]
+
+
+def task_args(name, *values, only_pending='0'):
+    return [name, '500', ANY, only_pending] + list(values)
+
+
+def script_mock(r_mock, result):
+    script = r_mock.register_script.return_value
+    script.return_value = result
+    return script
+
+
 @init_wrapper
 def test_update_status(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=True)
-    r_mock.hget = mocker.MagicMock(
-        return_value='[{"name": "def", "status": "started"}]')
+    script = script_mock(r_mock, 1)
     subject.update_status('abc', 'def', 0)
-    exists_calls = [call('abc', 'tasks')]
-    r_mock.hexists.assert_has_calls(exists_calls * 2)
-    r_mock.hget.assert_has_calls(exists_calls * 2)
-    r_mock.hmset.assert_not_called()
-    r_mock.hset.assert_called_once_with(
-        'abc', 'tasks', '[{"name": "def", "status": 0}]')
+    script.assert_called_once_with(keys=task_keys('status'), args=task_args('def', '0'))
+    r_mock.hget.assert_not_called()
+    r_mock.hset.assert_not_called()
 
 
 @init_wrapper
 def test_update_status_raises(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=False)
+    script_mock(r_mock, 0)
+    r_mock.transaction = mocker.MagicMock(return_value=False)
     with pytest.raises(ValueError):
         subject.update_status('abc', 'def', 'DONE')
 
+
 @init_wrapper
 def test_update_result(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=True)
-    r_mock.hget = mocker.MagicMock(
-        return_value='[{"name": "def", "result": "none"}]')
+    script = script_mock(r_mock, 1)
     subject.update_result('abc', 'def', {'stdout': None, 'stderr': 'Something went wrong'})
-    exists_calls = [call('abc', 'tasks')]
-    r_mock.hexists.assert_has_calls(exists_calls * 2)
-    r_mock.hget.assert_has_calls(exists_calls * 2)
-    r_mock.hmset.assert_not_called()
-    r_mock.hset.assert_called_once_with(
-        'abc', 'tasks', '[{"name": "def", "result": {"stdout": null, "stderr": "Something went wrong"}}]')
+    script.assert_called_once_with(keys=task_keys('result'),
+                                   args=task_args('def', '{"stdout": null, "stderr": "Something went wrong"}'))
+
 
 @init_wrapper
 def test_update_result_raises(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=False)
+    script_mock(r_mock, 0)
+    r_mock.transaction = mocker.MagicMock(return_value=False)
     with pytest.raises(ValueError):
         subject.update_result('abc', 'def', {'stdout': None, 'stderr': 'Something went wrong'})
 
+
+@init_wrapper
+def test_complete_task(r_mock, subject, mocker):
+    script = script_mock(r_mock, 1)
+    assert subject.complete_task('abc', 'def', 0, {'stdout': 'ok', 'stderr': None})
+    script.assert_called_once_with(keys=task_keys('status', 'result'),
+                                   args=task_args('def', '0', '{"stdout": "ok", "stderr": null}', only_pending='1'))
+    r_mock.hset.assert_not_called()
+
+
+@init_wrapper
+def test_complete_task_already_completed(r_mock, subject, mocker):
+    script_mock(r_mock, -1)
+    pipe = pipeline_mock(r_mock, mocker)
+    assert not subject.complete_task('abc', 'def', 0, {'stdout': 'late', 'stderr': None})
+    pipe.publish.assert_not_called()
+
+
+@init_wrapper
+def test_complete_task_migrates_legacy_job(r_mock, subject, mocker):
+    script = r_mock.register_script.return_value
+    script.side_effect = [0, 1]
+    r_mock.transaction = mocker.MagicMock(return_value=True)
+    subject.complete_task('abc', 'def', 0, {'stdout': 'ok', 'stderr': None})
+    r_mock.transaction.assert_called_once_with(mocker.ANY, 'abc', value_from_callable=True)
+    assert script.call_count == 2
+
+
 @init_wrapper
 def test_get_job(r_mock, subject, mocker):
     r_mock.exists = mocker.MagicMock(return_value=True)
-    r_mock.hgetall = mocker.Mock(return_value={b'__id': b'123', b'tasks': '[{"one": "two"}]'})
-    subject.get_job('abc')
+    pipe = pipeline_mock(r_mock, mocker, [
+        {b'__image': b'image', b'__callback': b'www.callback.com'},
+        [b'two', b'one'],
+        {b'one': b'["a"]', b'two': b'[]'},
+        {b'one': b'0', b'two': b'500'},
+        {b'one': b'{"stdout": "ok", "stderr": null}', b'two': b'{"stdout": null, "stderr": null}'},
+        {b'one': b'"svc"'},
+        {b'one:stderr'}
+    ])
+    actual = subject.get_job('abc')
     r_mock.exists.assert_called_once_with('abc')
-    r_mock.hgetall.assert_called_once_with('abc')
+    pipe.hgetall.assert_has_calls([call('abc'), call('abc:args'), call('abc:status'), call('abc:result'),
+                                   call('abc:task_id')])
+    pipe.lrange.assert_called_once_with('abc:names', 0, -1)
+    assert actual == {'__image': 'image', '__callback': 'www.callback.com', 'tasks': [
+        {'args': [], 'status': 500, 'result': {'stdout': None, 'stderr': None}, 'name': 'two'},
+        {'args': ['a'], 'status': 0, 'result': {'stdout': 'ok', 'stderr': None,
+                                                'outputs': {'stderr': '/output/abc/one/stderr'}},
+         'name': 'one', '__task_id': 'svc'}
+    ]}
+
+
+
+@init_wrapper
+def test_task_changes_are_published(r_mock, subject, mocker):
+    script_mock(r_mock, 1)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.update_status('abc', 'def', 0)
+    pipe.hincrby.assert_called_once_with('abc', '__version', 1)
+    pipe.publish.assert_called_once_with('swarmer:changes:abc', 'def')
+    r_mock.hget = mocker.Mock(return_value=b'3')
+    assert subject.get_version('abc') == 3
+
+
+@init_wrapper
+def test_get_job_fields(r_mock, subject, mocker):
+    r_mock.exists = mocker.MagicMock(return_value=True)
+    pipe = pipeline_mock(r_mock, mocker, [
+        {b'__image': b'image', b'__task_count_total': b'2', b'__task_count_complete': b'1'},
+        [b'one', b'two'],
+        {b'one': b'0', b'two': b'500'}
+    ])
+    actual = subject.get_job('abc', fields=['name', 'status'])
+    pipe.hgetall.assert_has_calls([call('abc'), call('abc:status')])
+    assert pipe.hgetall.call_count == 2
+    pipe.smembers.assert_not_called()
+    assert actual == {'__image': 'image', '__task_count_total': 2, '__task_count_complete': 1,
+                      'tasks': [{'status': 0, 'name': 'one'}, {'status': 500, 'name': 'two'}]}
+
 
+@init_wrapper
+def test_get_summary(r_mock, subject, mocker):
+    r_mock.hmget = mocker.Mock(return_value=[b'image', b'4', None, b'5', b'3', b'2', b'1'])
+    assert subject.get_summary('abc') == {'__image': 'image', '__version': 4, '__finished_at': None, 'counts': {
+        'total': 5, 'pending': 2, 'running': 1, 'complete': 2, 'failed': 1}}
+    r_mock.hmget.assert_called_once_with('abc', '__image', '__version', '__finished_at', *JobDb.TASK_COUNTS)
+
+
+@init_wrapper
+def test_get_summary_counts_tasks_without_counters(r_mock, subject, mocker):
+    r_mock.hmget = mocker.Mock(return_value=[b'image', None, None, None, None, None, None])
+    r_mock.transaction = mocker.Mock(return_value=False)
+    pipeline_mock(r_mock, mocker, [{b'one': b'0', b'two': b'500', b'three': b'1', b'four': b'500'}, [b'two']])
+    assert subject.get_summary('abc')['counts'] == {'total': 4, 'pending': 1, 'running': 1, 'complete': 2,
+                                                    'failed': 1}
+
+
+@init_wrapper
+def test_get_summary_raises(r_mock, subject, mocker):
+    r_mock.hmget = mocker.Mock(return_value=[None] * 7)
+    with pytest.raises(ValueError):
+        subject.get_summary('abc')
 
 @init_wrapper
 def test_get_job_raises(r_mock, subject, mocker):
@@ -97,27 +233,35 @@ def test_get_job_raises(r_mock, subject, mocker):
     with pytest.raises(ValueError):
         subject.get_job('abc')
 
+
 @init_wrapper
 def test_get_task(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=True)
-    r_mock.hget = mocker.MagicMock(
-        return_value='[{"name": "123", "status": "started"}]')
-    subject.get_task('abc', '123')
-    r_mock.hexists.assert_called_once_with('abc', 'tasks')
-    r_mock.hget.assert_called_once_with('abc', 'tasks')
+    pipe = pipeline_mock(r_mock, mocker, [b'[1]', b'500', b'{"stdout": null, "stderr": null}', None])
+    actual = subject.get_task('abc', '123')
+    pipe.hget.assert_has_calls([call('abc:args', '123'), call('abc:status', '123'), call('abc:result', '123'),
+                                call('abc:task_id', '123')])
+    assert actual == {'args': [1], 'status': 500, 'result': {'stdout': None, 'stderr': None}, 'name': '123'}
+
 
 @init_wrapper
 def test_get_task_raises(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=False)
+    pipeline_mock(r_mock, mocker, [None, None, None, None])
+    r_mock.transaction = mocker.MagicMock(return_value=False)
     with pytest.raises(ValueError):
         subject.get_task('abc', 'def')
 
+
 @init_wrapper
 def test_clear_job(r_mock, subject, mocker):
     r_mock.exists = mocker.MagicMock(return_value=True)
+    r_mock.smembers = mocker.Mock(return_value={b'one:stdout'})
+    pipe = pipeline_mock(r_mock, mocker)
     subject.clear_job('abc')
     r_mock.exists.assert_called_once_with('abc')
-    r_mock.delete.assert_called_once_with('abc')
+    pipe.srem.assert_called_once_with('swarmer:active_jobs', 'abc')
+    pipe.delete.assert_called_once_with('abc', 'abc:args', 'abc:status', 'abc:result', 'abc:task_id', 'abc:names',
+                                        'abc:spec', 'abc:outputs', 'abc:output:one:stdout')
+
 
 @init_wrapper
 def test_clear_job_raises(r_mock, subject, mocker):
@@ -125,15 +269,223 @@ def test_clear_job_raises(r_mock, subject, mocker):
     with pytest.raises(ValueError):
         subject.clear_job('abc')
 
+
 @init_wrapper
 def test_set_task_id(r_mock, subject, mocker):
-    r_mock.hexists = mocker.MagicMock(return_value=True)
-    r_mock.hget = mocker.MagicMock(
-        return_value='[{"name": "123", "status": "started"}]')
+    script = script_mock(r_mock, 1)
     subject.set_task_id('abc', '123', {'ID': 'value'})
-    exists_calls = [call('abc', 'tasks')]
-    r_mock.hexists.assert_has_calls(exists_calls * 2)
-    r_mock.hget.assert_has_calls(exists_calls * 2)
+    script.assert_called_once_with(keys=task_keys('task_id'), args=task_args('123', '{"ID": "value"}'))
     r_mock.hmset.assert_not_called()
-    r_mock.hset.assert_called_once_with(
-        'abc', 'tasks', '[{"name": "123", "status": "started", "__task_id": {"ID": "value"}}]')
+
+
+@init_wrapper
+def test_migrate_legacy_job(r_mock, subject, mocker):
+    pipe = mocker.MagicMock()
+    pipe.hget = mocker.Mock(
+        return_value=b'[{"args": [], "status": 0, "result": {"stdout": "x", "stderr": null}, "name": "one", '
+                     b'"__task_id": "svc"}]')
+    r_mock.transaction = mocker.Mock(side_effect=lambda fn, *_, **__: fn(pipe))
+    r_mock.scan_iter = mocker.Mock(return_value=[b'abc', b'ab:names', b'other', b'new'])
+    scan_pipe = pipeline_mock(r_mock, mocker)
+    scan_pipe.execute = mocker.Mock(side_effect=[[b'hash', b'string', b'hash'], [True, False]])
+    assert subject.migrate_legacy_jobs() == 1
+    r_mock.scan_iter.assert_called_once_with(match='?' * 26, count=JobDb.SWEEP_BATCH)
+    scan_pipe.type.assert_has_calls([call('abc'), call('other'), call('new')])
+    scan_pipe.hexists.assert_has_calls([call('abc', 'tasks'), call('new', 'tasks')])
+    r_mock.transaction.assert_called_once_with(mocker.ANY, 'abc', value_from_callable=True)
+    pipe.hget.assert_called_once_with('abc', 'tasks')
+    pipe.multi.assert_called_once_with()
+    pipe.rpush.assert_called_once_with('abc:names', 'one')
+    pipe.hmset.assert_has_calls([call('abc:args', {'one': '[]'}), call('abc:status', {'one': '0'}),
+                                 call('abc:result', {'one': '{"stdout": "x", "stderr": null}'}),
+                                 call('abc:task_id', {'one': '"svc"'})])
+    pipe.hdel.assert_called_once_with('abc', 'tasks')
+    pipe.sadd.assert_not_called()
+
+
+@init_wrapper
+def test_migrated_unfinished_job_is_active(r_mock, subject, mocker):
+    pipe = mocker.MagicMock()
+    pipe.hget = mocker.Mock(
+        return_value=b'[{"args": [], "status": 0, "result": {"stdout": "x", "stderr": null}, "name": "one"}, '
+                     b'{"args": [], "status": 500, "result": {"stdout": null, "stderr": null}, "name": "two"}]')
+    r_mock.transaction = mocker.Mock(side_effect=lambda fn, *_, **__: fn(pipe))
+    assert subject._migrate_legacy_job('abc')
+    pipe.sadd.assert_called_once_with('swarmer:active_jobs', 'abc')
+
+
+@init_wrapper
+def test_add_dead_letter(r_mock, subject, mocker):
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.add_dead_letter('abc', 'www.callback.com', 'refused')
+    pipe.lpush.assert_called_once_with('swarmer:dead_letters', mocker.ANY)
+    stored = json.loads(pipe.lpush.call_args[0][1])
+    assert (stored['id'], stored['callback'], stored['error']) == ('abc', 'www.callback.com', 'refused')
+    assert 'job' not in stored
+    pipe.ltrim.assert_called_once_with('swarmer:dead_letters', 0, 999)
+    pipe.srem.assert_called_once_with('swarmer:active_jobs', 'abc')
+    pipe.expire.assert_not_called()
+
+
+def test_dead_letter_keeps_job(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    r_mock.smembers = mocker.Mock(return_value=set())
+    subject = JobDb(r_mock, job_ttl=100, dead_letter_limit=10)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.add_dead_letter('abc', 'www.callback.com', 'refused')
+    pipe.ltrim.assert_called_once_with('swarmer:dead_letters', 0, 9)
+    pipe.expire.assert_any_call('abc', 100)
+
+
+@init_wrapper
+def test_ping(r_mock, subject, mocker):
+    r_mock.ping = mocker.Mock(side_effect=[True, redis.ConnectionError('refused')])
+    assert subject.ping()
+    assert not subject.ping()
+
+
+def test_jobs_expire_after_ttl(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    subject = JobDb(r_mock, job_ttl=100)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.add_jobs([JobEntry('abc', 'image', 'www.callback.com', [{'task_name': 'one', 'task_args': []}])])
+    pipe.expire.assert_has_calls([call(k, 100) for k in ['abc', 'abc:args', 'abc:status', 'abc:result',
+                                                         'abc:task_id', 'abc:names', 'abc:spec', 'abc:outputs']])
+    subject.add_job('def', 'image', 'www.callback.com')
+    r_mock.expire.assert_called_once_with('def', 100)
+
+
+def test_finishing_job_refreshes_ttl(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    script = script_mock(r_mock, 1)
+    r_mock.smembers = mocker.Mock(return_value={b'one:stdout'})
+    subject = JobDb(r_mock, job_ttl=100)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.complete_task('abc', 'one', 0, {'stdout': 'ok', 'stderr': None})
+    pipe.expire.assert_not_called()
+    r_mock.smembers.assert_not_called()
+    script.return_value = 2
+    subject.complete_task('abc', 'two', 0, {'stdout': 'ok', 'stderr': None})
+    pipe.expire.assert_has_calls([call(k, 100) for k in ['abc', 'abc:args', 'abc:status', 'abc:result',
+                                                         'abc:task_id', 'abc:names', 'abc:spec', 'abc:outputs',
+                                                         'abc:output:one:stdout']])
+
+
+def test_clear_job_keeps_retention(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    r_mock.exists = mocker.Mock(return_value=True)
+    r_mock.smembers = mocker.Mock(return_value=set())
+    subject = JobDb(r_mock, retention=60)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.clear_job('abc')
+    pipe.delete.assert_not_called()
+    assert pipe.expire.call_count == 8
+    pipe.expire.assert_any_call('abc', 60)
+
+
+def test_sweep_keys(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    subject = JobDb(r_mock, job_ttl=100)
+    pipe = pipeline_mock(r_mock, mocker)
+    pipe.execute = mocker.Mock(side_effect=[[-2, 50, -1, -1], [], [True, False], []])
+    r_mock.scan_iter = mocker.Mock(return_value=[b'gone:args', b'kept:args', b'old:args', b'old:status',
+                                                 b'swarmer:entries'])
+    r_mock.sscan_iter = mocker.Mock(return_value=[b'kept', b'lost'])
+    assert subject.sweep_keys() == 3
+    r_mock.scan_iter.assert_called_once_with(match='*:*', count=JobDb.SWEEP_BATCH)
+    pipe.ttl.assert_has_calls([call('gone'), call('kept'), call('old'), call('old')])
+    pipe.delete.assert_called_once_with(b'gone:args')
+    pipe.expire.assert_any_call('old', 100)
+    assert pipe.expire.call_count == 8
+    pipe.exists.assert_has_calls([call('kept'), call('lost')])
+    r_mock.srem.assert_called_once_with('swarmer:active_jobs', 'lost')
+
+
+@init_wrapper
+def test_task_specs_are_kept(r_mock, subject, mocker):
+    pipe = pipeline_mock(r_mock, mocker)
+    spec = {'resources': {'cpu_reservation': 1}, 'constraints': None}
+    subject.add_jobs([JobEntry('abc', 'image', 'www.callback.com', [{'task_name': 'one', 'task_args': [],
+                                                                     'resources': spec['resources']},
+                                                                    {'task_name': 'two', 'task_args': []}])])
+    pipe.hmset.assert_any_call('abc:spec', {'one': json.dumps(spec)})
+    pipe.sadd.assert_called_once_with('swarmer:active_jobs', 'abc')
+    r_mock.hgetall = mocker.Mock(return_value={b'one': json.dumps(spec).encode()})
+    assert subject.get_task_specs('abc') == {'one': spec}
+
+
+@init_wrapper
+def test_get_active_jobs(r_mock, subject, mocker):
+    r_mock.sscan_iter = mocker.Mock(return_value=[b'def', b'abc', b'gone'])
+    pipeline_mock(r_mock, mocker, [True, True, False])
+    assert subject.get_active_jobs() == ['abc', 'def']
+    r_mock.srem.assert_called_once_with('swarmer:active_jobs', 'gone')
+
+
+def test_large_outputs_are_stored_apart(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    script_mock(r_mock, 1)
+    subject = JobDb(r_mock, inline_limit=4)
+    pipe = pipeline_mock(r_mock, mocker)
+    subject.complete_task('abc', 'one', 0, {'stdout': 'long output', 'stderr': 'ok'})
+    staged = r_mock.set.call_args[0][0]
+    assert staged.startswith('abc:output:one:stdout:staged:')
+    r_mock.set.assert_called_once_with(staged, b'long output', ex=JobDb.STAGED_OUTPUT_TTL)
+    _, kwargs = r_mock.register_script.return_value.call_args
+    assert kwargs['args'] == task_args('one', '0', json.dumps({'stdout': None, 'stderr': 'ok'}), only_pending='1')
+    pipe.rename.assert_called_once_with(staged, 'abc:output:one:stdout')
+    pipe.sadd.assert_called_once_with('abc:outputs', 'one:stdout')
+    r_mock.delete.assert_not_called()
+
+
+def test_large_outputs_of_completed_tasks_are_dropped(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    script_mock(r_mock, -1)
+    subject = JobDb(r_mock, inline_limit=4)
+    pipe = pipeline_mock(r_mock, mocker)
+    assert not subject.complete_task('abc', 'one', 0, {'stdout': 'late output', 'stderr': None})
+    r_mock.delete.assert_called_once_with(r_mock.set.call_args[0][0])
+    pipe.rename.assert_not_called()
+
+
+def test_large_results_are_compressed(mocker):
+    r_mock = mocker.Mock(spec=redis.StrictRedis)
+    script = r_mock.register_script.return_value
+    script.return_value = 1
+    subject = JobDb(r_mock, compress_threshold=40)
+    result = {'stdout': 'x' * 100, 'stderr': None}
+    subject.complete_task('abc', 'one', 0, result)
+    _, kwargs = script.call_args
+    name, _, _, _, status, stored = kwargs['args']
+    assert (name, status) == ('one', '0')
+    assert stored.startswith(JobDb.COMPRESSED_PREFIX)
+    assert json.loads(zlib.decompress(stored[len(JobDb.COMPRESSED_PREFIX):])) == result
+
+
+@init_wrapper
+def test_get_task_decompresses_result(r_mock, subject, mocker):
+    r_mock.exists = mocker.MagicMock(return_value=True)
+    result = {'stdout': 'x' * 100, 'stderr': None}
+    pipeline_mock(r_mock, mocker, [b'["a"]', b'0', JobDb.COMPRESSED_PREFIX + zlib.compress(json.dumps(result).encode()),
+                                   None])
+    assert subject.get_task('abc', 'one')['result'] == result
+
+@init_wrapper
+def test_append_output_raises(r_mock, subject, mocker):
+    with pytest.raises(ValueError):
+        subject.append_output('abc', 'one', 'stdin', b'data')
+    script_mock(r_mock, -1)
+    subject = JobDb(r_mock)
+    with pytest.raises(ValueError):
+        subject.append_output('abc', 'one', 'stdout', b'data')
+
+
+@init_wrapper
+def test_read_output(r_mock, subject, mocker):
+    r_mock.strlen = mocker.Mock(return_value=10)
+    r_mock.getrange = mocker.Mock(side_effect=[b'0123', b'4567', b'89'])
+    assert list(subject.read_output('abc', 'one', 'stdout', chunk_size=4)) == [b'0123', b'4567', b'89']
+    r_mock.getrange.assert_called_with('abc:output:one:stdout', 8, 9)
+    r_mock.strlen = mocker.Mock(return_value=0)
+    with pytest.raises(ValueError):
+        subject.read_output('abc', 'one', 'stdout')
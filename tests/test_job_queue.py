@@ -1,8 +1,12 @@
 import datetime
-from threading import Thread
+from threading import Event, Thread
+
+import pytest
 
 from db import JobDb
+from jobs.delivery import ResultDelivery
 from jobs.queue import JobQueue
+from models import JobEntry
 
 FAKE_DATE = datetime.datetime(2019, 1, 1, 17, 5)
 
@@ -24,6 +28,27 @@ def test_add_job(mocker):
     threader_mock.assert_called()
 
 
+def test_add_jobs(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    jobs = [JobEntry('abc123', 'some-image', 'www.someurl.com', [{'task_name': 'first', 'task_args': ['a']}]),
+            JobEntry('def456', 'some-image', 'www.someurl.com', [{'task_name': 'second', 'task_args': ['b']}])]
+    subject.add_new_jobs(jobs)
+    job_log_mock.add_jobs.assert_called_once_with(jobs)
+    job_log_mock.add_job.assert_not_called()
+    assert [t.identifier for t in subject.get_next_tasks()] == ['abc123', 'def456']
+
+
+def test_add_jobs_requires_tasks(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    with pytest.raises(ValueError):
+        subject.add_new_jobs([JobEntry('abc123', 'some-image', 'www.someurl.com', [])])
+    job_log_mock.add_jobs.assert_not_called()
+
+
 def test_get_runnable(mocker):
     job_log_mock = mocker.Mock(spec=JobDb)
     threader_mock = mocker.Mock(spec=Thread)
@@ -55,10 +80,195 @@ def test_get_started(mocker, monkeypatch):
     assert item['started'] == FAKE_DATE
 
 
-def test_send_results(mocker):
-    import requests
-    from jobs.queue import _send_job_results
-    requests.post = mocker.Mock()
-    details = [{'__callback': 'urlone', 'something': 'else'}]
-    _send_job_results(details)
-    requests.post.assert_called_once_with('urlone', json={'__callback': 'urlone', 'something': 'else'})
+def test_complete_task(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com',
+                        [{'task_name': 'first', 'task_args': ['a', 'b', 'c']}])
+    next_up = subject.get_next_tasks()[0]
+    subject.mark_task_started(next_up.identifier, next_up.name, 1)
+    subject.complete_task('abc123', 'first', 0, {'stdout': 'ok', 'stderr': ''})
+    job_log_mock.complete_task.assert_called_once_with('abc123', 'first', 0, {'stdout': 'ok', 'stderr': ''})
+    job_log_mock.update_status.assert_not_called()
+    job_log_mock.update_result.assert_not_called()
+    assert subject.get_started_tasks() == []
+
+
+def test_complete_task_matches_job(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    tasks = [{'task_name': 'same', 'task_args': []}]
+    subject.add_new_jobs([JobEntry('abc123', 'some-image', 'www.someurl.com', tasks),
+                          JobEntry('def456', 'some-image', 'www.someurl.com', tasks)])
+    for task in subject.get_next_tasks():
+        subject.mark_task_started(task.identifier, task.name, task.identifier + '-svc')
+    services, _ = subject.complete_task('def456', 'same', 0, {'stdout': '', 'stderr': ''})
+    assert services == ['def456-svc']
+    assert [t['id'] for t in subject.get_started_tasks()] == ['abc123-svc']
+
+
+def test_complete_last_task_completes_job(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com',
+                        [{'task_name': 'first', 'task_args': []}, {'task_name': 'second', 'task_args': []}])
+    subject.get_next_tasks()
+    subject.complete_task('abc123', 'first', 0, {'stdout': '', 'stderr': ''})
+    assert subject._completed_jobs == []
+    subject.complete_task('abc123', 'second', 0, {'stdout': '', 'stderr': ''})
+    assert subject._completed_jobs == ['abc123']
+
+
+def test_complete_unknown_task(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock)
+    assert subject.complete_task('abc123', 'first', 0, {'stdout': '', 'stderr': ''}) == ([], False)
+    job_log_mock.complete_task.assert_not_called()
+
+
+def test_complete_task_already_completed(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    job_log_mock.complete_task.return_value = False
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', [{'task_name': 'first', 'task_args': []}])
+    subject.get_next_tasks()
+    subject.mark_task_started('abc123', 'first', 'svc')
+    # A run of a task that was completed in the store meanwhile still frees its slot
+    assert subject.complete_task('abc123', 'first', 0, {'stdout': 'late', 'stderr': ''}) == (['svc'], False)
+    assert not subject.is_task_running('abc123', 'first')
+    assert subject.complete_task('abc123', 'first', 0, {'stdout': 'late', 'stderr': ''}) == ([], False)
+
+
+def test_completed_job_is_delivered_immediately(mocker):
+    delivered = Event()
+    send_mock = mocker.Mock(spec=ResultDelivery)
+    send_mock.send.side_effect = lambda _: delivered.set()
+    job_log_mock = mocker.Mock(spec=JobDb)
+    job_log_mock.get_job.return_value = {'__callback': 'www.someurl.com', 'tasks': []}
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock, delivery=send_mock)
+    subject.COMPLETED_WAIT_TIMEOUT = 0.01
+    Thread(target=subject._process_completed_jobs, daemon=True).start()
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', [{'task_name': 'first', 'task_args': []}])
+    subject.get_next_tasks()
+    subject.complete_task('abc123', 'first', 0, {'stdout': '', 'stderr': ''})
+    assert delivered.wait(timeout=2)
+    send_mock.send.assert_called_once_with([('abc123', {'__callback': 'www.someurl.com', 'tasks': []})])
+    # The job is only cleared by the delivery, once its results were sent
+    job_log_mock.clear_job.assert_not_called()
+
+
+def test_unreadable_completed_job_is_dead_lettered(mocker):
+    delivered = Event()
+    send_mock = mocker.Mock(spec=ResultDelivery)
+    send_mock.send.side_effect = lambda _: delivered.set()
+    job_log_mock = mocker.Mock(spec=JobDb)
+    job_log_mock.get_job.side_effect = [ValueError('Can not find job with id: abc123'),
+                                        {'__callback': 'www.someurl.com', 'tasks': []}]
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread), delivery=send_mock)
+    subject.COMPLETED_WAIT_TIMEOUT = 0.01
+    subject._completed_jobs = ['abc123', 'def456']
+    Thread(target=subject._process_completed_jobs, daemon=True).start()
+    assert delivered.wait(timeout=2)
+    send_mock.send.assert_called_once_with([('def456', {'__callback': 'www.someurl.com', 'tasks': []})])
+    job_log_mock.add_dead_letter.assert_called_once_with('abc123', None, 'Can not find job with id: abc123')
+
+
+def test_is_task_running(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', [{'task_name': 'first', 'task_args': []}])
+    assert not subject.is_task_running('abc123', 'first')
+    subject.get_next_tasks()
+    assert subject.is_task_running('abc123', 'first')
+    assert not subject.is_task_running('other', 'first')
+    subject.mark_task_started('abc123', 'first', 'svc')
+    assert subject.is_task_running('abc123', 'first', task_id='svc')
+    # An exit from the service of an earlier run is not this run
+    assert not subject.is_task_running('abc123', 'first', task_id='old-svc')
+
+
+def test_growing_queue_len_signals_run(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    subject = JobQueue(job_log_mock, queue_len=1, thread_builder=mocker.Mock(spec=Thread))
+    subject.run_signal = mocker.Mock()
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com',
+                        [{'task_name': 'first', 'task_args': []}, {'task_name': 'second', 'task_args': []}])
+    assert len(subject.get_next_tasks()) == 1
+    subject.queue_len = 2
+    assert subject.queue_len == 2
+    subject.run_signal.assert_called_once_with()
+    assert len(subject.get_next_tasks()) == 1
+
+
+def test_get_next_tasks_within_resource_capacity(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.resource_capacity = (4, 1024)
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', [
+        {'task_name': 'first', 'task_args': [], 'resources': {'cpu_reservation': 3}, 'constraints': ['a==b']},
+        {'task_name': 'second', 'task_args': [], 'resources': {'cpu_reservation': 2}},
+        {'task_name': 'third', 'task_args': []}])
+    next_up = subject.get_next_tasks()
+    assert [(t.name, t.resources, t.constraints) for t in next_up] == [('first', {'cpu_reservation': 3}, ['a==b'])]
+    subject.complete_task('abc123', 'first', 0, {'stdout': '', 'stderr': ''})
+    assert [t.name for t in subject.get_next_tasks()] == ['second', 'third']
+
+
+def test_sweeps_job_keys(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    threader_mock = mocker.Mock(spec=Thread)
+    subject = JobQueue(job_log_mock, thread_builder=threader_mock, sweep_interval=60)
+    subject._sweeper.run_once()
+    job_log_mock.sweep_keys.assert_called_once_with()
+    assert JobQueue(job_log_mock, thread_builder=threader_mock)._sweeper is None
+
+
+def test_recover(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    job_log_mock.get_active_jobs.return_value = ['abc', 'done']
+    pending = JobDb.PENDING_STATUS
+    jobs = {
+        'abc': {'__image': 'some-image', '__callback': 'www.someurl.com', 'tasks': [
+            {'name': 'one', 'args': ['a'], 'status': 0},
+            {'name': 'two', 'args': [], 'status': pending},
+            {'name': 'three', 'args': [], 'status': pending}
+        ]},
+        'done': {'__image': 'some-image', '__callback': 'www.someurl.com', 'tasks': [
+            {'name': 'one', 'args': [], 'status': 0}
+        ]}
+    }
+    job_log_mock.get_job.side_effect = jobs.get
+    job_log_mock.get_task_specs.side_effect = lambda i: {'three': {'resources': {'cpu_reservation': 1},
+                                                                   'constraints': None}} if i == 'abc' else {}
+    run_signal = mocker.Mock()
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.run_signal = run_signal
+    assert subject.recover({('abc', 'two'): 'svc'}) == 2
+    assert subject.is_task_running('abc', 'two')
+    assert subject.get_started_tasks()[0]['id'] == 'svc'
+    assert subject._completed_jobs == ['done']
+    next_tasks = subject.get_next_tasks()
+    assert [(t.name, t.resources) for t in next_tasks] == [('three', {'cpu_reservation': 1})]
+    run_signal.assert_called_once()
+    job_log_mock.complete_task = mocker.Mock()
+    subject.complete_task('abc', 'two', 0, {})
+    assert subject.complete_task('abc', 'three', 0, {}) == ([], False)
+    assert subject._completed_jobs == ['done', 'abc']
+
+
+def test_mark_task_started_records_service(mocker):
+    job_log_mock = mocker.Mock(spec=JobDb)
+    subject = JobQueue(job_log_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.add_new_job('abc123', 'some-image', 'www.someurl.com', [{'task_name': 'first', 'task_args': []}])
+    subject.mark_task_started('abc123', 'other', 'svc')
+    job_log_mock.set_task_id.assert_not_called()
+    subject.get_next_tasks()
+    job_log_mock.set_task_id.side_effect = ValueError('Unable to locate task')
+    subject.mark_task_started('abc123', 'first', 'svc')
+    job_log_mock.set_task_id.assert_called_once_with('abc123', 'first', 'svc')
+    assert subject.get_started_tasks()[0]['id'] == 'svc'
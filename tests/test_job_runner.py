@@ -1,8 +1,14 @@
+from threading import Thread
+
 import ulid
 
 from jobs import JobRunner
+from jobs.links import OutputLinks
+from jobs.notifier import StatusNotifier
+from jobs.pool import WorkerPool
 from jobs.queue import JobQueue, RunnableTask
-from models import RunnerConfig
+from jobs.warmer import ImageWarmer
+from models import JobEntry, RunnerConfig
 from wrapper import DockerWrapper
 
 cfg = RunnerConfig('swarmer', '1234', 'overlay')
@@ -38,14 +44,30 @@ def test_create_job(**kwargs):
     identifier = ulid.new()
     mocker.patch.object(ulid, 'new')
     ulid.new = mocker.MagicMock(return_value=identifier)
-    subject = JobRunner(docker_mock, job_queue_mock)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
     result = subject.create_new_job('image', 'www.example.com', [{'task_name': 'one', 'task_args': ['a', 'b', 'c']}])
     ulid.new.assert_called_once()
     job_queue_mock.add_new_job.assert_called_once_with(
-        identifier.str, 'image', 'www.example.com', [{'task_name': 'one', 'task_args': ['a', 'b', 'c']}])
+        identifier.str, 'image', 'www.example.com', [{'task_name': 'one', 'task_args': ['a', 'b', 'c']}],
+        priority=None, tenant=None, batch_size=None)
     assert result == identifier.str
 
 
+@injection_wrapper
+def test_create_jobs(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=[])
+    first, second = ulid.new(), ulid.new()
+    mocker.patch.object(ulid, 'new', side_effect=[first, second])
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    tasks = [{'task_name': 'one', 'task_args': []}]
+    result = subject.create_new_jobs([('image', 'www.example.com', tasks), ('other', 'www.example.com', tasks)])
+    job_queue_mock.add_new_jobs.assert_called_once_with([JobEntry(first.str, 'image', 'www.example.com', tasks),
+                                                         JobEntry(second.str, 'other', 'www.example.com', tasks)])
+    job_queue_mock.get_next_tasks.assert_not_called()
+    assert result == [first.str, second.str]
+
+
 subject_job = {
     '__image': 'an-image',
     '__callback': 'www.example.com',
@@ -79,11 +101,14 @@ def test_add_tasks_to_job(**kwargs):
     job_queue_mock.get_job = mocker.Mock(return_value=subject_job)
     job_queue_mock.get_next_tasks = mocker.Mock(
         return_value=[RunnableTask(identifier.str, t['task_name'], t['task_args'], 'an-image') for t in call_tasks])
-    subject = JobRunner(docker_mock, job_queue_mock)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
     subject.create_new_job(subject_job['__image'], subject_job['__callback'], subject_job['tasks'])
     job_queue_mock.add_new_job.assert_called_once_with(identifier.str, subject_job['__image'],
-                                                       subject_job['__callback'], subject_job['tasks'])
+                                                       subject_job['__callback'], subject_job['tasks'],
+                                                       priority=None, tenant=None, batch_size=None)
+    job_queue_mock.mark_task_started.assert_not_called()
 
+    subject._scheduler.run_once()
     job_queue_mock.mark_task_started.assert_called()
 
 
@@ -92,7 +117,296 @@ def test_complete_task(**kwargs):
     job_queue_mock, docker_mock, mocker, monkeypatch = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs[
         'mocker'], kwargs['monkeypatch']
 
-    subject = JobRunner(docker_mock, job_queue_mock)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
     job_queue_mock.complete_task = mocker.Mock(return_value=([123456], False))
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=[])
     subject.complete_task('abc', 'test', 0, {'stdout': 'ok', 'stderr': None})
     job_queue_mock.complete_task.assert_called_once_with('abc', 'test', 0, {'stdout': 'ok', 'stderr': None})
+    docker_mock.remove_service.assert_not_called()
+
+    subject._scheduler.run_once()
+    docker_mock.remove_service.assert_called_once_with([123456])
+
+
+@injection_wrapper
+def test_run_tasks_isolates_failures(**kwargs):
+    from docker.errors import APIError
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.get_next_tasks = mocker.Mock(
+        return_value=[RunnableTask('abc', t['task_name'], t['task_args'], 'an-image') for t in call_tasks])
+    job_queue_mock.complete_task = mocker.Mock(return_value=([], False))
+
+    def start_task(identifier, image, name, args, **_):
+        if name == 'two':
+            raise APIError('conflict')
+        return 'svc-one'
+
+    docker_mock.start_task = mocker.Mock(side_effect=start_task)
+    subject = JobRunner(docker_mock, job_queue_mock, dispatch_workers=2, thread_builder=mocker.Mock(spec=Thread))
+    subject.create_new_job('an-image', 'www.example.com', call_tasks)
+    subject._scheduler.run_once()
+    assert docker_mock.start_task.call_count == 2
+    job_queue_mock.mark_task_started.assert_called_once_with('abc', 'one', 'svc-one')
+    job_queue_mock.complete_task.assert_called_once_with(
+        'abc', 'two', JobRunner.START_FAILED_STATUS,
+        {'stdout': None, 'stderr': 'Unable to start the task service: conflict'})
+
+
+@injection_wrapper
+def test_run_tasks_fails_tasks_on_any_error(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.get_next_tasks = mocker.Mock(
+        return_value=[RunnableTask('abc', t['task_name'], t['task_args'], 'an-image') for t in call_tasks])
+    job_queue_mock.complete_task = mocker.Mock(side_effect=[RuntimeError('redis is down'), ([], False)])
+    pool_mock = mocker.Mock(spec=WorkerPool)
+    pool_mock.submit = mocker.Mock(side_effect=RuntimeError('redis is down'))
+    subject = JobRunner(docker_mock, job_queue_mock, dispatch_workers=2, thread_builder=mocker.Mock(spec=Thread),
+                        pool=pool_mock)
+    subject._scheduler.run_once()
+    assert pool_mock.submit.call_count == 2
+    job_queue_mock.mark_task_started.assert_not_called()
+    assert job_queue_mock.complete_task.call_count == 2
+    job_queue_mock.complete_task.assert_called_with(
+        'abc', mocker.ANY, JobRunner.START_FAILED_STATUS,
+        {'stdout': None, 'stderr': 'Unable to start the task service: redis is down'})
+
+
+@injection_wrapper
+def test_handle_task_exit(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.is_task_running = mocker.Mock(return_value=True)
+    job_queue_mock.complete_task = mocker.Mock(return_value=(['svc'], True))
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.handle_task_exit('abc', 'one', 137, True, 'svc')
+    job_queue_mock.is_task_running.assert_called_once_with('abc', 'one', task_id='svc')
+    job_queue_mock.complete_task.assert_called_once_with(
+        'abc', 'one', JobRunner.OOM_KILLED_STATUS,
+        {'stdout': None, 'stderr': 'The task container was killed after running out of memory'})
+
+
+@injection_wrapper
+def test_handle_clean_task_exit_without_results(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.is_task_running = mocker.Mock(return_value=True)
+    job_queue_mock.complete_task = mocker.Mock(return_value=([], False))
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.handle_task_exit('abc', 'one', 0, False)
+    job_queue_mock.complete_task.assert_called_once_with(
+        'abc', 'one', JobRunner.NO_RESULTS_STATUS,
+        {'stdout': None, 'stderr': 'The task container exited with code 0 without reporting results'})
+
+
+@injection_wrapper
+def test_handle_task_exit_after_results(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.is_task_running = mocker.Mock(return_value=False)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.handle_task_exit('abc', 'one', 0, False)
+    job_queue_mock.complete_task.assert_not_called()
+
+
+@injection_wrapper
+def test_complete_pool_task(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    pool_mock = mocker.Mock(spec=WorkerPool)
+    job_queue_mock.complete_task = mocker.Mock(return_value=([], False))
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), pool=pool_mock)
+    subject.complete_task('abc', 'one', 0, {'stdout': 'ok', 'stderr': None})
+    pool_mock.finish_task.assert_called_once_with('abc', 'one')
+
+
+@injection_wrapper
+def test_run_tasks_in_pool(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    pool_mock = mocker.Mock(spec=WorkerPool)
+    task = RunnableTask('abc', 'one', [], 'an-image')
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=[task])
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), pool=pool_mock)
+    subject._scheduler.run_once()
+    pool_mock.submit.assert_called_once_with(task)
+    docker_mock.start_task.assert_not_called()
+    job_queue_mock.mark_task_started.assert_called_once_with('abc', 'one', None)
+
+
+@injection_wrapper
+def test_run_tasks_outside_pool(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    pool_mock = mocker.Mock(spec=WorkerPool)
+    pooled = RunnableTask('abc', 'one', [], 'an-image')
+    sized = RunnableTask('abc', 'two', [], 'an-image', resources={'cpu_reservation': 2})
+    placed = RunnableTask('abc', 'three', [], 'an-image', constraints=['node.role==worker'])
+    batched = [RunnableTask('def', str(i), [], 'an-image', batch_size=2) for i in range(2)]
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=[pooled, sized, placed] + batched)
+    docker_mock.start_task = mocker.Mock(side_effect=lambda identifier, image, name, *_, **__: 'svc-' + name)
+    docker_mock.start_batch = mocker.Mock(return_value='svc-batch')
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), pool=pool_mock)
+    subject._scheduler.run_once()
+    pool_mock.submit.assert_called_once_with(pooled)
+    docker_mock.start_task.assert_has_calls([
+        mocker.call('abc', 'an-image', 'two', [], resources={'cpu_reservation': 2}, constraints=None),
+        mocker.call('abc', 'an-image', 'three', [], resources=None, constraints=['node.role==worker'])],
+        any_order=True)
+    docker_mock.start_batch.assert_called_once_with('def', 'an-image', [{'task_name': '0', 'task_args': []},
+                                                                        {'task_name': '1', 'task_args': []}],
+                                                    resources=None, constraints=None)
+    job_queue_mock.mark_task_started.assert_any_call('abc', 'one', None)
+    job_queue_mock.mark_task_started.assert_any_call('abc', 'two', 'svc-two')
+    job_queue_mock.mark_task_started.assert_any_call('def', '1', 'svc-batch')
+
+
+@injection_wrapper
+def test_run_tasks_in_batches(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    batched = [RunnableTask('abc', str(i), [str(i)], 'an-image', batch_size=2) for i in range(3)]
+    single = RunnableTask('def', 'solo', [], 'other-image')
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=batched + [single])
+    docker_mock.start_batch = mocker.Mock(return_value='batch-svc')
+    docker_mock.start_task = mocker.Mock(return_value='solo-svc')
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject._scheduler.run_once()
+    docker_mock.start_batch.assert_called_once_with(
+        'abc', 'an-image', [{'task_name': '0', 'task_args': ['0']}, {'task_name': '1', 'task_args': ['1']}],
+        resources=None, constraints=None)
+    assert docker_mock.start_task.call_count == 2
+    started = {c[0][1]: c[0][2] for c in job_queue_mock.mark_task_started.call_args_list}
+    assert started == {'0': 'batch-svc', '1': 'batch-svc', '2': 'solo-svc', 'solo': 'solo-svc'}
+
+
+@injection_wrapper
+def test_complete_tasks_removes_batch_service_once(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.complete_task = mocker.Mock(side_effect=[(['batch-svc'], False), (['batch-svc'], True)])
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    subject.complete_tasks('abc', [('one', 0, {'stdout': 'a', 'stderr': None}), ('two', 1, {'stdout': None,
+                                                                                         'stderr': 'b'})])
+    assert job_queue_mock.complete_task.call_count == 2
+    job_queue_mock.get_next_tasks = mocker.Mock(return_value=[])
+    subject._scheduler.run_once()
+    docker_mock.remove_service.assert_called_once_with(['batch-svc'])
+
+
+@injection_wrapper
+def test_create_jobs_warms_images(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    warmer_mock = mocker.Mock(spec=ImageWarmer)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), warmer=warmer_mock)
+    tasks = [{'task_name': 'one', 'task_args': []}]
+    subject.create_new_jobs([('image', 'www.example.com', tasks), ('image', 'www.example.com', tasks)])
+    warmer_mock.warm.assert_called_once_with('image')
+    subject.create_new_job('other', 'www.example.com', tasks)
+    warmer_mock.warm.assert_called_with('other')
+
+
+@injection_wrapper
+def test_recover(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    docker_mock.task_services.return_value = {('abc', 'one'): 'svc'}
+    job_queue_mock.recover.return_value = 1
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread))
+    assert subject.recover() == 1
+    job_queue_mock.recover.assert_called_once_with({('abc', 'one'): 'svc'})
+
+
+@injection_wrapper
+def test_get_job_links_outputs(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    job_queue_mock.get_job_details.return_value = {'tasks': [
+        {'name': 'one', 'result': {'stdout': None, 'stderr': None, 'outputs': {'stdout': '/output/abc/one/stdout'}}}
+    ]}
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread),
+                        links=OutputLinks('http://swarmer:8500', secret='secret'))
+    link = subject.get_job('abc')['tasks'][0]['result']['outputs']['stdout']
+    params = dict(p.split('=') for p in link.partition('?')[2].split('&'))
+    assert subject.can_read_output('/output/abc/one/stdout', params['expires'], params['signature'])
+    assert not subject.can_read_output('/output/abc/one/stdout', params['expires'], 'forged')
+
+
+def pending_job(version, *statuses):
+    return {'__version': version, 'tasks': [{'name': str(i), 'status': s} for i, s in enumerate(statuses)]}
+
+
+def job_summary(version, total, complete):
+    return {'__image': 'image', '__version': version, '__finished_at': None,
+            'counts': {'total': total, 'pending': 0, 'running': total - complete, 'complete': complete, 'failed': 0}}
+
+
+@injection_wrapper
+def test_watch_job(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    notifier_mock = mocker.Mock(spec=StatusNotifier)
+    notifier_mock.watch.return_value = 4
+    notifier_mock.wait.return_value = 5
+    notifier_mock.changed_tasks.return_value = {'0'}
+    job_queue_mock.get_job_summary.side_effect = [job_summary(2, 1, 0), job_summary(3, 1, 1)]
+    job_queue_mock.get_task_details.return_value = {'name': '0', 'status': 0}
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), notifier=notifier_mock)
+    assert subject.watch_job('abc', since=2, timeout=10) == dict(job_summary(3, 1, 1),
+                                                                 tasks=[{'name': '0', 'status': 0}])
+    notifier_mock.wait.assert_called_once_with('abc', 4, 10)
+    notifier_mock.changed_tasks.assert_called_once_with('abc', 4)
+    job_queue_mock.get_task_details.assert_called_once_with('abc', '0')
+    job_queue_mock.get_job_details.assert_not_called()
+    notifier_mock.unwatch.assert_called_once_with('abc')
+
+
+@injection_wrapper
+def test_watch_job_full(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    notifier_mock = mocker.Mock(spec=StatusNotifier)
+    notifier_mock.wait.return_value = 1
+    notifier_mock.changed_tasks.side_effect = [{'0'}, None]
+    job_queue_mock.get_job_summary.return_value = job_summary(2, 1, 0)
+    job_queue_mock.get_job_details.return_value = pending_job(3, 0)
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), notifier=notifier_mock)
+    assert subject.watch_job('abc', since=2, full=True) == pending_job(3, 0)
+    # Clearing the job changes all of it
+    assert subject.watch_job('abc', since=2) == pending_job(3, 0)
+    job_queue_mock.get_task_details.assert_not_called()
+
+
+@injection_wrapper
+def test_watch_job_times_out(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    notifier_mock = mocker.Mock(spec=StatusNotifier)
+    notifier_mock.wait.return_value = None
+    job_queue_mock.get_job_summary.return_value = job_summary(2, 1, 0)
+    job_queue_mock.get_job_details.return_value = pending_job(2, 500)
+    job_queue_mock.get_job_version.return_value = 2
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), notifier=notifier_mock)
+    assert subject.watch_job('abc', since=2) is None
+    job_queue_mock.get_job_details.assert_not_called()
+    assert subject.watch_job('abc', since=1) == pending_job(2, 500)
+    assert notifier_mock.unwatch.call_count == 2
+
+
+@injection_wrapper
+def test_follow_job_until_finished(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    notifier_mock = mocker.Mock(spec=StatusNotifier)
+    notifier_mock.watch.return_value = 0
+    notifier_mock.wait.side_effect = [None, 1]
+    notifier_mock.changed_tasks.return_value = {'1'}
+    job_queue_mock.get_job_summary.side_effect = [job_summary(1, 2, 1), job_summary(2, 2, 2)]
+    job_queue_mock.get_job_details.return_value = pending_job(1, 0, 500)
+    job_queue_mock.get_task_details.return_value = {'name': '1', 'status': 1}
+    job_queue_mock.get_job_version.return_value = 1
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), notifier=notifier_mock)
+    changes = list(subject.follow_job('abc', keepalive=5))
+    assert changes == [pending_job(1, 0, 500), None, dict(job_summary(2, 2, 2), tasks=[{'name': '1', 'status': 1}])]
+    job_queue_mock.get_job_details.assert_called_once_with('abc', fields=None)
+    notifier_mock.changed_tasks.assert_called_once_with('abc', 0)
+    notifier_mock.unwatch.assert_called_once_with('abc')
+
+
+@injection_wrapper
+def test_follow_job_from_version(**kwargs):
+    job_queue_mock, docker_mock, mocker = kwargs['job_queue_mock'], kwargs['docker_mock'], kwargs['mocker']
+    notifier_mock = mocker.Mock(spec=StatusNotifier)
+    notifier_mock.wait.return_value = 1
+    notifier_mock.changed_tasks.return_value = {'0'}
+    job_queue_mock.get_job_summary.side_effect = [job_summary(3, 1, 0), job_summary(4, 1, 1)]
+    job_queue_mock.get_task_details.return_value = {'name': '0', 'status': 0}
+    subject = JobRunner(docker_mock, job_queue_mock, thread_builder=mocker.Mock(spec=Thread), notifier=notifier_mock)
+    changes = list(subject.follow_job('abc', since=3))
+    assert changes == [dict(job_summary(4, 1, 1), tasks=[{'name': '0', 'status': 0}])]
+    job_queue_mock.get_job_details.assert_not_called()
@@ -0,0 +1,34 @@
+from jobs.links import OutputLinks
+
+
+def test_unsigned_links():
+    subject = OutputLinks('http://swarmer:8500/')
+    assert subject.link('/output/abc/one/stdout') == 'http://swarmer:8500/output/abc/one/stdout'
+    assert subject.verify('/output/abc/one/stdout', None, None)
+
+
+def test_signed_links():
+    subject = OutputLinks('http://swarmer:8500', secret='secret', ttl=60, clock=lambda: 1000)
+    link = subject.link('/output/abc/one/stdout')
+    path, _, query = link[len('http://swarmer:8500'):].partition('?')
+    params = dict(p.split('=') for p in query.split('&'))
+    assert params['expires'] == '1060'
+    assert subject.verify(path, params['expires'], params['signature'])
+    assert not subject.verify('/output/abc/two/stdout', params['expires'], params['signature'])
+    assert not subject.verify(path, '2000', params['signature'])
+    assert not subject.verify(path, None, None)
+
+    expired = OutputLinks('http://swarmer:8500', secret='secret', ttl=60, clock=lambda: 2000)
+    assert not expired.verify(path, params['expires'], params['signature'])
+
+
+def test_resolve():
+    subject = OutputLinks('http://swarmer:8500')
+    details = {'__callback': 'url', 'tasks': [
+        {'name': 'one', 'result': {'stdout': None, 'stderr': None, 'outputs': {'stdout': '/output/abc/one/stdout'}}},
+        {'name': 'two', 'result': {'stdout': 'ok', 'stderr': None}}
+    ]}
+    resolved = subject.resolve(details)
+    assert resolved['tasks'][0]['result']['outputs'] == {'stdout': 'http://swarmer:8500/output/abc/one/stdout'}
+    assert resolved['tasks'][1] == details['tasks'][1]
+    assert details['tasks'][0]['result']['outputs'] == {'stdout': '/output/abc/one/stdout'}
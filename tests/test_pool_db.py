@@ -0,0 +1,72 @@
+import json
+
+import redis
+
+from db import PoolDb
+
+
+def init_wrapper(f):
+    def get_redis_mock(mocker):
+        r_mock = mocker.Mock(spec=redis.StrictRedis)
+        subject = PoolDb(r_mock)
+        return f(r_mock, subject, mocker)
+    return get_redis_mock
+
+
+@init_wrapper
+def test_push_task(r_mock, subject, mocker):
+    script = r_mock.register_script.return_value
+    script.return_value = 1
+    assert subject.push_task('p1', 'image', {'job_id': 'abc', 'task_name': 'one', 'task_args': []})
+    script.assert_called_once_with(
+        keys=['swarmer:pools', 'swarmer:pool:p1', 'swarmer:pool_task_pools', 'swarmer:pool_in_flight',
+              'swarmer:pool_images'],
+        args=['p1', json.dumps({'job_id': 'abc', 'task_name': 'one', 'task_args': []}), 'abc:one', mocker.ANY,
+              'image'])
+    script.return_value = 0
+    assert not subject.push_task('p1', 'image', {'job_id': 'abc', 'task_name': 'two', 'task_args': []})
+
+
+@init_wrapper
+def test_pop_task(r_mock, subject, mocker):
+    r_mock.rpop.side_effect = [b'{"job_id": "abc"}', None]
+    assert subject.pop_task('p1') == {'job_id': 'abc'}
+    assert subject.pop_task('p1') is None
+    r_mock.rpop.assert_called_with('swarmer:pool:p1')
+
+
+@init_wrapper
+def test_finish_task(r_mock, subject, mocker):
+    script = r_mock.register_script.return_value
+    script.side_effect = [b'p1', None]
+    assert subject.finish_task('abc', 'one') == 'p1'
+    assert subject.finish_task('abc', 'two') is None
+    script.assert_called_with(keys=['swarmer:pool_task_pools', 'swarmer:pool_in_flight', 'swarmer:pools'],
+                              args=['abc:two', mocker.ANY])
+
+
+@init_wrapper
+def test_withdraw_task(r_mock, subject, mocker):
+    task = {'job_id': 'abc', 'task_name': 'one', 'task_args': []}
+    subject.withdraw_task('p1', task)
+    r_mock.lrem.assert_called_once_with('swarmer:pool:p1', 1, json.dumps(task))
+    r_mock.register_script.return_value.assert_called_once_with(
+        keys=['swarmer:pool_task_pools', 'swarmer:pool_in_flight', 'swarmer:pools'], args=['abc:one', mocker.ANY])
+
+
+@init_wrapper
+def test_get_idle_pools(r_mock, subject, mocker):
+    r_mock.hgetall.return_value = {b'old': b'100', b'recent': b'900', b'stopping': b'-900', b'stuck': b'-100'}
+    assert subject.get_idle_pools(500) == ['old', 'stuck']
+
+
+@init_wrapper
+def test_claim_and_release_pool(r_mock, subject, mocker):
+    script = r_mock.register_script.return_value
+    script.return_value = 1
+    assert subject.claim_idle_pool('p1', 500)
+    script.assert_called_once_with(keys=['swarmer:pools', 'swarmer:pool_in_flight'], args=['p1', 500, mocker.ANY])
+    script.return_value = b'image'
+    assert subject.release_pool('p1') == 'image'
+    script.return_value = None
+    assert subject.release_pool('p1') is None
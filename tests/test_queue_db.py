@@ -0,0 +1,134 @@
+import json
+from unittest.mock import call
+
+import redis
+
+from db import QueueDb
+from models import JobEntry
+
+
+def init_wrapper(f):
+    def get_redis_mock(mocker):
+        r_mock = mocker.Mock(spec=redis.StrictRedis)
+        r_mock.register_script = mocker.Mock(side_effect=lambda _: mocker.Mock())
+        subject = QueueDb(r_mock)
+        return f(r_mock, subject, mocker)
+
+    return get_redis_mock
+
+
+@init_wrapper
+def test_push_jobs(r_mock, subject, mocker):
+    pipe = mocker.MagicMock()
+    r_mock.pipeline = mocker.Mock(return_value=pipe)
+    subject.push_jobs([JobEntry('abc', 'image', 'www.callback.com',
+                                [{'task_name': 'one', 'task_args': ['a']}, {'task_name': 'two', 'task_args': []}])])
+    pipe.hincrby.assert_called_once_with('swarmer:jobs', 'abc', 2)
+    pipe.hmset.assert_called_once_with('swarmer:entries', {
+        'abc:one': json.dumps({'identifier': 'abc', 'name': 'one', 'args': ['a'], 'image': 'image', 'resources': None,
+                               'constraints': None, 'batch_size': None}),
+        'abc:two': json.dumps({'identifier': 'abc', 'name': 'two', 'args': [], 'image': 'image', 'resources': None,
+                               'constraints': None, 'batch_size': None})})
+    pipe.lpush.assert_called_once_with('swarmer:queue:abc', 'abc:one', 'abc:two')
+    subject._activate_job.assert_called_once_with(
+        keys=['swarmer:passes', 'swarmer:virtual_time', 'swarmer:tenant_jobs', 'swarmer:priorities',
+              'swarmer:job_tenants'], args=['abc', 1, 'job:abc'], client=pipe)
+    pipe.execute.assert_called_once_with()
+
+
+@init_wrapper
+def test_push_jobs_with_reservations(r_mock, subject, mocker):
+    pipe = mocker.MagicMock()
+    r_mock.pipeline = mocker.Mock(return_value=pipe)
+    subject.push_jobs([JobEntry('abc', 'image', 'www.callback.com',
+                                [{'task_name': 'one', 'task_args': [], 'resources': {'cpu_reservation': 0.5}},
+                                 {'task_name': 'two', 'task_args': [], 'resources': {'mem_reservation': 1024}}])])
+    pipe.hmset.assert_any_call('swarmer:reservations:cpus', {'abc:one': 0.5})
+    pipe.hmset.assert_any_call('swarmer:reservations:memory', {'abc:two': 1024})
+
+
+@init_wrapper
+def test_claim_tasks_with_capacity(r_mock, subject, mocker):
+    subject._claim_tasks.return_value = []
+    subject.claim_tasks(12, (8, 4096))
+    _, kwargs = subject._claim_tasks.call_args
+    assert kwargs['args'][2:4] == [8, 4096]
+
+
+@init_wrapper
+def test_claim_tasks(r_mock, subject, mocker):
+    subject._claim_tasks.return_value = [
+        json.dumps({'identifier': 'abc', 'name': 'one', 'args': ['a'], 'image': 'image'}).encode()]
+    claimed = subject.claim_tasks(12)
+    subject._claim_tasks.assert_called_once_with(
+        keys=['swarmer:passes', 'swarmer:running', 'swarmer:entries', 'swarmer:reserved', 'swarmer:reservations:cpus',
+              'swarmer:reservations:memory', 'swarmer:virtual_time', 'swarmer:priorities', 'swarmer:job_tenants',
+              'swarmer:tenant_jobs'],
+        args=[12, mocker.ANY, '', '', 'swarmer:queue:'])
+    assert claimed == [{'identifier': 'abc', 'name': 'one', 'args': ['a'], 'image': 'image'}]
+
+
+@init_wrapper
+def test_complete_task(r_mock, subject, mocker):
+    subject._complete_task.return_value = b'{"task_id": "svc", "started": 1}'
+    assert subject.complete_task('abc', 'one') == {'task_id': 'svc', 'started': 1}
+    subject._complete_task.assert_called_once_with(
+        keys=['swarmer:running', 'swarmer:entries', 'swarmer:jobs', 'swarmer:finished', 'swarmer:reserved',
+              'swarmer:reservations:cpus', 'swarmer:reservations:memory', 'swarmer:priorities', 'swarmer:job_tenants'],
+        args=['abc:one', 'abc'])
+
+
+@init_wrapper
+def test_complete_task_not_running(r_mock, subject, mocker):
+    subject._complete_task.return_value = None
+    assert subject.complete_task('abc', 'one') is None
+
+
+@init_wrapper
+def test_requeue_task(r_mock, subject, mocker):
+    subject._requeue_task.return_value = 1
+    assert subject.requeue_task('abc:one', None)
+    subject._requeue_task.assert_called_once_with(
+        keys=['swarmer:running', 'swarmer:queue:abc', 'swarmer:overdue', 'swarmer:reserved',
+              'swarmer:reservations:cpus', 'swarmer:reservations:memory', 'swarmer:passes', 'swarmer:virtual_time',
+              'swarmer:tenant_jobs', 'swarmer:job_tenants'], args=['abc:one', '', 'abc'])
+
+
+@init_wrapper
+def test_pop_overdue(r_mock, subject, mocker):
+    pipe = mocker.MagicMock()
+    pipe.execute = mocker.Mock(return_value=[{b'svc'}, 1])
+    r_mock.pipeline = mocker.Mock(return_value=pipe)
+    assert subject.pop_overdue() == ['svc']
+    pipe.assert_has_calls([call.smembers('swarmer:overdue'), call.delete('swarmer:overdue')])
+
+
+@init_wrapper
+def test_wait_for_finished_job(r_mock, subject, mocker):
+    r_mock.brpop = mocker.Mock(side_effect=[(b'swarmer:finished', b'abc'), None])
+    assert subject.wait_for_finished_job(5) == 'abc'
+    assert subject.wait_for_finished_job(5) is None
+    r_mock.brpop.assert_called_with('swarmer:finished', timeout=5)
+
+
+@init_wrapper
+def test_is_running(r_mock, subject, mocker):
+    r_mock.hexists = mocker.Mock(return_value=True)
+    assert subject.is_running('abc', 'one')
+    r_mock.hexists.assert_called_once_with('swarmer:running', 'abc:one')
+
+
+@init_wrapper
+def test_get_running_task(r_mock, subject, mocker):
+    r_mock.hget = mocker.Mock(side_effect=[b'{"task_id": "svc", "started": 1}', None])
+    assert subject.get_running_task('abc', 'one') == {'task_id': 'svc', 'started': 1}
+    assert subject.get_running_task('abc', 'two') is None
+    r_mock.hget.assert_called_with('swarmer:running', 'abc:two')
+
+
+@init_wrapper
+def test_wait_for_finished_job_within_socket_timeout(r_mock, subject, mocker):
+    r_mock.connection_pool = mocker.Mock(connection_kwargs={'socket_timeout': 5.0})
+    r_mock.brpop = mocker.Mock(return_value=None)
+    assert subject.wait_for_finished_job(60) is None
+    r_mock.brpop.assert_called_once_with('swarmer:finished', timeout=4)
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+import redis
+
+from db import RedisConfig
+
+
+def test_from_environ(mocker):
+    mocker.patch.dict(os.environ, {'REDIS_TARGET': 'redis', 'REDIS_PORT': '6380', 'REDIS_MAX_CONNECTIONS': '10',
+                                   'REDIS_SOCKET_TIMEOUT': '1.5', 'REDIS_KEEPALIVE': 'false',
+                                   'REDIS_SENTINELS': 'one:26380, two'})
+    subject = RedisConfig.from_environ()
+    assert (subject.host, subject.port) == ('redis', 6380)
+    assert subject.max_connections == 10
+    assert subject.socket_timeout == 1.5
+    assert not subject.keepalive
+    assert subject.retry_on_timeout
+    assert subject.sentinels == [('one', 26380), ('two', 26379)]
+
+
+def test_tcp_client():
+    client = RedisConfig(host='redis', port=6380, max_connections=10, socket_timeout=3).create_client()
+    pool = client.connection_pool
+    assert pool.max_connections == 10
+    assert pool.connection_kwargs == {'host': 'redis', 'port': 6380, 'socket_timeout': 3, 'retry_on_timeout': True,
+                                      'socket_connect_timeout': 2.0, 'socket_keepalive': True}
+
+
+def test_unix_socket_client():
+    client = RedisConfig(socket_path='/run/redis.sock').create_client()
+    assert client.connection_pool.connection_class is redis.UnixDomainSocketConnection
+    assert client.connection_pool.connection_kwargs['path'] == '/run/redis.sock'
+
+
+def test_sentinel_client():
+    client = RedisConfig(sentinels=[('sentinel', 26379)], sentinel_service='main').create_client()
+    assert client.connection_pool.service_name == 'main'
+    assert client.connection_pool.connection_kwargs['socket_timeout'] == 5.0
+
+
+def test_requires_an_address():
+    with pytest.raises(ValueError):
+        RedisConfig().create_client()
@@ -0,0 +1,107 @@
+import gzip
+import json
+from concurrent.futures import Executor
+
+import requests
+
+from db import JobDb
+from jobs.delivery import ResultDelivery
+from jobs.links import OutputLinks
+
+
+class InlineExecutor(Executor):
+    def __init__(self, **_):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+def init_wrapper(f):
+    def get_session_mock(mocker):
+        job_log_mock = mocker.Mock(spec=JobDb)
+        session_mock = mocker.Mock(spec=requests.Session)
+        session_mock.post = mocker.Mock()
+        sleep_mock = mocker.Mock()
+        subject = ResultDelivery(job_log_mock, timeout=5, retries=3, backoff=1, session=session_mock,
+                                 executor_builder=InlineExecutor, sleep=sleep_mock)
+        return f(subject, job_log_mock, session_mock, sleep_mock, mocker)
+    return get_session_mock
+
+
+def response(mocker, status):
+    resp = mocker.Mock(spec=requests.Response)
+    resp.status_code = status
+    return resp
+
+
+@init_wrapper
+def test_send_results(subject, job_log_mock, session_mock, sleep_mock, mocker):
+    session_mock.post.side_effect = [response(mocker, 200)]
+    subject.send([('abc', {'__callback': 'urlone', 'something': 'else'})])
+    session_mock.post.assert_called_once_with('urlone', json={'__callback': 'urlone', 'something': 'else'},
+                                              timeout=5)
+    sleep_mock.assert_not_called()
+    job_log_mock.add_dead_letter.assert_not_called()
+    job_log_mock.clear_job.assert_called_once_with('abc')
+
+
+@init_wrapper
+def test_send_results_retries(subject, job_log_mock, session_mock, sleep_mock, mocker):
+    session_mock.post.side_effect = [requests.ConnectionError('refused'), response(mocker, 503), response(mocker, 204)]
+    subject.send([('abc', {'__callback': 'urlone'})])
+    assert session_mock.post.call_count == 3
+    assert [c[0][0] for c in sleep_mock.call_args_list] == [1, 2]
+    job_log_mock.add_dead_letter.assert_not_called()
+
+
+@init_wrapper
+def test_send_results_dead_letter(subject, job_log_mock, session_mock, sleep_mock, mocker):
+    session_mock.post.side_effect = [requests.Timeout('slow'), requests.Timeout('slow'), requests.Timeout('slow')]
+    subject.send([('abc', {'__callback': 'urlone'})])
+    assert session_mock.post.call_count == 3
+    job_log_mock.add_dead_letter.assert_called_once_with('abc', 'urlone', 'slow')
+    job_log_mock.clear_job.assert_not_called()
+
+
+@init_wrapper
+def test_send_results_unexpected_error(subject, job_log_mock, session_mock, sleep_mock, mocker):
+    session_mock.post.side_effect = ValueError('bad payload')
+    job_log_mock.add_dead_letter.side_effect = [ConnectionError('redis is down'), None]
+    subject.send([('abc', {'__callback': 'urlone'}), ('def', {'__callback': 'urltwo'})])
+    job_log_mock.add_dead_letter.assert_has_calls([mocker.call('abc', 'urlone', 'bad payload'),
+                                                   mocker.call('def', 'urltwo', 'bad payload')])
+    job_log_mock.clear_job.assert_not_called()
+
+
+@init_wrapper
+def test_send_results_client_error_not_retried(subject, job_log_mock, session_mock, sleep_mock, mocker):
+    session_mock.post.side_effect = [response(mocker, 404)]
+    subject.send([('abc', {'__callback': 'urlone'})])
+    session_mock.post.assert_called_once()
+    sleep_mock.assert_not_called()
+    job_log_mock.add_dead_letter.assert_called_once_with('abc', 'urlone',
+                                                         'Callback responded with status 404')
+
+
+def test_send_results_with_output_links(mocker):
+    session_mock = mocker.Mock(spec=requests.Session)
+    session_mock.post = mocker.Mock(return_value=response(mocker, 200))
+    subject = ResultDelivery(mocker.Mock(spec=JobDb), session=session_mock, executor_builder=InlineExecutor,
+                             links=OutputLinks('http://swarmer:8500'))
+    subject.send([('abc', {'__callback': 'urlone', 'tasks': [
+        {'name': 'one', 'result': {'stdout': None, 'stderr': None, 'outputs': {'stdout': '/output/abc/one/stdout'}}}
+    ]})])
+    _, kwargs = session_mock.post.call_args
+    assert kwargs['json']['tasks'][0]['result']['outputs'] == {'stdout': 'http://swarmer:8500/output/abc/one/stdout'}
+
+
+def test_send_compressed_results(mocker):
+    session_mock = mocker.Mock(spec=requests.Session)
+    session_mock.post = mocker.Mock(return_value=response(mocker, 200))
+    subject = ResultDelivery(mocker.Mock(spec=JobDb), timeout=5, session=session_mock,
+                             executor_builder=InlineExecutor, compress=True)
+    subject.send([('abc', {'__callback': 'urlone', 'something': 'else'})])
+    _, kwargs = session_mock.post.call_args
+    assert kwargs['headers'] == {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    assert json.loads(gzip.decompress(kwargs['data'])) == {'__callback': 'urlone', 'something': 'else'}
@@ -0,0 +1,25 @@
+from threading import Event, Thread
+
+from jobs.scheduler import Scheduler
+
+
+def test_run_once(mocker):
+    dispatch = mocker.Mock()
+    subject = Scheduler(dispatch, thread_builder=mocker.Mock(spec=Thread))
+    subject.run_once()
+    dispatch.assert_called_once_with()
+
+
+def test_run_once_survives_errors(mocker):
+    dispatch = mocker.Mock(side_effect=[ValueError('boom'), None])
+    subject = Scheduler(dispatch, thread_builder=mocker.Mock(spec=Thread))
+    subject.run_once()
+    subject.run_once()
+    assert dispatch.call_count == 2
+
+
+def test_wake_dispatches_on_scheduler_thread(mocker):
+    dispatched = Event()
+    subject = Scheduler(dispatched.set)
+    subject.wake()
+    assert dispatched.wait(timeout=2)
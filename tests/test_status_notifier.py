@@ -0,0 +1,62 @@
+from threading import Thread
+
+import pytest
+
+from db import JobDb
+from jobs.notifier import StatusNotifier
+
+
+def init_wrapper(f):
+    def get_notifier(mocker):
+        subject = StatusNotifier(mocker.Mock(spec=JobDb), thread_builder=mocker.Mock(spec=Thread))
+        return f(subject, mocker)
+    return get_notifier
+
+
+@init_wrapper
+def test_wait_returns_after_change(subject, mocker):
+    seen = subject.watch('abc')
+    subject.notify('abc')
+    assert subject.wait('abc', seen, 1) == seen + 1
+
+
+@init_wrapper
+def test_wait_times_out(subject, mocker):
+    seen = subject.watch('abc')
+    subject.notify('other')
+    assert subject.wait('abc', seen, 0.01) is None
+
+
+@init_wrapper
+def test_changes_are_only_tracked_while_watched(subject, mocker):
+    subject.notify('abc')
+    subject.watch('abc')
+    subject.watch('abc')
+    subject.unwatch('abc')
+    assert subject.watch('abc') == 0
+    subject.unwatch('abc')
+    subject.unwatch('abc')
+    with pytest.raises(ValueError):
+        subject.wait('abc', 0, 0.01)
+
+
+@init_wrapper
+def test_listen_notifies_changed_jobs(subject, mocker):
+    seen = subject.watch('abc')
+    subject._job_db.listen_for_changes.return_value = iter([('abc', 'one'), ('other', 'two')])
+    mocker.patch('time.sleep', side_effect=StopIteration)
+    with pytest.raises(StopIteration):
+        subject._listen()
+    assert subject.wait('abc', seen, 0) == 1
+
+
+@init_wrapper
+def test_changed_tasks(subject, mocker):
+    seen = subject.watch('abc')
+    subject.notify('abc', 'one')
+    subject.notify('abc', 'two')
+    subject.notify('abc', 'one')
+    assert subject.changed_tasks('abc', seen) == {'one', 'two'}
+    assert subject.changed_tasks('abc', seen + 2) == {'one'}
+    subject.notify('abc')
+    assert subject.changed_tasks('abc', seen) is None
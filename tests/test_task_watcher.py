@@ -0,0 +1,30 @@
+from threading import Event, Thread
+
+from jobs.watcher import TaskExitWatcher
+from wrapper import DockerWrapper
+
+
+def test_exit_handled_after_grace_period(mocker):
+    handled = Event()
+    on_exit = mocker.Mock(side_effect=lambda *_: handled.set())
+    docker_mock = mocker.Mock(spec=DockerWrapper)
+    subject = TaskExitWatcher(docker_mock, on_exit, thread_builder=mocker.Mock(spec=Thread), grace_period=0.05)
+    Thread(target=subject._process_exits, daemon=True).start()
+    subject.add_exit('abc', 'one', 1, False, 'svc')
+    assert not handled.wait(timeout=0.01)
+    assert handled.wait(timeout=2)
+    on_exit.assert_called_once_with('abc', 'one', 1, False, 'svc')
+
+
+def test_exits_without_labels_are_ignored(mocker):
+    subject = TaskExitWatcher(mocker.Mock(spec=DockerWrapper), mocker.Mock(), thread_builder=mocker.Mock(spec=Thread))
+    subject.add_exit(None, None, 0, False)
+    assert len(subject._exits) == 0
+
+
+def test_poll_finished_tasks(mocker):
+    docker_mock = mocker.Mock(spec=DockerWrapper)
+    docker_mock.finished_tasks.return_value = [('abc', 'one', 137, False, 'svc')]
+    subject = TaskExitWatcher(docker_mock, mocker.Mock(), thread_builder=mocker.Mock(spec=Thread))
+    subject._poll_finished_tasks()
+    assert [e for _, e in subject._exits] == [('abc', 'one', 137, False, 'svc')]
@@ -0,0 +1,76 @@
+from threading import Thread
+
+import pytest
+from docker.errors import APIError
+
+from db import PoolDb
+from jobs.pool import WorkerPool, pool_id_for
+from models import RunnableTask
+from wrapper import DockerWrapper
+
+
+def init_wrapper(f):
+    def get_pool_mocks(mocker):
+        docker_mock = mocker.Mock(spec=DockerWrapper)
+        pool_db_mock = mocker.Mock(spec=PoolDb)
+        subject = WorkerPool(docker_mock, pool_db_mock, size=3, idle_timeout=60,
+                             thread_builder=mocker.Mock(spec=Thread))
+        return f(subject, docker_mock, pool_db_mock, mocker)
+    return get_pool_mocks
+
+
+@init_wrapper
+def test_submit_starts_new_pool(subject, docker_mock, pool_db_mock, mocker):
+    pool_db_mock.push_task.return_value = True
+    subject.submit(RunnableTask('abc', 'one', ['a'], 'some-image'))
+    pool_id = pool_id_for('some-image')
+    pool_db_mock.push_task.assert_called_once_with(pool_id, 'some-image',
+                                                   {'job_id': 'abc', 'task_name': 'one', 'task_args': ['a']})
+    docker_mock.start_pool.assert_called_once_with(pool_id, 'some-image', 3)
+
+
+@init_wrapper
+def test_submit_reuses_known_pool(subject, docker_mock, pool_db_mock, mocker):
+    pool_db_mock.push_task.return_value = False
+    subject.submit(RunnableTask('abc', 'one', [], 'some-image'))
+    docker_mock.start_pool.assert_not_called()
+    pool_db_mock.push_task.assert_called_once()
+
+
+@init_wrapper
+def test_submit_forgets_pool_that_fails_to_start(subject, docker_mock, pool_db_mock, mocker):
+    pool_db_mock.push_task.return_value = True
+    docker_mock.start_pool.side_effect = APIError('no such image')
+    with pytest.raises(APIError):
+        subject.submit(RunnableTask('abc', 'one', [], 'some-image'))
+    pool_id = pool_id_for('some-image')
+    pool_db_mock.withdraw_task.assert_called_once_with(pool_id, {'job_id': 'abc', 'task_name': 'one',
+                                                                 'task_args': []})
+    pool_db_mock.remove_pool.assert_called_once_with(pool_id)
+
+
+@init_wrapper
+def test_finish_task(subject, docker_mock, pool_db_mock, mocker):
+    subject.finish_task('abc', 'one')
+    pool_db_mock.finish_task.assert_called_once_with('abc', 'one')
+
+
+@init_wrapper
+def test_remove_idle_pools(subject, docker_mock, pool_db_mock, mocker):
+    pool_db_mock.get_idle_pools.return_value = ['p1', 'busy']
+    pool_db_mock.claim_idle_pool.side_effect = lambda pool_id, _: pool_id == 'p1'
+    pool_db_mock.release_pool.return_value = None
+    subject._remove_idle_pools()
+    docker_mock.stop_pool.assert_called_once_with('p1')
+    pool_db_mock.release_pool.assert_called_once_with('p1')
+    docker_mock.start_pool.assert_not_called()
+
+
+@init_wrapper
+def test_pool_given_tasks_while_stopping_is_started_again(subject, docker_mock, pool_db_mock, mocker):
+    pool_db_mock.get_idle_pools.return_value = ['p1']
+    pool_db_mock.claim_idle_pool.return_value = True
+    pool_db_mock.release_pool.return_value = 'some-image'
+    subject._remove_idle_pools()
+    docker_mock.stop_pool.assert_called_once_with('p1')
+    docker_mock.start_pool.assert_called_once_with('p1', 'some-image', 3)
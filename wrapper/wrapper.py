@@ -1,7 +1,11 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable
 
 import docker
-from docker.types import RestartPolicy
+from docker.errors import APIError, NotFound
+from docker.types import Resources, RestartPolicy, ServiceMode
 
 from auth.authfactory import AuthenticationFactory
 from log import LogManager
@@ -11,16 +15,43 @@ from models import RunnerConfig
 class DockerWrapper:
     DOCKER_RESTART_POLICY = RestartPolicy(condition='none')
 
+    # Every service and container started by swarmer carries these labels
+    MANAGED_LABEL = 'swarmer.managed'
+    JOB_LABEL = 'swarmer.job'
+    TASK_LABEL = 'swarmer.task'
+
+    # Services running a batch of tasks carry the JSON list of their task names instead
+    BATCH_LABEL = 'swarmer.tasks'
+
+    # Long lived worker services carry this label instead, they are never pruned
+    POOL_LABEL = 'swarmer.pool'
+
+    # Services that pull an image onto every node ahead of its tasks carry this label
+    PREPULL_LABEL = 'swarmer.prepull'
+
+    # Swarm labels the containers of a service with the id of the service
+    SERVICE_ID_LABEL = 'com.docker.swarm.service.id'
+
+    # Task services started before they were labelled are named '<job id>-<task name>'
+    TASK_SERVICE_NAME = re.compile(r'^(?P<job>[0-9A-HJKMNP-TV-Z]{26})-(?P<task>.+)$')
+
+    # A service whose tasks are all in one of these states has finished running
+    FINISHED_TASK_STATES = {'complete', 'failed', 'shutdown', 'rejected', 'orphaned', 'remove'}
+
     def __init__(self,
                  client: docker.DockerClient,
                  config: RunnerConfig,
-                 authenticator: AuthenticationFactory):
+                 authenticator: AuthenticationFactory,
+                 removal_workers=8,
+                 executor_builder=ThreadPoolExecutor):
         self._client = client
         self._config = config
         self._authenticator = authenticator
         self._logger = LogManager(__name__)
+        self._removal_executor = executor_builder(max_workers=removal_workers)
 
-    def start_task(self, job_id: str, image: str, task_name: str, task_args: Iterable[str]) -> int:
+    def start_task(self, job_id: str, image: str, task_name: str, task_args: Iterable[str], resources: dict = None,
+                   constraints: Iterable[str] = None) -> int:
         self._logger.info('Starting task {tn} for job {ji}'.format(tn=task_name, ji=job_id))
         run_env = [
             'SWARMER_ADDRESS=http://{addr}:{port}/result/{ident}'.format(addr=self._config.host,
@@ -32,18 +63,237 @@ class DockerWrapper:
         if any(task_args):
             run_env += ['RUN_ARGS={args}'.format(args=','.join([str(a) for a in task_args]))]
 
+        labels = {self.MANAGED_LABEL: 'true', self.JOB_LABEL: job_id, self.TASK_LABEL: task_name}
         svc = self._get_client().services.create(image, env=run_env, restart_policy=self.DOCKER_RESTART_POLICY,
                                                  networks=[self._config.network],
-                                                 name='{id}-{name}'.format(id=job_id, name=task_name))
+                                                 name='{id}-{name}'.format(id=job_id, name=task_name),
+                                                 labels=labels, container_labels=labels,
+                                                 resources=_build_resources(resources), constraints=constraints)
+        return svc.id
+
+    def start_batch(self, job_id: str, image: str, tasks: Iterable[dict], resources: dict = None,
+                    constraints: Iterable[str] = None) -> int:
+        """ Start a single service that runs several tasks of a job, the task
+        names and arguments are passed as JSON in SWARMER_TASKS and the results
+        are reported together to the batch callback
+
+        :param job_id: The unique job identifier
+        :param image: The image that runs the tasks
+        :param tasks: The tasks to run, as dicts with task_name and task_args
+        :returns: The id of the service
+        """
+        tasks = list(tasks)
+        self._logger.info('Starting a batch of {n} tasks for job {ji}'.format(n=len(tasks), ji=job_id))
+        run_env = [
+            'SWARMER_ADDRESS=http://{addr}:{port}/result/{ident}/batch'.format(addr=self._config.host,
+                                                                               port=self._config.port,
+                                                                               ident=job_id),
+            'SWARMER_JOB_ID={ident}'.format(ident=job_id),
+            'SWARMER_TASKS={tasks}'.format(tasks=json.dumps(tasks, separators=(',', ':')))
+        ]
+
+        labels = {self.MANAGED_LABEL: 'true', self.JOB_LABEL: job_id,
+                  self.BATCH_LABEL: json.dumps([t['task_name'] for t in tasks])}
+        svc = self._get_client().services.create(image, env=run_env, restart_policy=self.DOCKER_RESTART_POLICY,
+                                                 networks=[self._config.network],
+                                                 name='{id}-batch-{name}'.format(id=job_id,
+                                                                                 name=tasks[0]['task_name']),
+                                                 labels=labels, container_labels=labels,
+                                                 resources=_build_resources(resources), constraints=constraints)
+        return svc.id
+
+    def start_pool(self, pool_id: str, image: str, replicas: int) -> str:
+        """ Start a long lived, replicated worker service for an image, the
+        workers pull their tasks from swarmer instead of being started per task
+
+        :param pool_id: The identifier of the pool
+        :param image: The image the workers run
+        :param replicas: The number of workers
+        :returns: The id of the worker service
+        """
+        existing = self._pool_services(pool_id)
+        if existing:
+            return existing[0]['ID']
+
+        self._logger.info('Starting worker pool {p} for image {img}'.format(p=pool_id, img=image))
+        address = 'http://{addr}:{port}'.format(addr=self._config.host, port=self._config.port)
+        run_env = [
+            'SWARMER_POOL_ADDRESS={a}/pool/{p}/task'.format(a=address, p=pool_id),
+            'SWARMER_RESULT_ADDRESS={a}/result'.format(a=address)
+        ]
+        labels = {self.POOL_LABEL: pool_id}
+        svc = self._get_client().services.create(image, env=run_env, networks=[self._config.network],
+                                                 name='swarmer-pool-{p}'.format(p=pool_id),
+                                                 mode=ServiceMode('replicated', replicas=replicas),
+                                                 labels=labels, container_labels=labels)
+        return svc.id
+
+    def stop_pool(self, pool_id: str):
+        """ Remove the worker service of a pool, if it is running
+
+        :param pool_id: The identifier of the pool
+        """
+        self.remove_service([svc['ID'] for svc in self._pool_services(pool_id)])
+
+    def prepull_image(self, image: str) -> str:
+        """ Start a global, one shot service that pulls an image onto every
+        node of the swarm, so the first tasks of a job don't wait on the pull.
+        The containers only exit, whether they succeed does not matter once the
+        image is on the node.
+
+        :param image: The image to pull
+        :returns: The id of the service
+        """
+        self._logger.info('Pulling image {img} onto the swarm nodes'.format(img=image))
+        labels = {self.PREPULL_LABEL: image}
+        svc = self._get_client().services.create(image, command=['true'], restart_policy=self.DOCKER_RESTART_POLICY,
+                                                 mode=ServiceMode('global'), labels=labels, container_labels=labels)
         return svc.id
 
+    def service_finished(self, service_id: str) -> bool:
+        """ Check whether every task of a service has finished running
+
+        :param service_id: The id of the service
+        :returns: True once the service has tasks and all of them are finished
+        """
+        states = {task['Status']['State'] for task in self._client.api.tasks(filters={'service': service_id})}
+        return bool(states) and states.issubset(self.FINISHED_TASK_STATES)
+
     def remove_service(self, service_ids: Iterable[int]):
-        for sid in service_ids:
-            svc = self._client.services.get(sid)
-            if svc:
-                svc.remove()
+        """ Remove the given services concurrently, services that are
+        already gone are skipped
+        """
+        service_ids = [sid for sid in service_ids if sid]
+        if not service_ids:
+            return
+
+        self._logger.info('Removing {n} services'.format(n=len(service_ids)))
+        list(self._removal_executor.map(self._remove_one, service_ids))
+
+    def prune_services(self) -> int:
+        """ Remove every swarmer service whose tasks have all finished, this
+        reclaims services whose results were never reported
+
+        :returns: The number of services removed
+        """
+        states = {}
+        for task in self._managed_tasks():
+            states.setdefault(task['ServiceID'], set()).add(task['Status']['State'])
+
+        finished = [sid for sid, state in states.items() if state.issubset(self.FINISHED_TASK_STATES)]
+        self._logger.info('Pruning {n} finished services'.format(n=len(finished)))
+        self.remove_service(finished)
+        return len(finished)
+
+    def task_exits(self):
+        """ Stream the exits of task containers as they happen. Container
+        events are only reported for the node the client is connected to.
+
+        :returns: A generator of (job id, task name, exit code, oom killed, service id) tuples
+        """
+        oom_killed = set()
+        events = self._client.events(decode=True, filters={'type': 'container', 'event': ['oom', 'die'],
+                                                            'label': '{l}=true'.format(l=self.MANAGED_LABEL)})
+        for event in events:
+            actor = event.get('Actor', {})
+            attributes = actor.get('Attributes', {})
+            if event.get('Action') == 'oom':
+                oom_killed.add(actor.get('ID'))
+                continue
+
+            oom = actor.get('ID') in oom_killed
+            oom_killed.discard(actor.get('ID'))
+            for task_name in self._task_names(attributes):
+                yield (attributes.get(self.JOB_LABEL), task_name, int(attributes.get('exitCode', -1)), oom,
+                       attributes.get(self.SERVICE_ID_LABEL))
+
+    def finished_tasks(self):
+        """ List the task containers across the whole swarm that are no longer running
+
+        :returns: A list of (job id, task name, exit code, oom killed, service id) tuples
+        """
+        finished = []
+        for task in self._managed_tasks():
+            if task['Status']['State'] not in self.FINISHED_TASK_STATES:
+                continue
+            labels = task['Spec']['ContainerSpec'].get('Labels') or {}
+            exit_code = task['Status'].get('ContainerStatus', {}).get('ExitCode', -1)
+            finished.extend((labels.get(self.JOB_LABEL), name, exit_code, False, task.get('ServiceID'))
+                            for name in self._task_names(labels))
+        return finished
+
+    def task_services(self):
+        """ List the services that are running tasks, matched to their tasks by
+        their labels, or by their name for services that have none
+
+        :returns: A dict of (job id, task name) to service id
+        """
+        services = {}
+        for svc in self._client.api.services():
+            labels = svc['Spec'].get('Labels') or {}
+            if labels.get(self.MANAGED_LABEL) == 'true':
+                for task_name in self._task_names(labels):
+                    services[(labels.get(self.JOB_LABEL), task_name)] = svc['ID']
+                continue
+
+            match = self.TASK_SERVICE_NAME.match(svc['Spec'].get('Name', ''))
+            if match and not labels:
+                services[(match.group('job'), match.group('task'))] = svc['ID']
+        return services
+
+    def node_resources(self):
+        """ List the resources of every swarm node that can run tasks
+
+        :returns: A list of (cpus, memory bytes) tuples, one per ready and active node
+        """
+        resources = []
+        for node in self._client.api.nodes():
+            if node['Status'].get('State') != 'ready' or node['Spec'].get('Availability') != 'active':
+                continue
+            available = node['Description'].get('Resources', {})
+            resources.append((available.get('NanoCPUs', 0) / 1e9, available.get('MemoryBytes', 0)))
+        return resources
+
+    def _task_names(self, labels):
+        if self.BATCH_LABEL in labels:
+            return json.loads(labels[self.BATCH_LABEL])
+        return [labels.get(self.TASK_LABEL)]
+
+    def _pool_services(self, pool_id):
+        return self._client.api.services(filters={'label': '{l}={p}'.format(l=self.POOL_LABEL, p=pool_id)})
+
+    def _managed_tasks(self):
+        services = self._client.api.services(filters={'label': '{l}=true'.format(l=self.MANAGED_LABEL)})
+        if not services:
+            return []
+        return self._client.api.tasks(filters={'service': [s['ID'] for s in services]})
+
+    def _remove_one(self, sid):
+        try:
+            self._client.api.remove_service(sid)
+        except NotFound:
+            self._logger.debug('Service {s} was already removed'.format(s=sid))
+        except APIError as ex:
+            self._logger.error('Unable to remove service {s}: {e}'.format(s=sid, e=ex))
 
     def _get_client(self):
-        if self._authenticator and self._authenticator.any_require_login:
-            self._authenticator.perform_logins(self._client)
+        if self._authenticator:
+            self._authenticator.ensure_logins(self._client)
         return self._client
+
+
+def _build_resources(resources):
+    """ Convert the resources requested by a task, cpus are given as a
+    number of cpus and docker wants them in nano cpus
+    """
+    if not resources:
+        return None
+
+    def nano_cpus(cpus):
+        return None if cpus is None else int(cpus * 1e9)
+
+    return Resources(cpu_limit=nano_cpus(resources.get('cpu_limit')),
+                     mem_limit=resources.get('mem_limit'),
+                     cpu_reservation=nano_cpus(resources.get('cpu_reservation')),
+                     mem_reservation=resources.get('mem_reservation'),
+                     generic_resources=resources.get('generic_resources'))